@@ -1,14 +1,18 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, Query
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReplaceOne, ReturnDocument, CursorType
+from pymongo.errors import DuplicateKeyError, OperationFailure, CollectionInvalid, BulkWriteError
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr, field_validator
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Callable, Awaitable
 import uuid
 from datetime import datetime, timezone, timedelta
 import hashlib
@@ -18,11 +22,19 @@ import bcrypt
 import httpx
 import random
 import re
-from collections import defaultdict
+import math
+from collections import defaultdict, deque
 import time
 import base64
+import io
+import csv
+import zlib
+import json
 import asyncio
 import smtplib
+from string import Template
+import numpy as np
+import pandas as pd
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
@@ -34,6 +46,23 @@ except ImportError:
     AI_AVAILABLE = False
     logging.warning("emergentintegrations not available, AI features disabled")
 
+# Async OpenAI client for product analysis
+try:
+    from openai import AsyncOpenAI
+    OPENAI_AVAILABLE = True
+except ImportError:
+    OPENAI_AVAILABLE = False
+    logging.warning("openai not available, AI product analysis disabled")
+
+# Perceptual hashing of receipts
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+    # Exact (sha256) duplicates are still caught; only near-copies go unnoticed
+    logging.warning("Pillow not available, receipt near-duplicate detection disabled")
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
@@ -41,14 +70,28 @@ load_dotenv(ROOT_DIR / '.env')
 mongo_url = os.getenv("MONGO_URL")
 if not mongo_url:
     raise RuntimeError("❌ MONGO_URL is not set in environment variables")
-client = AsyncIOMotorClient(mongo_url)
+# Timestamps are stored as native BSON dates and come back as aware UTC datetimes
+client = AsyncIOMotorClient(mongo_url, tz_aware=True, tzinfo=timezone.utc)
 db = client[os.environ['DB_NAME']]
 
+def as_utc(value) -> Optional[datetime]:
+    """Normalize a timestamp to an aware UTC datetime.
+    Strings are accepted for API input and for documents not yet migrated to native dates."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
 # Email Settings
 SMTP_SERVER = os.environ.get("SMTP_SERVER", "smtp.gmail.com")
 SMTP_PORT = int(os.environ.get("SMTP_PORT", 587))
 SMTP_USER = os.environ.get("SMTP_USER", "")
 SMTP_PASSWORD = os.environ.get("SMTP_PASSWORD", "")
+# STARTTLS on plain ports; "0" only for a local relay or test server without TLS
+SMTP_STARTTLS = os.environ.get("SMTP_STARTTLS", "1") != "0"
 
 # JWT Settings
 JWT_SECRET = os.environ.get('JWT_SECRET', secrets.token_hex(32))
@@ -134,19 +177,16 @@ def escape_regex(value: str) -> str:
     """Escape special characters for regex to prevent ReDoS"""
     return re.escape(value)
 
-async def send_verification_email(email: str, code: str):
-    """Send verification code to user's email"""
-    if not SMTP_USER or not SMTP_PASSWORD:
-        logging.warning("SMTP credentials not set, email not sent")
-        return False
-    
-    try:
-        msg = MIMEMultipart()
-        msg['From'] = SMTP_USER
-        msg['To'] = email
-        msg['Subject'] = "Код подтверждения регистрации TSMarket"
-        
-        body = f"""
+# Mail: pooled SMTP connections, provider rate limit, templates compiled once at startup
+SMTP_POOL_SIZE = int(os.environ.get("SMTP_POOL_SIZE", 2))
+SMTP_RATE_PER_MINUTE = float(os.environ.get("SMTP_RATE_PER_MINUTE", 30))
+SMTP_TIMEOUT = 30
+SMTP_IDLE_CHECK_AFTER = 60  # seconds idle before a pooled connection is NOOP-checked
+
+EMAIL_TEMPLATES = {
+    "verification_code": (
+        "Код подтверждения регистрации TSMarket",
+        Template("""
         <html>
             <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
                 <div style="max-width: 600px; margin: 0 auto; padding: 20px; border: 1px solid #eee; border-radius: 10px;">
@@ -154,7 +194,7 @@ async def send_verification_email(email: str, code: str):
                     <p>Здравствуйте!</p>
                     <p>Для завершения регистрации, пожалуйста, введите следующий 6-значный код подтверждения:</p>
                     <div style="background-color: #f3f4f6; padding: 20px; text-align: center; font-size: 32px; font-weight: bold; letter-spacing: 5px; color: #0f766e; border-radius: 5px; margin: 20px 0;">
-                        {code}
+                        $code
                     </div>
                     <p>Этот код действителен в течение 10 минут. Если вы не запрашивали этот код, просто проигнорируйте это письмо.</p>
                     <hr style="border: 0; border-top: 1px solid #eee; margin: 20px 0;">
@@ -162,158 +202,353 @@ async def send_verification_email(email: str, code: str):
                 </div>
             </body>
         </html>
-        """
-        msg.attach(MIMEText(body, 'html'))
-        
-        # Use asyncio.to_thread for blocking smtplib calls
-        def _send():
-            if SMTP_PORT == 465:
-                with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) as server:
-                    server.login(SMTP_USER, SMTP_PASSWORD)
-                    server.send_message(msg)
-            else:
-                with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-                    server.starttls()
-                    server.login(SMTP_USER, SMTP_PASSWORD)
-                    server.send_message(msg)
-        
-        await asyncio.to_thread(_send)
+        """)
+    ),
+}
+
+def render_email(template: str, **context) -> tuple:
+    """Returns (subject, html) for a named template"""
+    subject, body = EMAIL_TEMPLATES[template]
+    return subject, body.substitute(**context)
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class SmtpPool:
+    """Small pool of long-lived, logged-in SMTP connections.
+
+    smtplib is blocking, so each send runs in a thread; at most `size` sends run at
+    once and each reuses an idle connection instead of a new TLS handshake + login.
+    Dropped connections are detected (NOOP after idling, or a failed send) and reopened.
+    A message the server refuses (bad recipient, sender, content) fails on its own
+    and the connection goes back to the pool.
+    """
+
+    def __init__(self, size: int):
+        self.slots = asyncio.Semaphore(size)
+        self.idle: List[tuple] = []  # (connection, last_used)
+
+    @staticmethod
+    def _connect() -> smtplib.SMTP:
+        if SMTP_PORT == 465:
+            conn = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        else:
+            conn = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        try:
+            if SMTP_PORT != 465 and SMTP_STARTTLS:
+                conn.starttls()
+            conn.login(SMTP_USER, SMTP_PASSWORD)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    @staticmethod
+    def _close(conn: smtplib.SMTP):
+        try:
+            conn.quit()
+        except Exception:
+            conn.close()
+
+    @staticmethod
+    def _connection_lost(error: Exception) -> bool:
+        """Whether the connection is unusable after `error`. SMTPException subclasses
+        OSError, so protocol replies are told apart first: after a refused sender or
+        recipient smtplib has already sent RSET and the session can be reused."""
+        if isinstance(error, smtplib.SMTPServerDisconnected):
+            return True
+        if isinstance(error, smtplib.SMTPResponseException):
+            return error.smtp_code == 421  # Server is closing the channel
+        if isinstance(error, smtplib.SMTPException):
+            return False
+        return isinstance(error, OSError)
+
+    def _deliver(self, conn: Optional[smtplib.SMTP], last_used: float, msg) -> tuple:
+        """Blocking: send `msg`, reconnecting once if the connection is gone.
+        Returns (connection to pool or None, error or None)."""
+        if conn is not None and time.monotonic() - last_used > SMTP_IDLE_CHECK_AFTER:
+            try:
+                if conn.noop()[0] != 250:
+                    raise smtplib.SMTPServerDisconnected("NOOP failed")
+            except (smtplib.SMTPException, OSError):
+                self._close(conn)
+                conn = None
+        fresh = conn is None
+        if fresh:
+            conn = self._connect()
+        while True:
+            try:
+                conn.send_message(msg)
+                return conn, None
+            except Exception as e:
+                if not self._connection_lost(e):
+                    return conn, e
+                self._close(conn)
+                if fresh:
+                    return None, e
+                conn = self._connect()
+                fresh = True
+
+    async def send(self, msg):
+        async with self.slots:
+            conn, last_used = self.idle.pop() if self.idle else (None, 0.0)
+            conn, error = await asyncio.to_thread(self._deliver, conn, last_used, msg)
+            if conn is not None:
+                self.idle.append((conn, time.monotonic()))
+            if error is not None:
+                raise error
+
+    async def close(self):
+        idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            await asyncio.to_thread(self._close, conn)
+
+smtp_pool = SmtpPool(SMTP_POOL_SIZE)
+mail_rate_limit = TokenBucket(SMTP_RATE_PER_MINUTE / 60, capacity=SMTP_POOL_SIZE)
+
+async def send_email(to: str, template: str, **context) -> bool:
+    """Render and send a templated email; False if it could not be delivered"""
+    if not SMTP_USER or not SMTP_PASSWORD:
+        logging.warning("SMTP credentials not set, email not sent")
+        return False
+    
+    subject, body = render_email(template, **context)
+    msg = MIMEMultipart()
+    msg['From'] = SMTP_USER
+    msg['To'] = to
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body, 'html'))
+    
+    await mail_rate_limit.acquire()
+    try:
+        await smtp_pool.send(msg)
         return True
     except Exception as e:
         logging.error(f"Failed to send email: {str(e)}")
+        return False
+
+async def send_verification_email(email: str, code: str):
+    """Send verification code to user's email"""
+    sent = await send_email(email, "verification_code", code=code)
+    if not sent:
         # DEBUG: Print code to logs so user can register without working SMTP
         logging.info(f"DEBUG: Verification code for {email} is: {code}")
-        return False
+    return sent
 
-# AI Receipt Analysis Function
-async def analyze_receipt_with_ai(receipt_image_url: str, expected_amount: float) -> dict:
-    """
-    Analyze receipt image using AI to verify the amount.
-    Returns: {"approved": bool, "confidence": str, "extracted_amount": float|None, "reason": str}
-    """
-    if not AI_AVAILABLE:
-        return {"approved": False, "confidence": "none", "extracted_amount": None, "reason": "AI модуль не доступен"}
-    
-    api_key = os.environ.get('EMERGENT_LLM_KEY')
-    if not api_key:
-        return {"approved": False, "confidence": "none", "extracted_amount": None, "reason": "API ключ не настроен"}
-    
-    if not is_safe_url(receipt_image_url):
-        return {"approved": False, "confidence": "none", "extracted_amount": None, "reason": "Небезопасный URL изображения"}
+# AI Receipt Analysis
+# Provider: "emergent" (LLM via emergentintegrations) or "fake" (local stub for offline benchmarks,
+# its readings are low-confidence so every request still ends up in manual review)
+AI_RECEIPT_PROVIDER = os.environ.get("AI_RECEIPT_PROVIDER", "emergent")
+AI_RECEIPT_CONCURRENCY = int(os.environ.get("AI_RECEIPT_CONCURRENCY", 4))
+AI_RECEIPT_TIMEOUT = float(os.environ.get("AI_RECEIPT_TIMEOUT", 60))
+AI_FAKE_LATENCY = float(os.environ.get("AI_FAKE_LATENCY", 1.5))
 
+RECEIPT_SYSTEM_MESSAGE = """Ты - AI помощник для проверки чеков пополнения баланса. 
+Твоя задача - проанализировать изображение чека/квитанции и найти сумму перевода.
+
+ВАЖНО:
+1. Найди на изображении сумму денежного перевода
+2. Ответь ТОЛЬКО в формате JSON: {"amount": число_или_null, "confidence": "high/medium/low", "found": true/false}
+3. Если сумму определить невозможно или изображение некачественное, верни {"amount": null, "confidence": "low", "found": false}
+4. Не добавляй никакого дополнительного текста, только JSON"""
+
+RECEIPT_PHASH_BANDS = 4  # 64-bit dHash stored as 4 indexed 16-bit bands
+RECEIPT_PHASH_MAX_DISTANCE = 3  # below the band count, so any near copy shares a band
+RECEIPT_DUPLICATE_STATUSES = ["pending", "pending_ai", "approved"]
+
+def receipt_ai_available() -> bool:
+    """Whether the configured receipt provider can run"""
+    if AI_RECEIPT_PROVIDER == "fake":
+        return True
+    return AI_AVAILABLE and bool(os.environ.get('EMERGENT_LLM_KEY'))
+
+async def load_receipt_bytes(receipt_image_url: str) -> Optional[bytes]:
+    """Load receipt image bytes without blocking the event loop"""
     try:
-        # Get image as base64
-        image_base64 = None
-        
         if receipt_image_url.startswith('/uploads/'):
             # Local file
             file_path = ROOT_DIR / receipt_image_url.lstrip('/')
             if file_path.exists():
-                with open(file_path, 'rb') as f:
-                    image_base64 = base64.b64encode(f.read()).decode('utf-8')
+                return await asyncio.to_thread(file_path.read_bytes)
         elif receipt_image_url.startswith('http'):
             # Remote URL
-            async with httpx.AsyncClient() as client:
-                resp = await client.get(receipt_image_url, timeout=30)
-                if resp.status_code == 200:
-                    image_base64 = base64.b64encode(resp.content).decode('utf-8')
+            resp = await http_pool["receipt_images"].get(receipt_image_url)
+            if resp.status_code == 200:
+                return resp.content
         elif receipt_image_url.startswith('data:image'):
-            # Already base64
-            image_base64 = receipt_image_url.split(',')[1] if ',' in receipt_image_url else receipt_image_url
-        
-        if not image_base64:
-            return {"approved": False, "confidence": "none", "extracted_amount": None, "reason": "Не удалось загрузить изображение"}
-        
-        # Initialize AI chat
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=f"receipt_analysis_{uuid.uuid4().hex[:8]}",
-            system_message="""Ты - AI помощник для проверки чеков пополнения баланса. 
-Твоя задача - проанализировать изображение чека/квитанции и найти сумму перевода.
-
-ВАЖНО:
-1. Найди на изображении сумму денежного перевода
-2. Ответь ТОЛЬКО в формате JSON: {"amount": число_или_null, "confidence": "high/medium/low", "found": true/false}
-3. Если сумму определить невозможно или изображение некачественное, верни {"amount": null, "confidence": "low", "found": false}
-4. Не добавляй никакого дополнительного текста, только JSON"""
-        ).with_model("openai", "gpt-4o")
-        
-        # Create message with image
-        image_content = ImageContent(image_base64=image_base64)
-        user_message = UserMessage(
-            text=f"Найди сумму перевода на этом чеке. Ожидаемая сумма для проверки: {expected_amount}",
-            image_contents=[image_content]
-        )
-        
-        # Send to AI
-        response = await chat.send_message(user_message)
-        
-        # Parse response
-        try:
-            # Clean response - remove markdown if present
-            clean_response = response.strip()
-            if clean_response.startswith('```'):
-                clean_response = clean_response.split('```')[1]
-                if clean_response.startswith('json'):
-                    clean_response = clean_response[4:]
-            clean_response = clean_response.strip()
-            
-            import json
-            result = json.loads(clean_response)
-            
-            extracted_amount = result.get('amount')
-            confidence = result.get('confidence', 'low')
-            found = result.get('found', False)
-            
-            if not found or extracted_amount is None:
-                return {
-                    "approved": False, 
-                    "confidence": confidence,
-                    "extracted_amount": None,
-                    "reason": "AI не смог определить сумму на чеке"
-                }
-            
-            # Compare amounts (allow 5% tolerance)
-            tolerance = expected_amount * 0.05
-            amount_matches = abs(float(extracted_amount) - expected_amount) <= tolerance
-            
-            if amount_matches and confidence in ['high', 'medium']:
-                return {
-                    "approved": True,
-                    "confidence": confidence,
-                    "extracted_amount": float(extracted_amount),
-                    "reason": f"AI подтвердил: сумма {extracted_amount} соответствует заявленной {expected_amount}"
-                }
-            elif not amount_matches:
-                return {
-                    "approved": False,
-                    "confidence": confidence,
-                    "extracted_amount": float(extracted_amount),
-                    "reason": f"Сумма на чеке ({extracted_amount}) не совпадает с заявленной ({expected_amount})"
-                }
-            else:
-                return {
-                    "approved": False,
-                    "confidence": confidence,
-                    "extracted_amount": float(extracted_amount),
-                    "reason": "Низкая уверенность AI - требуется ручная проверка"
-                }
-                
-        except json.JSONDecodeError:
-            return {
-                "approved": False,
-                "confidence": "low",
-                "extracted_amount": None,
-                "reason": f"Ошибка парсинга ответа AI: {response[:100]}"
-            }
-            
+            # Inline base64
+            encoded = receipt_image_url.split(',')[1] if ',' in receipt_image_url else receipt_image_url
+            return base64.b64decode(encoded)
     except Exception as e:
-        logging.error(f"AI analysis error: {str(e)}")
+        logging.error(f"Failed to load receipt image: {str(e)}")
+    return None
+
+def receipt_dhash(data: bytes) -> Optional[str]:
+    """64-bit difference hash, stable across re-encoding, resizing and recompression"""
+    if not PIL_AVAILABLE:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            pixels = list(img.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    except Exception:
+        return None
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+def hash_receipt(data: bytes) -> dict:
+    """Exact and perceptual hashes of a receipt image (CPU-bound, run in a thread)"""
+    phash = receipt_dhash(data)
+    width = 16 // RECEIPT_PHASH_BANDS
+    return {
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "phash": phash,
+        "phash_bands": [
+            f"{i}:{phash[i * width:(i + 1) * width]}" for i in range(RECEIPT_PHASH_BANDS)
+        ] if phash else []
+    }
+
+async def find_receipt_matches(hashes: dict) -> List[dict]:
+    """Known receipts with the same bytes or a perceptually near-identical image"""
+    query = {"sha256": hashes["sha256"]}
+    if hashes["phash"]:
+        query = {"$or": [query, {"phash_bands": {"$in": hashes["phash_bands"]}}]}
+    candidates = await db.receipt_hashes.find(query, {"_id": 0}).to_list(200)
+    
+    def is_match(candidate: dict) -> bool:
+        if candidate["sha256"] == hashes["sha256"]:
+            return True
+        if not hashes["phash"] or not candidate.get("phash"):
+            return False
+        distance = bin(int(candidate["phash"], 16) ^ int(hashes["phash"], 16)).count("1")
+        return distance <= RECEIPT_PHASH_MAX_DISTANCE
+    
+    return [c for c in candidates if is_match(c)]
+
+async def record_receipt_hash(hashes: dict, request_id: str):
+    update = {
+        "$setOnInsert": {
+            "phash": hashes["phash"],
+            "phash_bands": hashes["phash_bands"],
+            "extraction": None,
+            "created_at": datetime.now(timezone.utc)
+        },
+        "$addToSet": {"request_ids": request_id}
+    }
+    try:
+        await db.receipt_hashes.update_one({"sha256": hashes["sha256"]}, update, upsert=True)
+    except DuplicateKeyError:
+        # Concurrent first submission of the same receipt; the document exists now
+        await db.receipt_hashes.update_one({"sha256": hashes["sha256"]}, update)
+
+async def ask_receipt_model(image_base64: str, expected_amount: float) -> str:
+    """Send the receipt to the configured provider, return the raw model answer"""
+    if AI_RECEIPT_PROVIDER == "fake":
+        # Simulated model round trip: reads the expected amount but never enough to auto-approve
+        await asyncio.sleep(random.uniform(0.5, 1.5) * AI_FAKE_LATENCY)
+        return json.dumps({"amount": expected_amount, "confidence": "low", "found": True})
+    
+    chat = LlmChat(
+        api_key=os.environ.get('EMERGENT_LLM_KEY'),
+        session_id=f"receipt_analysis_{uuid.uuid4().hex[:8]}",
+        system_message=RECEIPT_SYSTEM_MESSAGE
+    ).with_model("openai", "gpt-4o")
+    
+    # Create message with image
+    image_content = ImageContent(image_base64=image_base64)
+    user_message = UserMessage(
+        text=f"Найди сумму перевода на этом чеке. Ожидаемая сумма для проверки: {expected_amount}",
+        image_contents=[image_content]
+    )
+    return await chat.send_message(user_message)
+
+async def extract_receipt_amount(image: bytes, expected_amount: float) -> dict:
+    """
+    Ask the AI model for the transfer amount on a receipt.
+    Returns: {"found": bool, "amount": float|None, "confidence": str}
+    """
+    response = await ask_receipt_model(base64.b64encode(image).decode('utf-8'), expected_amount)
+    
+    # Clean response - remove markdown if present
+    clean_response = response.strip()
+    if clean_response.startswith('```'):
+        clean_response = clean_response.split('```')[1]
+        if clean_response.startswith('json'):
+            clean_response = clean_response[4:]
+    clean_response = clean_response.strip()
+    
+    try:
+        result = json.loads(clean_response)
+    except json.JSONDecodeError:
+        raise ValueError(f"Ошибка парсинга ответа AI: {response[:100]}")
+    
+    amount = result.get('amount')
+    return {
+        "found": bool(result.get('found', False)),
+        "amount": float(amount) if amount is not None else None,
+        "confidence": result.get('confidence', 'low')
+    }
+
+def evaluate_receipt_extraction(extraction: dict, expected_amount: float) -> dict:
+    """
+    Check an AI extraction against the claimed amount.
+    Returns: {"approved": bool, "confidence": str, "extracted_amount": float|None, "reason": str}
+    """
+    extracted_amount = extraction.get('amount')
+    confidence = extraction.get('confidence', 'low')
+    
+    if not extraction.get('found') or extracted_amount is None:
         return {
-            "approved": False,
-            "confidence": "none",
+            "approved": False, 
+            "confidence": confidence,
             "extracted_amount": None,
-            "reason": f"Ошибка AI анализа: {str(e)}"
+            "reason": "AI не смог определить сумму на чеке"
+        }
+    
+    # Compare amounts (allow 5% tolerance)
+    tolerance = expected_amount * 0.05
+    amount_matches = abs(float(extracted_amount) - expected_amount) <= tolerance
+    
+    if amount_matches and confidence in ['high', 'medium']:
+        return {
+            "approved": True,
+            "confidence": confidence,
+            "extracted_amount": float(extracted_amount),
+            "reason": f"AI подтвердил: сумма {extracted_amount} соответствует заявленной {expected_amount}"
+        }
+    elif not amount_matches:
+        return {
+            "approved": False,
+            "confidence": confidence,
+            "extracted_amount": float(extracted_amount),
+            "reason": f"Сумма на чеке ({extracted_amount}) не совпадает с заявленной ({expected_amount})"
+        }
+    else:
+        return {
+            "approved": False,
+            "confidence": confidence,
+            "extracted_amount": float(extracted_amount),
+            "reason": "Низкая уверенность AI - требуется ручная проверка"
         }
 
 # Create the main app
@@ -331,6 +566,7 @@ app.add_middleware(
     allow_origin_regex=r"^https://ts-market0001-[a-z0-9-]+\.vercel\.app$",
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count", "Content-Disposition"],
 )
 # Add rate limiting middleware
 app.add_middleware(RateLimitMiddleware)
@@ -459,6 +695,11 @@ class Product(BaseModel):
     is_active: bool = True
     discount_percent: float = 0.0  # Admin sets discount on product
     tags: List[str] = []  # List of tag IDs
+    # Review aggregates, maintained by create_review
+    rating_count: int = 0
+    rating_sum: int = 0
+    rating_avg: float = 0.0
+    rating_histogram: Dict[str, int] = {}  # "1".."5" -> number of reviews
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class ProductCreate(BaseModel):
@@ -723,6 +964,7 @@ class Review(BaseModel):
     user_name: str
     rating: int = Field(..., ge=1, le=5)
     comment: str
+    sparkles: int = 0  # Maintained by sparkle_review
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 
@@ -872,6 +1114,621 @@ class UserSession(BaseModel):
 
 # ==================== HELPERS ====================
 
+class TTLCache:
+    """Small per-process cache with per-entry expiry (like rate_limit_store, not shared across workers)"""
+
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data: Dict[Any, tuple] = {}
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._data.pop(key, None)
+            return None
+        return entry[1]
+
+    def set(self, key, value):
+        if len(self._data) >= self.max_entries:
+            now = time.monotonic()
+            self._data = {k: v for k, v in self._data.items() if v[0] >= now}
+            if len(self._data) >= self.max_entries:
+                self._data.clear()
+        self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+class JobQueue:
+    """In-process background job queue.
+
+    Jobs are persisted in a MongoDB collection before they are queued, so pending work
+    survives restarts. A fixed number of workers bounds concurrency; failed jobs are
+    retried with exponential backoff and marked "failed" after max_attempts.
+    Each job is claimed atomically (pending -> running) with a lease that is renewed
+    while the handler runs; a periodic sweep puts jobs with an expired lease back to
+    pending, so work held by a crashed process is picked up by the survivors.
+    Handlers get the payload plus `job_id`, which stays the same across retries and
+    is the key for making their writes idempotent.
+    The sweep only schedules orphaned pending jobs: ones not already queued or waiting
+    on a retry timer in this process, and overdue long enough that no other process
+    is about to run them.
+    """
+
+    LEASE = timedelta(seconds=60)
+    SWEEP_INTERVAL = 30
+    SWEEP_PAGE_SIZE = 500
+    # A pending job this far past run_at is not being handled by the process that queued it
+    ORPHANED_AFTER = timedelta(seconds=SWEEP_INTERVAL)
+    # Jobs claimed before leases existed have no lease_expires_at
+    STALE_RUNNING_AFTER = timedelta(minutes=10)
+    # Failed jobs are kept this long for inspection, then a TTL index removes them
+    FAILED_RETENTION = timedelta(days=7)
+
+    def __init__(self, collection, concurrency: int = 4, max_attempts: int = 5, base_delay: float = 2.0):
+        self.collection = collection
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.handlers: Dict[str, Callable[[dict], Awaitable[Any]]] = {}
+        self.failure_handlers: Dict[str, Callable[[dict, str], Awaitable[Any]]] = {}
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.workers: List[asyncio.Task] = []
+        self.sweeper: Optional[asyncio.Task] = None
+        # job_id -> retry timer; `scheduled` holds every job_id queued or waiting on a timer here
+        self.retry_timers: Dict[str, asyncio.TimerHandle] = {}
+        self.scheduled: set = set()
+        self.accepting = False
+        self.worker_id = f"worker_{uuid.uuid4().hex[:8]}"
+
+    def handler(self, name: str):
+        """Register a coroutine `fn(payload: dict)` as the handler for job `name`"""
+        def decorator(fn):
+            self.handlers[name] = fn
+            return fn
+        return decorator
+
+    def on_failure(self, name: str):
+        """Register a coroutine `fn(payload: dict, error: str)` run once job `name` fails permanently"""
+        def decorator(fn):
+            self.failure_handlers[name] = fn
+            return fn
+        return decorator
+
+    async def enqueue(self, name: str, payload: dict, max_attempts: Optional[int] = None) -> str:
+        now = datetime.now(timezone.utc)
+        job = {
+            "job_id": f"job_{uuid.uuid4().hex[:12]}",
+            "name": name,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "max_attempts": max_attempts or self.max_attempts,
+            "last_error": None,
+            "run_at": now,
+            "created_at": now
+        }
+        await self.collection.insert_one(job)
+        # While stopped the job stays pending in MongoDB and is picked up on next start
+        if self.accepting:
+            self._schedule(job["job_id"], 0)
+        return job["job_id"]
+
+    async def create_indexes(self):
+        await self.collection.create_index("job_id", unique=True)
+        await self.collection.create_index([("status", 1), ("created_at", 1)])
+        await self.collection.create_index([("status", 1), ("run_at", 1)])
+        await self.collection.create_index(
+            "failed_at", expireAfterSeconds=int(self.FAILED_RETENTION.total_seconds())
+        )
+
+    async def start(self):
+        self.accepting = True
+        # Nothing is scheduled here yet: take every due pending job, not just overdue ones
+        recovered = await self.sweep(orphaned_after=timedelta(0))
+        if recovered:
+            logging.info(f"Recovered {recovered} pending background jobs")
+
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self.sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self, timeout: float = 10):
+        """Stop accepting jobs, let queued ones drain, then cancel the workers"""
+        self.accepting = False
+        if self.sweeper:
+            self.sweeper.cancel()
+            await asyncio.gather(self.sweeper, return_exceptions=True)
+            self.sweeper = None
+        for job_id, timer in self.retry_timers.items():
+            timer.cancel()
+            self.scheduled.discard(job_id)
+        self.retry_timers.clear()
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"{self.queue.qsize()} background jobs left pending on shutdown")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers.clear()
+
+    async def sweep(self, orphaned_after: Optional[timedelta] = None) -> int:
+        """Requeue running jobs whose lease expired and schedule orphaned pending jobs"""
+        now = datetime.now(timezone.utc)
+        # Jobs left "running" by a crashed or hung process go back to pending
+        await self.collection.update_many(
+            {"status": "running", "$or": [
+                {"lease_expires_at": {"$lt": now}},
+                {"lease_expires_at": {"$exists": False}, "started_at": {"$lt": now - self.STALE_RUNNING_AFTER}}
+            ]},
+            {"$set": {"status": "pending", "run_at": now}, "$unset": {"lease_expires_at": ""}}
+        )
+        # Jobs enqueued by processes that went away before running them, read in pages.
+        # Another process may still grab one first; only one claim can succeed.
+        overdue = now - (self.ORPHANED_AFTER if orphaned_after is None else orphaned_after)
+        cursor = self.collection.find(
+            {"status": "pending", "run_at": {"$lte": overdue}}, {"_id": 0, "job_id": 1}
+        ).sort("run_at", 1).batch_size(self.SWEEP_PAGE_SIZE)
+        picked = 0
+        async for job in cursor:
+            if job["job_id"] not in self.scheduled:
+                self._schedule(job["job_id"], 0)
+                picked += 1
+        return picked
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.SWEEP_INTERVAL)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logging.error(f"Background job sweep failed: {str(e)}")
+
+    def _schedule(self, job_id: str, delay: float):
+        if job_id in self.scheduled:
+            return
+        self.scheduled.add(job_id)
+        if delay <= 0:
+            self.queue.put_nowait(job_id)
+            return
+        loop = asyncio.get_running_loop()
+        self.retry_timers[job_id] = loop.call_later(delay, self._requeue, job_id)
+
+    def _requeue(self, job_id: str):
+        self.retry_timers.pop(job_id, None)
+        if self.accepting:
+            self.queue.put_nowait(job_id)
+        else:
+            self.scheduled.discard(job_id)
+
+    async def _worker(self):
+        while True:
+            job_id = await self.queue.get()
+            # Off the local schedule once taken: a retry schedules it again
+            self.scheduled.discard(job_id)
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                logging.error(f"Background job {job_id} crashed the worker loop: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    async def _heartbeat(self, job_id: str):
+        """Keep extending the lease while the handler is still running"""
+        while True:
+            await asyncio.sleep(self.LEASE.total_seconds() / 3)
+            try:
+                await self.collection.update_one(
+                    {"job_id": job_id, "status": "running", "worker": self.worker_id},
+                    {"$set": {"lease_expires_at": datetime.now(timezone.utc) + self.LEASE}}
+                )
+            except Exception as e:
+                logging.warning(f"Could not renew lease for background job {job_id}: {str(e)}")
+
+    async def _run(self, job_id: str):
+        now = datetime.now(timezone.utc)
+        job = await self.collection.find_one_and_update(
+            {"job_id": job_id, "status": "pending"},
+            {
+                "$set": {
+                    "status": "running",
+                    "worker": self.worker_id,
+                    "started_at": now,
+                    "lease_expires_at": now + self.LEASE
+                },
+                "$inc": {"attempts": 1}
+            },
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if not job:
+            return  # Claimed by another worker or already done
+
+        handler = self.handlers.get(job["name"])
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            if not handler:
+                raise RuntimeError(f"No handler registered for job '{job['name']}'")
+            await handler({**job["payload"], "job_id": job_id})
+        except Exception as e:
+            attempts = job["attempts"]
+            if attempts >= job.get("max_attempts", self.max_attempts) or not handler:
+                logging.error(f"Background job {job['name']} ({job_id}) failed permanently: {str(e)}")
+                await self.collection.update_one(
+                    {"job_id": job_id},
+                    {
+                        "$set": {"status": "failed", "last_error": str(e)[:500], "failed_at": datetime.now(timezone.utc)},
+                        "$unset": {"lease_expires_at": ""}
+                    }
+                )
+                on_failure = self.failure_handlers.get(job["name"])
+                if on_failure:
+                    try:
+                        await on_failure({**job["payload"], "job_id": job_id}, str(e))
+                    except Exception as hook_error:
+                        logging.error(f"Failure hook of background job {job['name']} ({job_id}) failed: {str(hook_error)}")
+                return
+            delay = self.base_delay * (2 ** (attempts - 1)) + random.uniform(0, 1)
+            logging.warning(f"Background job {job['name']} ({job_id}) failed, retrying in {delay:.1f}s: {str(e)}")
+            await self.collection.update_one(
+                {"job_id": job_id},
+                {
+                    "$set": {
+                        "status": "pending",
+                        "last_error": str(e)[:500],
+                        "run_at": datetime.now(timezone.utc) + timedelta(seconds=delay)
+                    },
+                    "$unset": {"lease_expires_at": ""}
+                }
+            )
+            self._schedule(job_id, delay)
+            return
+        finally:
+            heartbeat.cancel()
+
+        await self.collection.delete_one({"job_id": job_id})
+
+job_queue = JobQueue(db.jobs, concurrency=int(os.environ.get("JOB_QUEUE_CONCURRENCY", 4)))
+# Receipt analysis gets its own workers: slow LLM calls must not starve other jobs,
+# and the worker count is the cap on concurrent model requests
+receipt_queue = JobQueue(db.receipt_jobs, concurrency=AI_RECEIPT_CONCURRENCY, max_attempts=3)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open"""
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures; after `reset_timeout`
+    seconds a single trial request is let through (half-open)"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """A call ended without a verdict (other error, cancellation): let the next trial through"""
+        self.trial_in_flight = False
+
+class Upstream:
+    """One outbound service: a pooled AsyncClient plus its timeouts, retries and breaker.
+    With `per_host` every host gets its own breaker configured like `breaker`, so one
+    dead host doesn't cut off the others."""
+
+    RETRY_METHODS = ("GET", "HEAD")
+    MAX_HOST_BREAKERS = 1000
+
+    def __init__(self, name: str, timeout: httpx.Timeout, limits: httpx.Limits,
+                 retries: int = 0, breaker: Optional[CircuitBreaker] = None, base_url: str = "",
+                 per_host: bool = False):
+        self.name = name
+        self.timeout = timeout
+        self.limits = limits
+        self.retries = retries
+        self.breaker = breaker or CircuitBreaker()
+        self.per_host = per_host
+        self.host_breakers: Dict[str, CircuitBreaker] = {}
+        self.base_url = base_url
+        self.client: Optional[httpx.AsyncClient] = None
+
+    def breaker_for(self, url: str) -> CircuitBreaker:
+        if not self.per_host:
+            return self.breaker
+        host = httpx.URL(url).host
+        breaker = self.host_breakers.get(host)
+        if breaker is None:
+            if len(self.host_breakers) >= self.MAX_HOST_BREAKERS:
+                # Forget healthy hosts first; only tripped breakers carry state worth keeping
+                self.host_breakers = {h: b for h, b in self.host_breakers.items() if b.state != "closed"}
+            breaker = CircuitBreaker(self.breaker.failure_threshold, self.breaker.reset_timeout)
+            self.host_breakers[host] = breaker
+        return breaker
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        if self.client is None:
+            raise RuntimeError(f"HTTP client for '{self.name}' is not started")
+        attempts = 1 + (self.retries if method.upper() in self.RETRY_METHODS else 0)
+        breaker = self.breaker_for(url)
+        for attempt in range(attempts):
+            if not breaker.allow():
+                raise CircuitOpenError(f"Upstream '{self.name}' is unavailable")
+            try:
+                resp = await self.client.request(method, url, **kwargs)
+            except httpx.TransportError:
+                breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    raise
+            except BaseException:
+                breaker.release()
+                raise
+            else:
+                if resp.status_code < 500:
+                    breaker.record_success()
+                    return resp
+                breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    return resp
+            await asyncio.sleep(0.2 * (2 ** attempt) + random.uniform(0, 0.1))
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+class HttpPool:
+    """Application-lifetime HTTP clients, one connection pool per upstream"""
+
+    def __init__(self, upstreams: List[Upstream]):
+        self.upstreams = {u.name: u for u in upstreams}
+
+    def __getitem__(self, name: str) -> Upstream:
+        return self.upstreams[name]
+
+    async def start(self):
+        for u in self.upstreams.values():
+            u.client = httpx.AsyncClient(base_url=u.base_url, timeout=u.timeout, limits=u.limits)
+
+    async def close(self):
+        clients = [u.client for u in self.upstreams.values() if u.client is not None]
+        for u in self.upstreams.values():
+            u.client = None
+        await asyncio.gather(*(c.aclose() for c in clients), return_exceptions=True)
+
+http_pool = HttpPool([
+    # Emergent OAuth session exchange: small JSON, must answer fast or fail
+    Upstream(
+        "emergent_auth",
+        base_url="https://demobackend.emergentagent.com",
+        timeout=httpx.Timeout(5.0, connect=3.0),
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        retries=1,
+        breaker=CircuitBreaker(failure_threshold=5, reset_timeout=30)
+    ),
+    # Remote receipt images fetched by the receipt stage
+    Upstream(
+        "receipt_images",
+        timeout=httpx.Timeout(15.0, connect=3.0),
+        limits=httpx.Limits(max_connections=AI_RECEIPT_CONCURRENCY * 2, max_keepalive_connections=AI_RECEIPT_CONCURRENCY),
+        retries=2,
+        breaker=CircuitBreaker(failure_threshold=5, reset_timeout=60),
+        per_host=True
+    ),
+])
+
+# SDK clients with their own connection pools, created and closed with http_pool
+ai_clients: Dict[str, Any] = {}
+
+class Subscription:
+    """One client's bounded event queue. A client that falls behind loses its oldest
+    events instead of growing memory; `dropped` tells the stream to ask for a resync."""
+
+    def __init__(self, topic: str, maxsize: int):
+        self.topic = topic
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, event):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout: float):
+        """Next event, or None after `timeout` seconds without one"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+class EventHub:
+    """In-process pub/sub fanning events out to streaming clients.
+
+    With a relay collection (a capped MongoDB collection) publishers write there and every
+    worker tails it, so subscribers on all workers see every event; without one, events
+    only reach subscribers of the publishing process.
+    """
+
+    CLOSED = object()
+
+    def __init__(self, queue_size: int = 100, relay=None):
+        self.queue_size = queue_size
+        self.relay = relay
+        self._subscribers: Dict[str, set] = defaultdict(set)
+
+    def subscribe(self, topic: str) -> Subscription:
+        subscription = Subscription(topic, self.queue_size)
+        self._subscribers[topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._subscribers.get(subscription.topic)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.topic]
+
+    def deliver(self, topic: str, event: dict):
+        for subscription in list(self._subscribers.get(topic, ())):
+            subscription.put(event)
+
+    async def publish(self, topic: str, event: dict):
+        if self.relay is None:
+            self.deliver(topic, event)
+            return
+        try:
+            await self.relay.insert_one({"topic": topic, "event": event, "created_at": datetime.now(timezone.utc)})
+        except Exception as e:
+            logging.error(f"Event relay write failed, delivering locally: {str(e)}")
+            self.deliver(topic, event)
+
+    async def tail_relay(self):
+        """Deliver relay documents inserted after startup (runs as a background task)"""
+        try:
+            await db.create_collection(self.relay.name, capped=True, size=EVENT_RELAY_SIZE)
+        except CollectionInvalid:
+            pass
+        latest = await self.relay.find_one({}, {"_id": 1}, sort=[("$natural", -1)])
+        last_id = latest["_id"] if latest else None
+        while True:
+            query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+            cursor = self.relay.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+            try:
+                async for doc in cursor:
+                    last_id = doc["_id"]
+                    self.deliver(doc["topic"], doc["event"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Event relay tail failed: {str(e)}")
+            # Tailable cursors die on an empty collection; wait for the first insert
+            await asyncio.sleep(1)
+
+    def close(self):
+        """End every open stream (on shutdown)"""
+        for subscribers in self._subscribers.values():
+            for subscription in subscribers:
+                subscription.put(self.CLOSED)
+
+class BatchWriter:
+    """Buffers documents and writes them with insert_many, every `interval` seconds or as
+    soon as `max_batch` documents are waiting. Documents still buffered when the process
+    dies are lost, so it is only for data that tolerates that (e.g. the activity feed)."""
+
+    def __init__(self, collection, interval: float = 1.0, max_batch: int = 200):
+        self.collection = collection
+        self.interval = interval
+        self.max_batch = max_batch
+        self._buffer: List[dict] = []
+        self._wakeup = asyncio.Event()
+
+    def add(self, doc: dict):
+        # Copy: insert_many adds _id to the documents it is given
+        self._buffer.append(dict(doc))
+        if len(self._buffer) >= self.max_batch:
+            self._wakeup.set()
+
+    async def flush(self):
+        batch, self._buffer = self._buffer, []
+        if not batch:
+            return
+        try:
+            await self.collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Per-document failures (the rest of the batch was written); retrying won't help
+            logging.error(f"Batched insert into {self.collection.name}: {len(e.details.get('writeErrors', []))} documents rejected")
+        except Exception as e:
+            logging.error(f"Batched insert into {self.collection.name} failed: {str(e)}")
+            # Retry with the next flush unless the backlog is getting out of hand. The documents
+            # keep their _id, so any that did reach the server fail as duplicates instead of doubling.
+            if len(self._buffer) < self.max_batch * 10:
+                self._buffer = batch + self._buffer
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+# "mongo" relays events through a capped collection so multi-worker deployments see them all
+EVENT_RELAY = os.environ.get("EVENT_RELAY", "")
+EVENT_RELAY_SIZE = int(os.environ.get("EVENT_RELAY_SIZE", 16 * 1024 * 1024))
+SSE_HEARTBEAT_INTERVAL = 15
+ACTIVITY_TOPIC = "activity"
+
+event_hub = EventHub(queue_size=100, relay=db.event_relay if EVENT_RELAY == "mongo" else None)
+
+def user_topic(user_id: str) -> str:
+    return f"user:{user_id}"
+
+async def notify_user(user_id: str, event_type: str, **data):
+    """Push a status change to the user's own event stream (/api/events/stream)"""
+    await event_hub.publish(user_topic(user_id), {"type": event_type, **data, "created_at": datetime.now(timezone.utc)})
+
+def sse_message(data, event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(jsonable_encoder(data))}\n\n"
+
+def event_stream(request: Request, subscription: Subscription) -> StreamingResponse:
+    """Server-sent events response for a subscription, with periodic heartbeats"""
+    async def messages():
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                event = await subscription.get(SSE_HEARTBEAT_INTERVAL)
+                if event is EventHub.CLOSED:
+                    return
+                if subscription.dropped:
+                    # The client missed events; it should refetch the current state
+                    subscription.dropped = 0
+                    yield sse_message({}, event="resync")
+                if event is None:
+                    yield ": heartbeat\n\n"
+                else:
+                    yield sse_message(event)
+        finally:
+            event_hub.unsubscribe(subscription)
+    return StreamingResponse(
+        messages(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
 
@@ -885,16 +1742,20 @@ def create_jwt_token(user_id: str) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+def level_threshold(level: int) -> int:
+    """Total XP at which calculate_level starts returning `level`.
+    Level 2 needs 100 XP, every next level needs 100 + level*50 more."""
+    if level <= 1:
+        return 0
+    return 25 * level * level + 75 * level - 150
+
 def calculate_level(xp: int) -> int:
-    """Calculate level from XP. Formula: each level needs base 100 + level*50 XP"""
-    level = 1
-    xp_needed = 100
-    total_xp_for_level = 0
-    while xp >= total_xp_for_level + xp_needed:
-        total_xp_for_level += xp_needed
-        level += 1
-        xp_needed = 100 + level * 50
-    return level
+    """Calculate level from XP in O(1): largest level with level_threshold(level) <= xp.
+    Solves 25L^2 + 75L - 150 <= xp with an exact integer square root."""
+    xp = int(xp)
+    if xp < 100:
+        return 1
+    return (math.isqrt(100 * xp + 20625) - 75) // 50
 
 def xp_for_next_level(current_level: int) -> int:
     """XP needed to reach next level"""
@@ -902,10 +1763,24 @@ def xp_for_next_level(current_level: int) -> int:
 
 def total_xp_for_level(level: int) -> int:
     """Total XP accumulated to reach a level"""
-    total = 0
-    for l in range(1, level):
-        total += 100 + l * 50
-    return total
+    if level <= 1:
+        return 0
+    return (level - 1) * (25 * level + 100)
+
+# Precomputed thresholds for batch recomputes; index i holds level_threshold(i + 1)
+LEVEL_TABLE_SIZE = 10000
+LEVEL_XP_THRESHOLDS = np.array([level_threshold(l) for l in range(1, LEVEL_TABLE_SIZE + 1)], dtype=np.int64)
+
+def calculate_levels_batch(xp_values) -> np.ndarray:
+    """Vectorized calculate_level for a whole batch of users"""
+    xp = np.floor(np.asarray(xp_values, dtype=np.float64)).astype(np.int64)
+    levels = np.searchsorted(LEVEL_XP_THRESHOLDS, xp, side="right")
+    levels = np.maximum(levels, 1)
+    # Beyond the table fall back to the closed form
+    overflow = levels >= LEVEL_TABLE_SIZE
+    if overflow.any():
+        levels[overflow] = [calculate_level(v) for v in xp[overflow]]
+    return levels
 
 
 async def log_activity(user_id: str, user_name: str, activity_type: str, description: str):
@@ -916,40 +1791,243 @@ async def log_activity(user_id: str, user_name: str, activity_type: str, descrip
         description=description
     )
     activity_dict = activity.model_dump()
-    activity_dict["created_at"] = activity_dict["created_at"].isoformat()
-    await db.activity_feed.insert_one(activity_dict)
+    activity_writer.add(activity_dict)
+    await event_hub.publish(ACTIVITY_TOPIC, activity_dict)
+
+SEASON_PERIODS = ("weekly", "monthly")
+
+def season_key(period: str, moment: datetime) -> str:
+    """Season identifier for a moment: ISO week ("2026-W03") or month ("2026-01")"""
+    if period == "weekly":
+        year, week, _ = moment.isocalendar()
+        return f"{year}-W{week:02d}"
+    return f"{moment.year}-{moment.month:02d}"
+
+# Exactly the keys season_key produces
+SEASON_KEY_PATTERNS = {
+    "weekly": re.compile(r"^\d{4}-W(0[1-9]|[1-4]\d|5[0-3])$"),
+    "monthly": re.compile(r"^\d{4}-(0[1-9]|1[0-2])$"),
+}
+
+def previous_season_key(period: str, moment: datetime) -> str:
+    if period == "weekly":
+        return season_key(period, moment - timedelta(days=7))
+    return season_key(period, moment.replace(day=1) - timedelta(days=1))
+
+# Recent job ids remembered on a document to skip writes a retried job already applied
+APPLIED_JOBS_KEPT = 20
+
+def only_duplicate_keys(error: BulkWriteError) -> bool:
+    """True if every write error is a duplicate key, i.e. an upsert whose
+    "not yet applied" filter missed a document that already has the change"""
+    errors = error.details.get("writeErrors", [])
+    return bool(errors) and all(e.get("code") == 11000 for e in errors)
+
+async def record_xp_event(user: dict, xp: int, source: str, event_id: Optional[str] = None):
+    """Append an XP grant to the event log and bump the weekly/monthly rollups.
+    `user` holds user_id, name, picture, is_admin and role. Calls with the same
+    `event_id` (the job id of a retried job) are applied once."""
+    if xp <= 0:
+        return
+    now = datetime.now(timezone.utc)
+    event_id = event_id or f"xpe_{uuid.uuid4().hex[:12]}"
+    event = {
+        "event_id": event_id,
+        "user_id": user["user_id"],
+        "xp": xp,
+        "source": source,
+        "created_at": now
+    }
 
-async def check_achievements(user_id: str):
-    user_data = await db.users.find_one({"user_id": user_id})
-    if not user_data or user_data.get("level", 1) < 5:
-        return []
-    
-    current_achievements = user_data.get("achievements", [])
-    new_achievements = []
-    
-    # 1. Первопроходец (Pioneer) - Always for level 5+
-    if "pioneer" not in current_achievements:
-        new_achievements.append("pioneer")
-    
-    # 2. Мастер уровней (Level Master) - Level 10+
-    if user_data.get("level", 1) >= 10 and "level_master" not in current_achievements:
-        new_achievements.append("level_master")
-        
-    # 3. Богач (Rich) - Balance > 1000
-    if user_data.get("balance", 0) >= 1000 and "rich" not in current_achievements:
-        new_achievements.append("rich")
-        
-    if new_achievements:
-        await db.users.update_one(
-            {"user_id": user_id},
-            {"$push": {"achievements": {"$each": new_achievements}}}
-        )
-        for ach in new_achievements:
-            ach_names = {"pioneer": "Первопроходец", "level_master": "Мастер уровней", "rich": "Богач"}
-            await log_activity(user_id, user_data["name"], "achievement", f"получил достижение: {ach_names.get(ach, ach)}")
-            
-    return new_achievements
-async def get_current_user(request: Request) -> Optional[User]:
+    async def insert_event():
+        try:
+            await db.xp_events.insert_one(event)
+        except DuplicateKeyError:
+            pass  # Recorded by an earlier attempt
+
+    async def bump_rollups():
+        try:
+            await db.xp_rollups.bulk_write([
+                UpdateOne(
+                    {
+                        "period": period,
+                        "season": season_key(period, now),
+                        "user_id": user["user_id"],
+                        "applied_events": {"$ne": event_id}
+                    },
+                    {
+                        "$inc": {"xp": xp},
+                        "$set": {"name": user.get("name"), "picture": user.get("picture")},
+                        "$push": {"applied_events": {"$each": [event_id], "$slice": -APPLIED_JOBS_KEPT}}
+                    },
+                    upsert=True
+                )
+                for period in SEASON_PERIODS
+            ], ordered=False)
+        except BulkWriteError as e:
+            if not only_duplicate_keys(e):
+                raise
+
+    writes = [insert_event()]
+    # Admins are not ranked, so they only get the raw event
+    if not user.get("is_admin") and user.get("role") != "admin":
+        writes.append(bump_rollups())
+    await asyncio.gather(*writes)
+
+# ==================== GAMIFICATION ENGINE ====================
+
+ACHIEVEMENT_NAMES = {"pioneer": "Первопроходец", "level_master": "Мастер уровней", "rich": "Богач"}
+XP_MULTIPLIER_DAYS = 30
+
+def level_expr(xp_expr) -> dict:
+    """Aggregation expression equivalent to calculate_level"""
+    d = {"$add": [{"$multiply": [{"$max": [{"$floor": xp_expr}, 0]}, 100]}, 20625]}
+    return {"$max": [1, {"$floor": {"$divide": [{"$subtract": [{"$sqrt": d}, 75]}, 50]}}]}
+
+def as_date_expr(field: str) -> dict:
+    """Read a date field that may still hold a legacy ISO string"""
+    return {"$cond": [
+        {"$eq": [{"$type": field}, "string"]},
+        {"$dateFromString": {"dateString": {"$substrCP": [field, 0, 19]}, "timezone": "UTC", "onError": None}},
+        field
+    ]}
+
+def build_xp_grant_pipeline(
+    xp: int,
+    apply_multiplier: bool = True,
+    inc: Optional[Dict[str, float]] = None,
+    set_fields: Optional[Dict[str, Any]] = None,
+    push: Optional[Dict[str, Any]] = None
+) -> List[dict]:
+    """Update pipeline that grants XP and applies multiplier, level, wheel spins,
+    multiplier expiry and achievements in one atomic write.
+    `inc`/`set_fields`/`push` are applied first, so they can be combined with the grant
+    (e.g. charging the order total or consuming a wheel spin)."""
+    changes: Dict[str, Any] = {}
+    for field, value in (inc or {}).items():
+        changes[field] = {"$add": [{"$ifNull": [f"${field}", 0]}, value]}
+    for field, value in (set_fields or {}).items():
+        changes[field] = {"$literal": value}
+    for field, value in (push or {}).items():
+        changes[field] = {"$concatArrays": [{"$ifNull": [f"${field}", []]}, [{"$literal": value}]]}
+
+    multiplier = 1
+    if apply_multiplier:
+        multiplier = {"$cond": [{"$gt": [as_date_expr("$xp_multiplier_expires_at"), "$$NOW"]}, 2, 1]}
+    changes["_grant_xp"] = {"$multiply": [xp, multiplier]}
+
+    level_up = {"$gt": ["$_new_level", "$_old_level"]}
+    achievement_candidates = [
+        {"$cond": [{"$gte": ["$_new_level", 5]}, "pioneer", None]},
+        {"$cond": [{"$gte": ["$_new_level", 10]}, "level_master", None]},
+        {"$cond": [{"$and": [
+            {"$gte": ["$_new_level", 5]},
+            {"$gte": [{"$ifNull": ["$balance", 0]}, 1000]}
+        ]}, "rich", None]},
+    ]
+
+    return [
+        {"$set": changes},
+        {"$set": {
+            "_new_xp": {"$add": [{"$ifNull": ["$xp", 0]}, "$_grant_xp"]},
+            "_old_level": {"$ifNull": ["$level", 1]}
+        }},
+        {"$set": {"_new_level": {"$max": ["$_old_level", level_expr("$_new_xp")]}}},
+        {"$set": {"_new_achievements": {"$filter": {
+            "input": achievement_candidates,
+            "as": "a",
+            "cond": {"$and": [
+                {"$ne": ["$$a", None]},
+                {"$not": [{"$in": ["$$a", {"$ifNull": ["$achievements", []]}]}]}
+            ]}
+        }}}},
+        {"$set": {
+            "xp": "$_new_xp",
+            "level": "$_new_level",
+            # One wheel spin per level gained
+            "wheel_spins_available": {"$add": [
+                {"$ifNull": ["$wheel_spins_available", 0]},
+                {"$subtract": ["$_new_level", "$_old_level"]}
+            ]},
+            # Leveling up sets/extends the x2 XP multiplier
+            "xp_multiplier_expires_at": {"$cond": [
+                level_up,
+                {"$add": ["$$NOW", XP_MULTIPLIER_DAYS * 24 * 3600 * 1000]},
+                "$xp_multiplier_expires_at"
+            ]},
+            "achievements": {"$concatArrays": [{"$ifNull": ["$achievements", []]}, "$_new_achievements"]},
+            "last_xp_grant": {
+                "xp": "$_grant_xp",
+                "level_before": "$_old_level",
+                "new_achievements": "$_new_achievements",
+                "at": "$$NOW"
+            }
+        }},
+        {"$unset": ["_grant_xp", "_new_xp", "_old_level", "_new_level", "_new_achievements"]}
+    ]
+
+async def grant_xp(
+    user: User,
+    xp: int,
+    source: str,
+    apply_multiplier: bool = True,
+    inc: Optional[Dict[str, float]] = None,
+    set_fields: Optional[Dict[str, Any]] = None,
+    push: Optional[Dict[str, Any]] = None,
+    filter_extra: Optional[Dict[str, Any]] = None
+) -> Optional[dict]:
+    """Single entry point for every XP grant: one round trip updates XP, level, spins,
+    multiplier and achievements. `filter_extra` guards the update (e.g. enough balance);
+    returns None when the guard did not match."""
+    updated = await db.users.find_one_and_update(
+        {"user_id": user.user_id, **(filter_extra or {})},
+        build_xp_grant_pipeline(xp, apply_multiplier, inc, set_fields, push),
+        projection={"_id": 0, "password_hash": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not updated:
+        return None
+
+    grant = updated.get("last_xp_grant", {})
+    xp_gained = int(grant.get("xp", 0))
+    old_level = grant.get("level_before", updated.get("level", 1))
+    new_level = updated.get("level", 1)
+    new_achievements = grant.get("new_achievements", [])
+
+    # Event log, seasonal rollups and activity feed are not needed for the response.
+    # The grant is already written, so failing to queue them must not fail the caller.
+    if xp_gained > 0 or new_level > old_level or new_achievements:
+        try:
+            await job_queue.enqueue("xp_grant_effects", {
+                "user": user.model_dump(include={"user_id", "name", "picture", "is_admin", "role"}),
+                "xp": xp_gained,
+                "source": source,
+                "old_level": old_level,
+                "new_level": new_level,
+                "new_achievements": new_achievements
+            })
+        except Exception as e:
+            logging.error(f"Could not queue XP grant effects for {user.user_id}: {str(e)}")
+
+    return {
+        "user": updated,
+        "xp_gained": xp_gained,
+        "old_level": old_level,
+        "new_level": new_level,
+        "level_up": new_level > old_level,
+        "new_achievements": new_achievements
+    }
+
+@job_queue.handler("xp_grant_effects")
+async def run_xp_grant_effects(payload: dict):
+    user = payload["user"]
+    await record_xp_event(user, payload["xp"], payload["source"], event_id=payload["job_id"])
+    if payload["new_level"] > payload["old_level"]:
+        await log_activity(user["user_id"], user["name"], "level_up", f"достиг {payload['new_level']} уровня!")
+    for ach in payload["new_achievements"]:
+        await log_activity(user["user_id"], user["name"], "achievement", f"получил достижение: {ACHIEVEMENT_NAMES.get(ach, ach)}")
+
+def request_session_token(request: Request) -> Optional[str]:
     # Try cookie first
     session_token = request.cookies.get("session_token")
     
@@ -958,7 +2036,9 @@ async def get_current_user(request: Request) -> Optional[User]:
         auth_header = request.headers.get("Authorization")
         if auth_header and auth_header.startswith("Bearer "):
             session_token = auth_header.split(" ")[1]
-    
+    return session_token
+
+async def user_for_session(session_token: Optional[str]) -> Optional[User]:
     if not session_token:
         return None
     
@@ -968,12 +2048,7 @@ async def get_current_user(request: Request) -> Optional[User]:
         return None
     
     # Check expiry
-    expires_at = session.get("expires_at")
-    if isinstance(expires_at, str):
-        expires_at = datetime.fromisoformat(expires_at)
-    if expires_at.tzinfo is None:
-        expires_at = expires_at.replace(tzinfo=timezone.utc)
-    if expires_at < datetime.now(timezone.utc):
+    if as_utc(session.get("expires_at")) < datetime.now(timezone.utc):
         return None
     
     user = await db.users.find_one({"user_id": session["user_id"]}, {"_id": 0})
@@ -982,6 +2057,9 @@ async def get_current_user(request: Request) -> Optional[User]:
     
     return User(**user)
 
+async def get_current_user(request: Request) -> Optional[User]:
+    return await user_for_session(request_session_token(request))
+
 async def require_user(request: Request) -> User:
     user = await get_current_user(request)
     if not user:
@@ -1015,6 +2093,11 @@ async def require_staff(request: Request) -> User:
         raise HTTPException(status_code=403, detail="Staff access required")
     return user
 
+def user_search_fields(doc: dict) -> dict:
+    """Lowercased email/name stored next to the originals, so the admin user search can
+    run a case-sensitive anchored prefix match that stays on the index"""
+    return {f"{key}_lower": doc[key].lower() for key in ("email", "name") if isinstance(doc.get(key), str)}
+
 # ==================== AUTH ENDPOINTS ====================
 
 @api_router.post("/auth/register")
@@ -1036,22 +2119,32 @@ async def register(data: UserCreate, response: Response):
         "password_hash": hash_password(data.password),
         "verification_code": verification_code,
         "promo_code": data.promo_code,
-        "expires_at": (datetime.now(timezone.utc) + timedelta(minutes=10)).isoformat(),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "expires_at": datetime.now(timezone.utc) + timedelta(minutes=10),
+        "created_at": datetime.now(timezone.utc)
     }
     
     await db.pending_registrations.insert_one(pending_data)
     
-    # Send email
-    email_sent = await send_verification_email(data.email, verification_code)
-    
-    if not email_sent:
-        # If email sending fails, we might still want to proceed for demo purposes 
-        # or show an error. Let's return success but mention email status in logs.
-        logging.warning(f"Verification email could not be sent to {data.email}")
+    # Send email in the background, the user doesn't wait for SMTP
+    # The code stays in pending_registrations only, not in the job payload
+    await job_queue.enqueue("send_verification_email", {"email": data.email})
     
     return {"message": "Код подтверждения отправлен на вашу почту", "email": data.email}
 
+@job_queue.handler("send_verification_email")
+async def run_send_verification_email(payload: dict):
+    pending = await db.pending_registrations.find_one(
+        {"email": payload["email"]}, {"_id": 0, "verification_code": 1}
+    )
+    if not pending:
+        return  # Already verified or expired
+    email_sent = await send_verification_email(payload["email"], pending["verification_code"])
+    if not email_sent:
+        if SMTP_USER and SMTP_PASSWORD:
+            # Let the job queue retry with backoff
+            raise RuntimeError(f"Verification email could not be sent to {payload['email']}")
+        logging.warning(f"Verification email could not be sent to {payload['email']}")
+
 @api_router.post("/auth/verify")
 async def verify_code(data: VerifyCode, response: Response):
     pending = await db.pending_registrations.find_one({
@@ -1062,9 +2155,8 @@ async def verify_code(data: VerifyCode, response: Response):
     if not pending:
         raise HTTPException(status_code=400, detail="Неверный код или email")
     
-    # Check expiration
-    expires_at = datetime.fromisoformat(pending["expires_at"])
-    if datetime.now(timezone.utc) > expires_at:
+    # Check expiration (TTL removes expired documents, but only about once a minute)
+    if datetime.now(timezone.utc) > as_utc(pending["expires_at"]):
         await db.pending_registrations.delete_one({"_id": pending["_id"]})
         raise HTTPException(status_code=400, detail="Код истек. Пожалуйста, зарегистрируйтесь снова.")
     
@@ -1084,11 +2176,12 @@ async def verify_code(data: VerifyCode, response: Response):
         "wheel_spins_available": 1,
         "claimed_rewards": [],
         "referred_by": pending.get("promo_code"),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     
-    await db.users.insert_one(user_data)
+    await db.users.insert_one({**user_data, **user_search_fields(user_data)})
     await db.pending_registrations.delete_one({"_id": pending["_id"]})
+    await bump_store_stats(users_count=1)
     
     # Create session
     session_token = secrets.token_hex(32)
@@ -1096,8 +2189,8 @@ async def verify_code(data: VerifyCode, response: Response):
         "session_id": f"sess_{uuid.uuid4().hex[:12]}",
         "user_id": user_id,
         "session_token": session_token,
-        "expires_at": (datetime.now(timezone.utc) + timedelta(days=7)).isoformat(),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
+        "created_at": datetime.now(timezone.utc)
     }
     await db.user_sessions.insert_one(session_data)
     
@@ -1130,8 +2223,8 @@ async def login(data: UserLogin, response: Response):
         "session_id": f"sess_{uuid.uuid4().hex[:12]}",
         "user_id": user["user_id"],
         "session_token": session_token,
-        "expires_at": (datetime.now(timezone.utc) + timedelta(days=7)).isoformat(),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
+        "created_at": datetime.now(timezone.utc)
     }
     await db.user_sessions.insert_one(session_data)
     
@@ -1158,15 +2251,19 @@ async def process_google_session(request: Request, response: Response):
         raise HTTPException(status_code=400, detail="session_id required")
     
     # Fetch user data from Emergent Auth
-    async with httpx.AsyncClient() as client_http:
-        resp = await client_http.get(
-            "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
+    try:
+        resp = await http_pool["emergent_auth"].get(
+            "/auth/v1/env/oauth/session-data",
             headers={"X-Session-ID": session_id}
         )
-        if resp.status_code != 200:
-            raise HTTPException(status_code=401, detail="Invalid session")
-        
-        oauth_data = resp.json()
+    except (CircuitOpenError, httpx.HTTPError):
+        raise HTTPException(status_code=503, detail="Сервис авторизации временно недоступен")
+    if resp.status_code >= 500:
+        raise HTTPException(status_code=503, detail="Сервис авторизации временно недоступен")
+    if resp.status_code != 200:
+        raise HTTPException(status_code=401, detail="Invalid session")
+    
+    oauth_data = resp.json()
     
     # Check if user exists
     existing = await db.users.find_one({"email": oauth_data["email"]}, {"_id": 0})
@@ -1174,12 +2271,13 @@ async def process_google_session(request: Request, response: Response):
     if existing:
         user_id = existing["user_id"]
         # Update user data
+        profile = {
+            "name": oauth_data.get("name", existing.get("name")),
+            "picture": oauth_data.get("picture", existing.get("picture"))
+        }
         await db.users.update_one(
             {"user_id": user_id},
-            {"$set": {
-                "name": oauth_data.get("name", existing.get("name")),
-                "picture": oauth_data.get("picture", existing.get("picture"))
-            }}
+            {"$set": {**profile, **user_search_fields(profile)}}
         )
     else:
         # Create new user
@@ -1195,9 +2293,10 @@ async def process_google_session(request: Request, response: Response):
             "is_admin": False,
             "wheel_spins_available": 1,
             "claimed_rewards": [],
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc)
         }
-        await db.users.insert_one(user_data)
+        await db.users.insert_one({**user_data, **user_search_fields(user_data)})
+        await bump_store_stats(users_count=1)
     
     # Create session
     session_token = oauth_data.get("session_token", secrets.token_hex(32))
@@ -1205,8 +2304,8 @@ async def process_google_session(request: Request, response: Response):
         "session_id": f"sess_{uuid.uuid4().hex[:12]}",
         "user_id": user_id,
         "session_token": session_token,
-        "expires_at": (datetime.now(timezone.utc) + timedelta(days=7)).isoformat(),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
+        "created_at": datetime.now(timezone.utc)
     }
     await db.user_sessions.insert_one(session_data)
     
@@ -1225,9 +2324,23 @@ async def process_google_session(request: Request, response: Response):
 
 # ==================== REVIEWS ====================
 
+def rating_aggregate_update(rating: int) -> list:
+    """Update pipeline adding one review to a product's rating count/sum/histogram.
+    A pipeline lets rating_avg be recomputed from the new totals in the same atomic write."""
+    def bumped(field, by):
+        return {"$add": [{"$ifNull": [f"${field}", 0]}, by]}
+    return [
+        {"$set": {
+            "rating_count": bumped("rating_count", 1),
+            "rating_sum": bumped("rating_sum", rating),
+            f"rating_histogram.{rating}": bumped(f"rating_histogram.{rating}", 1),
+        }},
+        {"$set": {"rating_avg": {"$round": [{"$divide": ["$rating_sum", "$rating_count"]}, 2]}}},
+    ]
+
 @api_router.post("/reviews", response_model=Review)
 async def create_review(review_data: ReviewCreate, user: User = Depends(get_current_user)):
-    product = await db.products.find_one({"product_id": review_data.product_id})
+    product = await db.products.find_one({"product_id": review_data.product_id}, {"_id": 1})
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
 
@@ -1238,15 +2351,108 @@ async def create_review(review_data: ReviewCreate, user: User = Depends(get_curr
     )
 
     await db.reviews.insert_one(review.model_dump(by_alias=True))
+    await db.products.update_one(
+        {"product_id": review.product_id},
+        rating_aggregate_update(review.rating)
+    )
+    review_pages_cache.invalidate(review.product_id)
     
     # Update mission progress
-    await update_mission_progress(user.user_id, "review", 1)
+    await job_queue.enqueue("mission_progress", {
+        "user_id": user.user_id,
+        "progress": {"review": 1},
+        "user_level": user.level
+    })
     
     return review
 
-@api_router.get("/reviews/{product_id}", response_model=List[Review])
-async def get_reviews_for_product(product_id: str):
-    reviews = await db.reviews.find({"product_id": product_id}).sort("created_at", -1).to_list(100)
+# Keyset sort orders for review listings. Every order ends in (created_at, review_id),
+# so keys are unique and each one is served by a (product_id, ...) compound index.
+REVIEW_SORTS = {
+    "newest": ["created_at", "review_id"],
+    "top": ["sparkles", "created_at", "review_id"],
+    "rating": ["rating", "created_at", "review_id"],
+}
+REVIEW_PAGE_SIZE = 20
+REVIEW_PAGE_MAX = 100
+
+# First pages per product: {(sort, limit): (reviews, next_cursor)}. Dropped on new reviews
+# and sparkles; deeper pages always go to MongoDB.
+review_pages_cache = TTLCache(ttl=30, max_entries=2048)
+
+def encode_review_cursor(review: dict, keys: List[str]) -> str:
+    values = [review.get(key) for key in keys]
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_review_cursor(cursor: str, keys: List[str]) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError(cursor)
+        return [as_utc(v) if key == "created_at" else v for key, v in zip(keys, values)]
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Неверный курсор")
+
+def after_cursor(keys: List[str], values: list) -> dict:
+    """Filter for documents strictly after `values` in descending order of `keys`"""
+    branches = []
+    for i, key in enumerate(keys):
+        branch = {k: values[j] for j, k in enumerate(keys[:i])}
+        branch[key] = {"$lt": values[i]}
+        branches.append(branch)
+    return {"$or": branches}
+
+async def fetch_review_page(product_id: str, sort: str, limit: int, cursor: Optional[str]):
+    keys = REVIEW_SORTS[sort]
+    query = {"product_id": product_id}
+    if cursor:
+        query.update(after_cursor(keys, decode_review_cursor(cursor, keys)))
+    # One extra document tells whether another page exists
+    reviews = await db.reviews.find(query, {"_id": 0}).sort([(key, -1) for key in keys]).limit(limit + 1).to_list(limit + 1)
+    next_cursor = encode_review_cursor(reviews[limit - 1], keys) if len(reviews) > limit else None
+    reviews = reviews[:limit]
+    for review in reviews:
+        review.setdefault("sparkles", 0)
+    return reviews, next_cursor
+
+@api_router.get("/reviews/{product_id}")
+async def get_product_reviews(
+    product_id: str,
+    response: Response,
+    sort: str = "newest",
+    limit: int = REVIEW_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    user: Optional[User] = Depends(get_current_user)
+):
+    """One page of reviews; the cursor for the next page is returned in X-Next-Cursor"""
+    if sort not in REVIEW_SORTS:
+        raise HTTPException(status_code=400, detail="sort: newest, top или rating")
+    limit = max(1, min(limit, REVIEW_PAGE_MAX))
+
+    if cursor:
+        reviews, next_cursor = await fetch_review_page(product_id, sort, limit, cursor)
+    else:
+        pages = review_pages_cache.get(product_id) or {}
+        page = pages.get((sort, limit))
+        if page is None:
+            page = await fetch_review_page(product_id, sort, limit, None)
+            review_pages_cache.set(product_id, {**pages, (sort, limit): page})
+        reviews, next_cursor = page
+        reviews = [dict(review) for review in reviews]
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+    # Sparkle counts live on the reviews; the viewer's own sparkles come from a single $in lookup
+    sparkled = set()
+    if user and reviews:
+        likes = await db.review_likes.find(
+            {"user_id": user.user_id, "review_id": {"$in": [r["review_id"] for r in reviews]}},
+            {"_id": 0, "review_id": 1}
+        ).to_list(len(reviews))
+        sparkled = {like["review_id"] for like in likes}
+    for review in reviews:
+        review["is_sparkled"] = review["review_id"] in sparkled
     return reviews
 
 @api_router.get("/auth/me")
@@ -1403,43 +2609,95 @@ async def get_product(product_id: str):
         raise HTTPException(status_code=404, detail="Product not found")
     return product
 
+# Market snapshot for AI product analysis: per-category price statistics,
+# rebuilt in the background so the endpoint never scans the catalog
+MARKET_SNAPSHOT_INTERVAL = 600
+MARKET_SNAPSHOT_EXAMPLES = 5
+market_snapshot: Dict[str, Any] = {"built_at": None, "categories": []}
+
+async def category_price_median(category_id: str, count: int) -> float:
+    """Median read from the (category_id, price) index: skip to the middle, take one or two"""
+    middle = await db.products.find(
+        {"category_id": category_id, "price": {"$type": "number"}}, {"_id": 0, "price": 1}
+    ).sort("price", 1).skip((count - 1) // 2).limit(2 - count % 2).to_list(2)
+    return sum(p["price"] for p in middle) / len(middle)
+
+async def refresh_market_snapshot():
+    """Rebuild per-category min/median/max prices. Only scalar stats are grouped and
+    the median and examples are bounded index reads, so no document grows with the catalog."""
+    groups = await db.products.aggregate([
+        {"$match": {"price": {"$type": "number"}}},
+        {"$group": {
+            "_id": "$category_id",
+            "count": {"$sum": 1},
+            "min": {"$min": "$price"},
+            "max": {"$max": "$price"}
+        }}
+    ]).to_list(None)
+    categories = await db.categories.find({}, {"_id": 0, "category_id": 1, "name": 1}).to_list(None)
+    names = {c["category_id"]: c.get("name") for c in categories}
+    
+    async def category_stats(group: dict) -> dict:
+        median, examples = await asyncio.gather(
+            category_price_median(group["_id"], group["count"]),
+            db.products.find(
+                {"category_id": group["_id"]}, {"_id": 0, "name": 1}
+            ).limit(MARKET_SNAPSHOT_EXAMPLES).to_list(MARKET_SNAPSHOT_EXAMPLES)
+        )
+        return {
+            "count": group["count"],
+            "min": round(float(group["min"]), 2),
+            "median": round(float(median), 2),
+            "max": round(float(group["max"]), 2),
+            "examples": [p.get("name") for p in examples]
+        }
+    
+    known = [g for g in groups if g["_id"] in names]
+    stats = dict(zip(
+        (g["_id"] for g in known),
+        await asyncio.gather(*(category_stats(g) for g in known))
+    ))
+    
+    market_snapshot.update({
+        "built_at": datetime.now(timezone.utc),
+        "categories": [
+            {"id": category_id, "name": name, **stats.get(category_id, {"count": 0})}
+            for category_id, name in names.items()
+        ]
+    })
+
+async def market_snapshot_refresher():
+    while True:
+        try:
+            await refresh_market_snapshot()
+        except Exception as e:
+            logging.error(f"Market snapshot refresh failed: {str(e)}")
+        await asyncio.sleep(MARKET_SNAPSHOT_INTERVAL)
+
 @api_router.post("/ai/analyze-product", response_model=AIProductAnalysisResponse)
 async def ai_analyze_product(request: AIProductAnalysisRequest, user: User = Depends(require_helper_or_admin)):
     """AI analyzes market prices and extracts product data from prompt"""
+    client_ai = ai_clients.get("openai")
+    if client_ai is None:
+        raise HTTPException(status_code=503, detail="AI сервис не настроен")
     
-    # 1. Get existing products for market analysis
-    all_products = await db.products.find().to_list(1000)
-    
-    # Prepare market data for AI
-    market_data = []
-    for p in all_products:
-        market_data.append({
-            "name": p.get("name"),
-            "category_id": p.get("category_id"),
-            "price": p.get("price")
-        })
-    
-    # 2. Get categories to help AI choose the right one
-    categories = await db.categories.find().to_list(100)
-    categories_info = [{"id": str(c["_id"]), "name": c.get("name")} for c in categories]
-
-    # 3. Call AI
-    from openai import OpenAI
-    client_ai = OpenAI() # Uses environment variables
+    # 1. Market data and categories come from the precomputed snapshot
+    if market_snapshot["built_at"] is None:
+        await refresh_market_snapshot()
     
     system_prompt = f"""
     You are an AI assistant for a marketplace admin. 
     Your task is to extract product information from the admin's prompt and analyze market prices.
     
-    Current market products: {market_data[:50]} (truncated)
-    Available categories: {categories_info}
+    Available categories with current market prices (count, min/median/max price, example products):
+    {json.dumps(market_snapshot["categories"], ensure_ascii=False)}
     
     Return a JSON object with:
     1. 'suggested_product': An object matching the ProductCreate model.
        - name, name_ru, name_tj (translate if needed)
        - description, description_ru, description_tj (translate if needed)
-       - price (suggest based on market or use admin's if specified)
-       - category_id (choose from available categories)
+       - price (suggest based on the category's market prices or use admin's if specified)
+       - category_id (choose the id of one of the available categories)
        - xp_reward (default 10)
        - image_url (leave empty if not specified)
        - images (empty list if not specified)
@@ -1451,8 +2709,9 @@ async def ai_analyze_product(request: AIProductAnalysisRequest, user: User = Dep
     Respond ONLY with valid JSON.
     """
     
+    # 2. Call AI without blocking the event loop
     try:
-        response = client_ai.chat.completions.create(
+        response = await client_ai.chat.completions.create(
             model="gpt-4.1-mini",
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -1461,7 +2720,6 @@ async def ai_analyze_product(request: AIProductAnalysisRequest, user: User = Dep
             response_format={"type": "json_object"}
         )
         
-        import json
         result = json.loads(response.choices[0].message.content)
         return result
     except Exception as e:
@@ -1481,8 +2739,8 @@ async def create_product(data: ProductCreate, user: User = Depends(require_helpe
     
     product = Product(**product_data)
     product_dict = product.model_dump()
-    product_dict["created_at"] = product_dict["created_at"].isoformat()
     await db.products.insert_one(product_dict)
+    await bump_store_stats(products_count=1)
     return product
 
 @api_router.put("/products/{product_id}", response_model=Product)
@@ -1509,6 +2767,7 @@ async def delete_product(product_id: str, user: User = Depends(require_helper_or
     result = await db.products.delete_one({"product_id": product_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    await bump_store_stats(products_count=-1)
     return {"message": "Product deleted"}
 
 # ==================== ORDER ENDPOINTS ====================
@@ -1657,67 +2916,51 @@ async def create_order(data: CreateOrderRequest, user: User = Depends(require_us
         delivery_cost=delivery_cost,
         status_history=[{
             "status": "pending",
-            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "timestamp": datetime.now(timezone.utc),
             "note": "Заказ создан"
         }]
     )
     order_dict = order.model_dump()
-    order_dict["created_at"] = order_dict["created_at"].isoformat()
     order_dict["items"] = [item.model_dump() for item in order_items]
+    # The order is written before the charge: with no transaction, a failed insert after
+    # charging would leave the user paying for nothing. A failed or missed charge removes it.
     await db.orders.insert_one(order_dict)
+    try:
+        # Charge the balance and grant XP in one atomic update;
+        # the balance guard also protects against concurrent checkouts
+        grant = await grant_xp(
+            user, total_xp, "order",
+            inc={"balance": -total},
+            filter_extra={"balance": {"$gte": total}}
+        )
+    except Exception:
+        await db.orders.delete_one({"order_id": order.order_id})
+        raise
+    if not grant:
+        await db.orders.delete_one({"order_id": order.order_id})
+        raise HTTPException(status_code=400, detail="Insufficient balance")
+    await asyncio.gather(
+        bump_store_stats(orders_count=1, gross_revenue=total),
+        bump_sales_rollups(order.created_at, sale_increments(
+            order_dict, {pid: p.get("category_id") for pid, p in products_map.items()}
+        ))
+    )
     
     # Remove MongoDB _id from response
     order_dict.pop("_id", None)
     
-    # Check for XP multiplier
-    xp_multiplier = 1
-    xp_expires = current_user.get("xp_multiplier_expires_at")
-    if xp_expires:
-        if isinstance(xp_expires, str):
-            xp_expires = datetime.fromisoformat(xp_expires)
-        if xp_expires.tzinfo is None:
-            xp_expires = xp_expires.replace(tzinfo=timezone.utc)
-        if xp_expires > datetime.now(timezone.utc):
-            xp_multiplier = 2
-    
-    actual_xp_gained = total_xp * xp_multiplier
-
-    # Update user balance and XP
-    new_xp = current_user["xp"] + actual_xp_gained
-    old_level = current_user["level"]
-    new_level = calculate_level(new_xp)
-    
-    # Calculate wheel spins for level up
-    levels_gained = new_level - old_level
-    new_spins = current_user.get("wheel_spins_available", 0) + levels_gained
-    
-    update_data = {
-        "balance": current_user["balance"] - total,
-        "xp": new_xp,
-        "level": new_level,
-        "wheel_spins_available": new_spins
-    }
-    
-    # If leveled up, set/extend XP multiplier for 30 days
-    if new_level > old_level:
-        multiplier_expiry = datetime.now(timezone.utc) + timedelta(days=30)
-        update_data["xp_multiplier_expires_at"] = multiplier_expiry.isoformat()
-    
-    await db.users.update_one(
-        {"user_id": user.user_id},
-        {"$set": update_data}
-    )
-    
     # Update mission progress
-    await update_mission_progress(user.user_id, "orders_count", 1)
-    await update_mission_progress(user.user_id, "spend_amount", total)
-    await update_mission_progress(user.user_id, "purchase", 1)
+    await job_queue.enqueue("mission_progress", {
+        "user_id": user.user_id,
+        "progress": {"orders_count": 1, "spend_amount": total, "purchase": 1},
+        "user_level": grant["new_level"]
+    })
     
     return {
         "order": order_dict,
-        "xp_gained": actual_xp_gained,
-        "new_level": new_level,
-        "level_up": new_level > old_level,
+        "xp_gained": grant["xp_gained"],
+        "new_level": grant["new_level"],
+        "level_up": grant["level_up"],
         "discount_applied": total_discount
     }
 
@@ -1764,7 +3007,7 @@ async def redeem_topup_code(code: str, user: User = Depends(require_user)):
         "user_id": user.user_id,
         "code": code,
         "amount": topup["amount"],
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     })
     
     return {"message": "Balance topped up", "amount": topup["amount"], "new_balance": new_balance}
@@ -1787,6 +3030,11 @@ async def create_topup_request(data: TopUpRequestCreate, user: User = Depends(re
     """Create a new top-up request with receipt"""
     request_id = f"req_{uuid.uuid4().hex[:12]}"
     
+    # Receipts go through AI review first when auto-approve is enabled
+    settings = await db.admin_settings.find_one({"settings_id": "admin_settings"}, {"_id": 0})
+    ai_enabled = settings.get("ai_auto_approve_enabled", False) if settings else False
+    ai_review = ai_enabled and receipt_ai_available()
+    
     request_data = {
         "request_id": request_id,
         "user_id": user.user_id,
@@ -1795,48 +3043,173 @@ async def create_topup_request(data: TopUpRequestCreate, user: User = Depends(re
         "amount": data.amount,
         "receipt_url": data.receipt_url,
         "receipt_image_url": data.receipt_url,  # Alias for compatibility
-        "status": "pending",
+        "status": "pending_ai" if ai_review else "pending",
         "admin_note": None,
         "ai_analysis": None,
-        "created_at": datetime.now(timezone.utc).isoformat(),
+        "created_at": datetime.now(timezone.utc),
         "processed_at": None
     }
     
-    # Check if AI auto-approve is enabled
-    settings = await db.admin_settings.find_one({"settings_id": "admin_settings"}, {"_id": 0})
-    ai_enabled = settings.get("ai_auto_approve_enabled", False) if settings else False
+    await db.topup_requests.insert_one(request_data)
+    request_data.pop("_id", None)
     
-    if ai_enabled and AI_AVAILABLE:
-        # Run AI analysis
-        ai_result = await analyze_receipt_with_ai(data.receipt_url, data.amount)
-        request_data["ai_analysis"] = ai_result
-        
-        if ai_result.get("approved"):
-            # Auto-approve
-            request_data["status"] = "approved"
-            request_data["admin_note"] = f"🤖 AI авто-одобрение: {ai_result.get('reason')}"
-            request_data["processed_at"] = datetime.now(timezone.utc).isoformat()
-            
-            # Add balance to user
-            await db.users.update_one(
-                {"user_id": user.user_id},
-                {"$inc": {"balance": data.amount}}
+    # Receipt stage always runs: duplicate check, then AI review when enabled
+    await receipt_queue.enqueue("topup_receipt_review", {"request_id": request_id})
+    
+    return request_data
+
+@receipt_queue.on_failure("topup_receipt_review")
+async def fail_topup_receipt_review(payload: dict, error: str):
+    """Out of retries: hand the request to a human instead of leaving it in pending_ai"""
+    ai_result = {
+        "approved": False,
+        "confidence": "none",
+        "extracted_amount": None,
+        "reason": "Проверка чека не удалась - требуется ручная проверка"
+    }
+    req = await db.topup_requests.find_one_and_update(
+        {"request_id": payload["request_id"], "status": "pending_ai"},
+        {"$set": {"ai_analysis": ai_result, "status": "pending"}},
+        projection={"_id": 0, "user_id": 1, "amount": 1}
+    )
+    if req:
+        await notify_user(req["user_id"], "topup", request_id=payload["request_id"], status="pending", amount=req["amount"])
+
+@receipt_queue.handler("topup_receipt_review")
+async def run_topup_receipt_review(payload: dict):
+    """Receipt stage of a top-up request: duplicate check by content hash, then
+    AI review (pending_ai -> approved, or pending for manual review)"""
+    req = await db.topup_requests.find_one({"request_id": payload["request_id"]}, {"_id": 0})
+    if not req or req["status"] not in ("pending", "pending_ai"):
+        return
+    
+    safe_url = is_safe_url(req["receipt_url"])
+    image = await load_receipt_bytes(req["receipt_url"]) if safe_url else None
+    hashes = None
+    duplicate_of = None
+    similar_to = None
+    extraction = None
+    
+    async def earliest_live_request(matches: List[dict]) -> Optional[str]:
+        other_ids = {rid for m in matches for rid in m.get("request_ids", [])} - {req["request_id"]}
+        if not other_ids:
+            return None
+        original = await db.topup_requests.find_one(
+            {"request_id": {"$in": list(other_ids)}, "status": {"$in": RECEIPT_DUPLICATE_STATUSES}},
+            {"_id": 0, "request_id": 1},
+            sort=[("created_at", 1)]
+        )
+        return original["request_id"] if original else None
+    
+    if image:
+        hashes = await asyncio.to_thread(hash_receipt, image)
+        # Record before looking up, so two concurrent submissions always see each other
+        await record_receipt_hash(hashes, req["request_id"])
+        matches = await find_receipt_matches(hashes)
+        exact = [m for m in matches if m["sha256"] == hashes["sha256"]]
+        # Same receipt file already used by another live or approved request
+        duplicate_of = await earliest_live_request(exact)
+        # A near-identical image may still be a different receipt (same bank template),
+        # so it only sends the request to manual review
+        if not duplicate_of:
+            similar_to = await earliest_live_request([m for m in matches if m["sha256"] != hashes["sha256"]])
+        # Reuse an earlier AI reading of exactly this file
+        extraction = next((m["extraction"] for m in exact if m.get("extraction")), None)
+        await db.topup_requests.update_one(
+            {"request_id": req["request_id"]},
+            {"$set": {"receipt_sha256": hashes["sha256"], "duplicate_of": duplicate_of, "similar_to": similar_to}}
+        )
+    
+    if req["status"] != "pending_ai":
+        return
+    
+    if duplicate_of:
+        # Duplicates are never auto-approved
+        ai_result = {
+            "approved": False,
+            "confidence": "none",
+            "extracted_amount": None,
+            "reason": f"Чек уже использован в заявке {duplicate_of} - требуется ручная проверка"
+        }
+    elif similar_to:
+        ai_result = {
+            "approved": False,
+            "confidence": "none",
+            "extracted_amount": None,
+            "reason": f"Чек похож на чек из заявки {similar_to} - требуется ручная проверка"
+        }
+    elif not safe_url:
+        ai_result = {"approved": False, "confidence": "none", "extracted_amount": None, "reason": "Небезопасный URL изображения"}
+    elif not image:
+        ai_result = {"approved": False, "confidence": "none", "extracted_amount": None, "reason": "Не удалось загрузить изображение"}
+    elif extraction:
+        ai_result = evaluate_receipt_extraction(extraction, req["amount"])
+        ai_result["cached"] = True
+    else:
+        try:
+            extraction = await asyncio.wait_for(
+                extract_receipt_amount(image, req["amount"]),
+                timeout=AI_RECEIPT_TIMEOUT
+            )
+            await db.receipt_hashes.update_one(
+                {"sha256": hashes["sha256"]},
+                {"$set": {"extraction": extraction}}
             )
-            
-            # Log history
-            history_entry = {
-                "history_id": f"hist_{uuid.uuid4().hex[:12]}",
-                "user_id": user.user_id,
-                "amount": data.amount,
-                "type": "ai_approved",
-                "description": f"AI авто-одобрение пополнения: {data.amount}",
-                "created_at": datetime.now(timezone.utc).isoformat()
+            ai_result = evaluate_receipt_extraction(extraction, req["amount"])
+        except asyncio.TimeoutError:
+            ai_result = {
+                "approved": False,
+                "confidence": "none",
+                "extracted_amount": None,
+                "reason": "AI не ответил вовремя - требуется ручная проверка"
+            }
+        except Exception as e:
+            logging.error(f"AI analysis error: {str(e)}")
+            ai_result = {
+                "approved": False,
+                "confidence": "none",
+                "extracted_amount": None,
+                "reason": f"Ошибка AI анализа: {str(e)}"
             }
-            await db.topup_history.insert_one(history_entry)
     
-    await db.topup_requests.insert_one(request_data)
-    request_data.pop("_id", None)
-    return request_data
+    if not ai_result.get("approved"):
+        # Fall back to manual review
+        await db.topup_requests.update_one(
+            {"request_id": req["request_id"], "status": "pending_ai"},
+            {"$set": {"ai_analysis": ai_result, "status": "pending"}}
+        )
+        await notify_user(req["user_id"], "topup", request_id=req["request_id"], status="pending", amount=req["amount"])
+        return
+    
+    result = await db.topup_requests.update_one(
+        {"request_id": req["request_id"], "status": "pending_ai"},
+        {"$set": {
+            "ai_analysis": ai_result,
+            "status": "approved",
+            "admin_note": f"🤖 AI авто-одобрение: {ai_result.get('reason')}",
+            "processed_at": datetime.now(timezone.utc)
+        }}
+    )
+    if result.modified_count == 0:
+        return
+    
+    # Add balance to user
+    await db.users.update_one(
+        {"user_id": req["user_id"]},
+        {"$inc": {"balance": req["amount"]}}
+    )
+    
+    # Log history
+    history_entry = {
+        "history_id": f"hist_{uuid.uuid4().hex[:12]}",
+        "user_id": req["user_id"],
+        "amount": req["amount"],
+        "type": "ai_approved",
+        "description": f"AI авто-одобрение пополнения: {req['amount']}",
+        "created_at": datetime.now(timezone.utc)
+    }
+    await db.topup_history.insert_one(history_entry)
+    await notify_user(req["user_id"], "topup", request_id=req["request_id"], status="approved", amount=req["amount"])
 
 @api_router.get("/topup/requests")
 async def get_user_topup_requests(user: User = Depends(require_user)):
@@ -1844,6 +3217,14 @@ async def get_user_topup_requests(user: User = Depends(require_user)):
     requests = await db.topup_requests.find({"user_id": user.user_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
     return requests
 
+@api_router.get("/topup/requests/{request_id}")
+async def get_user_topup_request(request_id: str, user: User = Depends(require_user)):
+    """Poll a single top-up request (status changes once AI review finishes)"""
+    req = await db.topup_requests.find_one({"request_id": request_id, "user_id": user.user_id}, {"_id": 0})
+    if not req:
+        raise HTTPException(status_code=404, detail="Заявка не найдена")
+    return req
+
 @api_router.get("/topup/history")
 async def get_topup_history(user: User = Depends(require_user)):
     history = await db.topup_history.find({"user_id": user.user_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
@@ -1871,7 +3252,7 @@ async def create_withdrawal_request(data: WithdrawalRequestCreate, user: User =
         "card_number": data.card_number,
         "status": "pending",
         "admin_note": None,
-        "created_at": datetime.now(timezone.utc).isoformat(),
+        "created_at": datetime.now(timezone.utc),
         "processed_at": None
     }
     
@@ -1887,8 +3268,8 @@ async def create_withdrawal_request(data: WithdrawalRequestCreate, user: User =
         "user_id": user.user_id,
         "amount": -data.amount,
         "type": "withdrawal_request",
-        "description": f"Заявка на вывод средств: {data.amount} на карту {data.card_number}",
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "description": f"Заявка на вывод средств: {data.amount} на карту {mask_card_number(data.card_number)}",
+        "created_at": datetime.now(timezone.utc)
     }
     await db.topup_history.insert_one(history_entry)
     
@@ -1930,23 +3311,27 @@ async def claim_reward(level: int, user: User = Depends(require_user)):
     if level in user.claimed_rewards:
         raise HTTPException(status_code=400, detail="Reward already claimed")
     
-    # Apply reward atomically
-    update_ops = {"$push": {"claimed_rewards": level}}
-    
-    if reward["reward_type"] == "coins":
-        update_ops["$inc"] = {"balance": reward["value"]}
-    elif reward["reward_type"] == "xp_boost":
-        # Note: XP update doesn't automatically recalculate level here
-        # For simplicity, we just increment XP, level will catch up on next login or action
-        update_ops["$inc"] = {"xp": int(reward["value"])}
-    
     # We use a filter to ensure reward isn't double-claimed in a race condition
-    result = await db.users.update_one(
-        {"user_id": user.user_id, "claimed_rewards": {"$ne": level}},
-        update_ops
-    )
+    if reward["reward_type"] == "xp_boost":
+        # XP, level and spins are applied together by the gamification engine
+        claimed = await grant_xp(
+            user, int(reward["value"]), "level_reward",
+            apply_multiplier=False,
+            push={"claimed_rewards": level},
+            filter_extra={"claimed_rewards": {"$ne": level}}
+        ) is not None
+    else:
+        # Apply reward atomically
+        update_ops = {"$push": {"claimed_rewards": level}}
+        if reward["reward_type"] == "coins":
+            update_ops["$inc"] = {"balance": reward["value"]}
+        result = await db.users.update_one(
+            {"user_id": user.user_id, "claimed_rewards": {"$ne": level}},
+            update_ops
+        )
+        claimed = result.modified_count > 0
     
-    if result.modified_count == 0:
+    if not claimed:
         raise HTTPException(status_code=400, detail="Reward already claimed or user not found")
     
     return {"message": "Reward claimed", "reward": reward}
@@ -1979,25 +3364,22 @@ async def spin_wheel(user: User = Depends(require_user)):
             selected_prize = prize
             break
     
-    # Apply prize atomically
+    # Apply prize atomically, ensuring user has spins available during update
+    if selected_prize["prize_type"] == "xp":
+        # Multiplier, level-up and bonus spins are handled by the gamification engine
+        grant = await grant_xp(
+            user, int(selected_prize["value"]), "wheel",
+            inc={"wheel_spins_available": -1},
+            filter_extra={"wheel_spins_available": {"$gt": 0}}
+        )
+        if not grant:
+            raise HTTPException(status_code=400, detail="No spins available or user not found")
+        return {"prize": selected_prize, "spins_remaining": grant["user"].get("wheel_spins_available", 0)}
+
     update_ops = {"$inc": {"wheel_spins_available": -1}}
-    
     if selected_prize["prize_type"] == "coins":
         update_ops["$inc"]["balance"] = selected_prize["value"]
-    elif selected_prize["prize_type"] == "xp":
-        # Check for XP multiplier
-        xp_multiplier = 1
-        xp_expires = user.xp_multiplier_expires_at
-        if xp_expires:
-            if xp_expires.tzinfo is None:
-                xp_expires = xp_expires.replace(tzinfo=timezone.utc)
-            if xp_expires > datetime.now(timezone.utc):
-                xp_multiplier = 2
-        
-        update_ops["$inc"]["xp"] = int(selected_prize["value"]) * xp_multiplier
-        # Level will be updated on next action or login
     
-    # Ensure user has spins available during update
     result = await db.users.update_one(
         {"user_id": user.user_id, "wheel_spins_available": {"$gt": 0}},
         update_ops
@@ -2008,30 +3390,111 @@ async def spin_wheel(user: User = Depends(require_user)):
     
     return {"prize": selected_prize, "spins_remaining": user.wheel_spins_available - 1}
 
-# ==================== ADMIN ENDPOINTS ====================
+# ==================== ADMIN ENDPOINTS ====================
+
+# Dashboard counters, kept current with $inc on every write that changes them
+# and periodically recomputed from the source collections
+STATS_ID = "store"
+STATS_RECONCILE_INTERVAL = 3600  # seconds
+
+async def bump_store_stats(**deltas: float):
+    await db.store_stats.update_one(
+        {"stats_id": STATS_ID},
+        {"$inc": deltas, "$set": {"updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+async def reconcile_store_stats() -> dict:
+    """Recompute every counter from source with counts and one aggregation"""
+    users_count, products_count, orders = await asyncio.gather(
+        db.users.count_documents({}),
+        db.products.count_documents({}),
+        db.orders.aggregate([
+            {"$group": {
+                "_id": None,
+                "orders_count": {"$sum": 1},
+                "gross_revenue": {"$sum": {"$ifNull": ["$total", 0]}},
+                "refunded": {"$sum": {"$ifNull": ["$refund_amount", 0]}}
+            }}
+        ]).to_list(1)
+    )
+    totals = orders[0] if orders else {}
+    stats = {
+        "users_count": users_count,
+        "products_count": products_count,
+        "orders_count": totals.get("orders_count", 0),
+        "gross_revenue": totals.get("gross_revenue", 0),
+        "refunded": totals.get("refunded", 0),
+        "reconciled_at": datetime.now(timezone.utc)
+    }
+    await db.store_stats.update_one({"stats_id": STATS_ID}, {"$set": stats}, upsert=True)
+    return stats
+
+async def store_stats_reconciler():
+    while True:
+        try:
+            await reconcile_store_stats()
+        except Exception as e:
+            logging.error(f"Store stats reconciliation failed: {str(e)}")
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+
+# Work queues shown as badges in the admin panel: collection and the status that means "waiting"
+INBOX_QUEUES = {
+    "topup_requests": ("topup_requests", "pending"),
+    "topup_ai_review": ("topup_requests", "pending_ai"),
+    "withdrawal_requests": ("withdrawal_requests", "pending"),
+    "orders": ("orders", "pending"),
+    "order_returns": ("orders", "return_pending"),
+    "support_tickets": ("support_tickets", "open"),
+}
+inbox_cache = TTLCache(ttl=5, max_entries=1)
+
+async def inbox_queue(collection: str, status: str) -> dict:
+    """Pending count and oldest pending item, both answered by the (status, created_at) index"""
+    count, oldest = await asyncio.gather(
+        db[collection].count_documents({"status": status}),
+        db[collection].find_one({"status": status}, {"_id": 0, "created_at": 1}, sort=[("created_at", 1)])
+    )
+    oldest_at = as_utc(oldest.get("created_at")) if oldest else None
+    return {
+        "pending": count,
+        "oldest_at": oldest_at,
+        "oldest_age_seconds": int((datetime.now(timezone.utc) - oldest_at).total_seconds()) if oldest_at else None
+    }
+
+@api_router.get("/admin/inbox")
+async def get_admin_inbox(user: User = Depends(require_helper_or_admin)):
+    """Pending counts per admin queue, for badges without loading the lists"""
+    inbox = inbox_cache.get("inbox")
+    if inbox is None:
+        queues = await asyncio.gather(*(inbox_queue(*INBOX_QUEUES[name]) for name in INBOX_QUEUES))
+        inbox = dict(zip(INBOX_QUEUES, queues))
+        inbox_cache.set("inbox", inbox)
+    return inbox
 
 @api_router.get("/admin/stats")
 async def get_admin_stats(user: User = Depends(require_helper_or_admin)):
-    users_count = await db.users.count_documents({})
-    orders_count = await db.orders.count_documents({})
-    products_count = await db.products.count_documents({})
+    stats, settings = await asyncio.gather(
+        db.store_stats.find_one({"stats_id": STATS_ID}, {"_id": 0}),
+        db.admin_settings.find_one({"settings_id": "admin_settings"}, {"_id": 0, "custom_revenue": 1})
+    )
+    if not stats:
+        stats = await reconcile_store_stats()
+    
+    # Revenue net of approved returns
+    net_revenue = round(stats.get("gross_revenue", 0) - stats.get("refunded", 0), 2)
     
     # Get custom revenue from settings if exists
-    settings = await db.admin_settings.find_one({"settings_id": "admin_settings"})
     custom_revenue = settings.get("custom_revenue") if settings else None
-    
-    if custom_revenue is not None:
-        total_revenue = custom_revenue
-    else:
-        # Calculate real revenue from orders
-        orders = await db.orders.find({}, {"total": 1, "_id": 0}).to_list(10000)
-        total_revenue = sum(o.get("total", 0) for o in orders)
+    total_revenue = custom_revenue if custom_revenue is not None else net_revenue
     
     return {
-        "users_count": users_count,
-        "orders_count": orders_count,
-        "products_count": products_count,
+        "users_count": stats.get("users_count", 0),
+        "orders_count": stats.get("orders_count", 0),
+        "products_count": stats.get("products_count", 0),
         "total_revenue": total_revenue,
+        "gross_revenue": round(stats.get("gross_revenue", 0), 2),
+        "refunded": round(stats.get("refunded", 0), 2),
         "is_custom_revenue": custom_revenue is not None
     }
 
@@ -2054,6 +3517,332 @@ async def reset_admin_revenue(user: User = Depends(require_admin)):
     )
     return {"message": "Выручка сброшена к реальным значениям"}
 
+# ==================== SALES ANALYTICS ====================
+
+# Pre-aggregated sales per UTC day and hour. Orders and approved returns bump their
+# bucket with $inc; the analytics API reads only these rollups.
+SALES_ROLLUPS = {"day": "sales_daily", "hour": "sales_hourly"}
+ANALYTICS_MAX_BUCKETS = 24 * 93  # ~3 months of hourly buckets
+SALES_BACKFILL_BATCH_SIZE = 2000
+
+def bucket_start(moment: datetime, granularity: str) -> datetime:
+    moment = moment.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0) if granularity == "day" else moment
+
+def sale_increments(order: dict, product_categories: Dict[str, Optional[str]]) -> dict:
+    """$inc payload for one order: totals plus units/revenue per product and category"""
+    inc = defaultdict(int)
+    inc["revenue"] = order["total"]
+    inc["orders_count"] = 1
+    inc["discount"] = order.get("discount_applied", 0)
+    for item in order["items"]:
+        quantity = item["quantity"]
+        revenue = item["price"] * quantity
+        inc["units"] += quantity
+        inc[f"products.{item['product_id']}.units"] += quantity
+        inc[f"products.{item['product_id']}.revenue"] += revenue
+        category_id = product_categories.get(item["product_id"]) or "uncategorized"
+        inc[f"categories.{category_id}.units"] += quantity
+        inc[f"categories.{category_id}.revenue"] += revenue
+    return dict(inc)
+
+async def bump_sales_rollups(moment: datetime, inc: dict):
+    await asyncio.gather(*(
+        db[collection].update_one(
+            {"start": bucket_start(moment, granularity)},
+            {"$inc": inc},
+            upsert=True
+        )
+        for granularity, collection in SALES_ROLLUPS.items()
+    ))
+
+def merge_breakdown(target: dict, source: Optional[dict]):
+    for key, values in (source or {}).items():
+        entry = target.setdefault(key, {"units": 0, "revenue": 0.0})
+        entry["units"] += values.get("units", 0)
+        entry["revenue"] += values.get("revenue", 0)
+
+def top_breakdown(breakdown: dict, id_field: str, limit: int = 10) -> List[dict]:
+    ranked = sorted(breakdown.items(), key=lambda kv: kv[1]["revenue"], reverse=True)[:limit]
+    return [
+        {id_field: key, "units": int(values["units"]), "revenue": round(values["revenue"], 2)}
+        for key, values in ranked
+    ]
+
+@api_router.get("/admin/analytics")
+async def get_sales_analytics(
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    granularity: str = "day",
+    user: User = Depends(require_admin)
+):
+    """Sales time series for [start, end) from the daily/hourly rollups (default: last 30 days)"""
+    if granularity not in SALES_ROLLUPS:
+        raise HTTPException(status_code=400, detail="granularity: day или hour")
+    try:
+        end_at = as_utc(end) or datetime.now(timezone.utc)
+        start_at = as_utc(start) or end_at - timedelta(days=30)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неверный формат даты")
+    step = timedelta(days=1) if granularity == "day" else timedelta(hours=1)
+    first = bucket_start(start_at, granularity)
+    if end_at <= first:
+        raise HTTPException(status_code=400, detail="Конец периода должен быть позже начала")
+    if (end_at - first) / step > ANALYTICS_MAX_BUCKETS:
+        raise HTTPException(status_code=400, detail="Слишком большой период для выбранной детализации")
+    
+    rollups = await db[SALES_ROLLUPS[granularity]].find(
+        {"start": {"$gte": first, "$lt": end_at}}, {"_id": 0}
+    ).sort("start", 1).to_list(None)
+    by_start = {r["start"]: r for r in rollups}
+    
+    series = []
+    totals = defaultdict(float)
+    products: Dict[str, dict] = {}
+    categories: Dict[str, dict] = {}
+    moment = first
+    while moment < end_at:
+        r = by_start.get(moment, {})
+        point = {key: r.get(key, 0) for key in ("revenue", "orders_count", "units", "discount", "refunded", "returns_count")}
+        for key, value in point.items():
+            totals[key] += value
+        point["net_revenue"] = round(point["revenue"] - point["refunded"], 2)
+        point["aov"] = round(point["revenue"] / point["orders_count"], 2) if point["orders_count"] else 0
+        series.append({"start": moment, **point})
+        merge_breakdown(products, r.get("products"))
+        merge_breakdown(categories, r.get("categories"))
+        moment += step
+    
+    totals = {key: round(value, 2) for key, value in totals.items()}
+    totals["net_revenue"] = round(totals["revenue"] - totals["refunded"], 2)
+    totals["aov"] = round(totals["revenue"] / totals["orders_count"], 2) if totals["orders_count"] else 0
+    
+    return {
+        "granularity": granularity,
+        "start": first,
+        "end": end_at,
+        "series": series,
+        "totals": totals,
+        "top_products": top_breakdown(products, "product_id"),
+        "top_categories": top_breakdown(categories, "category_id")
+    }
+
+def aggregate_sales_batch(orders: List[dict], product_categories: Dict[str, Optional[str]], buckets: dict):
+    """Fold a batch of orders into `buckets[granularity][start]` (CPU-bound, run in a thread)"""
+    frame = pd.DataFrame({
+        "created_at": pd.to_datetime([as_utc(o.get("created_at")) for o in orders], utc=True),
+        "total": [o.get("total", 0) for o in orders],
+        "discount": [o.get("discount_applied", 0) for o in orders]
+    })
+    items = pd.DataFrame([
+        {
+            "created_at": created_at,
+            "product_id": item["product_id"],
+            "category_id": product_categories.get(item["product_id"]) or "uncategorized",
+            "units": item.get("quantity", 0),
+            "revenue": item.get("price", 0) * item.get("quantity", 0)
+        }
+        for created_at, order in zip(frame["created_at"], orders)
+        for item in order.get("items", [])
+    ], columns=["created_at", "product_id", "category_id", "units", "revenue"])
+    returned = []
+    for order in orders:
+        if order.get("status") != "returned":
+            continue
+        # Refunds count in the bucket of the approval, like the live increments
+        entry = next((e for e in order.get("status_history", []) if e.get("status") == "returned"), None)
+        if entry and entry.get("timestamp"):
+            returned.append({"returned_at": as_utc(entry["timestamp"]), "refunded": order.get("refund_amount", 0)})
+    returns = pd.DataFrame(returned, columns=["returned_at", "refunded"])
+    returns["returned_at"] = pd.to_datetime(returns["returned_at"], utc=True)
+    
+    for granularity, freq in (("day", "D"), ("hour", "h")):
+        target = buckets[granularity]
+        def bucket(start) -> dict:
+            return target.setdefault(start.to_pydatetime(), {
+                "revenue": 0.0, "orders_count": 0, "units": 0, "discount": 0.0,
+                "refunded": 0.0, "returns_count": 0, "products": {}, "categories": {}
+            })
+        
+        grouped = frame.groupby(frame["created_at"].dt.floor(freq)).agg(
+            revenue=("total", "sum"), orders_count=("total", "size"), discount=("discount", "sum")
+        )
+        for start, row in grouped.iterrows():
+            b = bucket(start)
+            b["revenue"] += float(row["revenue"])
+            b["orders_count"] += int(row["orders_count"])
+            b["discount"] += float(row["discount"])
+        
+        item_start = items["created_at"].dt.floor(freq)
+        for key, field in (("product_id", "products"), ("category_id", "categories")):
+            grouped = items.groupby([item_start, items[key]])[["units", "revenue"]].sum()
+            for (start, key_value), row in grouped.iterrows():
+                b = bucket(start)
+                entry = b[field].setdefault(key_value, {"units": 0, "revenue": 0.0})
+                entry["units"] += int(row["units"])
+                entry["revenue"] += float(row["revenue"])
+                if field == "products":
+                    b["units"] += int(row["units"])
+        
+        grouped = returns.dropna().groupby(returns["returned_at"].dt.floor(freq)).agg(
+            refunded=("refunded", "sum"), returns_count=("refunded", "size")
+        )
+        for start, row in grouped.iterrows():
+            b = bucket(start)
+            b["refunded"] += float(row["refunded"])
+            b["returns_count"] += int(row["returns_count"])
+
+@job_queue.handler("backfill_sales_rollups")
+async def run_sales_backfill(payload: dict):
+    """Rebuild the rollups from db.orders for every bucket before the current hour.
+    The live hour keeps its incremental counts, so backfilling while orders come in is safe."""
+    cutoff = bucket_start(datetime.now(timezone.utc), "hour")
+    products = await db.products.find({}, {"_id": 0, "product_id": 1, "category_id": 1}).to_list(None)
+    product_categories = {p["product_id"]: p.get("category_id") for p in products}
+    buckets = {"day": {}, "hour": {}}
+    
+    cursor = db.orders.find(
+        {},
+        {"_id": 0, "created_at": 1, "total": 1, "discount_applied": 1, "items.product_id": 1,
+         "items.quantity": 1, "items.price": 1, "status": 1, "refund_amount": 1, "status_history": 1}
+    ).batch_size(SALES_BACKFILL_BATCH_SIZE)
+    batch = []
+    async for order in cursor:
+        batch.append(order)
+        if len(batch) >= SALES_BACKFILL_BATCH_SIZE:
+            await asyncio.to_thread(aggregate_sales_batch, batch, product_categories, buckets)
+            batch = []
+    if batch:
+        await asyncio.to_thread(aggregate_sales_batch, batch, product_categories, buckets)
+    
+    for granularity, collection in SALES_ROLLUPS.items():
+        # The current day bucket also holds the live hour, so it is left to the increments
+        limit = bucket_start(cutoff, granularity)
+        ops = [
+            ReplaceOne({"start": start}, {"start": start, **values}, upsert=True)
+            for start, values in buckets[granularity].items() if start < limit
+        ]
+        for i in range(0, len(ops), 1000):
+            await db[collection].bulk_write(ops[i:i + 1000], ordered=False)
+    logging.info(f"Sales rollups backfilled: {len(buckets['day'])} days, {len(buckets['hour'])} hours")
+
+@api_router.post("/admin/analytics/backfill")
+async def backfill_sales_analytics(user: User = Depends(require_admin)):
+    """Admin: rebuild sales rollups from existing orders in the background"""
+    job_id = await job_queue.enqueue("backfill_sales_rollups", {}, max_attempts=1)
+    return {"message": "Пересчёт аналитики запущен", "job_id": job_id}
+
+# ==================== EXPORTS ====================
+
+# Streamed straight from a Motor cursor in bounded batches, so memory stays flat however many
+# rows match. Each export has a fixed column list; NDJSON rows carry the same fields.
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CHUNK_SIZE = 64 * 1024  # bytes of output buffered before each yield
+EXPORTS = {
+    "orders": ("orders", [
+        "order_id", "user_id", "status", "total", "total_xp", "discount_applied", "delivery_cost",
+        "refund_amount", "promo_code", "delivery_method_id", "delivery_user_id", "tracking_number",
+        "created_at", "updated_at"
+    ]),
+    "users": ("users", ["user_id", "email", "name", "role", "balance", "xp", "level", "created_at"]),
+    "topup-history": ("topup_history", ["history_id", "user_id", "amount", "type", "description", "created_at"]),
+    "withdrawals": ("withdrawal_requests", [
+        "request_id", "user_id", "user_name", "user_email", "amount", "card_number", "status",
+        "admin_note", "created_at", "processed_at"
+    ]),
+}
+
+def mask_card_number(value) -> str:
+    """Card number reduced to its last four digits"""
+    digits = re.sub(r"\D", "", str(value))
+    return f"**** {digits[-4:]}" if len(digits) > 4 else "****"
+
+# 12+ digits, optionally split by spaces or dashes: a card number inside free text
+CARD_NUMBER_RE = re.compile(r"\d(?:[ -]?\d){11,}")
+
+def mask_card_numbers_in_text(text) -> str:
+    """Free text with every embedded card number masked (older history descriptions carry them)"""
+    return CARD_NUMBER_RE.sub(lambda match: mask_card_number(match.group()), str(text))
+
+# Columns rewritten on export unless the admin asks for full values
+EXPORT_MASKS = {
+    "withdrawals": {"card_number": mask_card_number},
+    "topup-history": {"description": mask_card_numbers_in_text},
+}
+
+def csv_cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    # Keep spreadsheet apps from evaluating user-supplied text as a formula
+    if isinstance(value, str) and value[:1] in ("=", "+", "-", "@"):
+        return "'" + value
+    return value
+
+async def export_chunks(collection, query: dict, columns: List[str], fmt: str, masks: Optional[dict] = None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        buffer.write("\ufeff")  # BOM so Excel reads Cyrillic as UTF-8
+        writer.writerow(columns)
+    cursor = collection.find(query, {"_id": 0, **{c: 1 for c in columns}}).sort("created_at", 1).batch_size(EXPORT_BATCH_SIZE)
+    async for doc in cursor:
+        for column, mask in (masks or {}).items():
+            if doc.get(column):
+                doc[column] = mask(doc[column])
+        if fmt == "csv":
+            writer.writerow([csv_cell(doc.get(c)) for c in columns])
+        else:
+            buffer.write(json.dumps(jsonable_encoder(doc), ensure_ascii=False) + "\n")
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+async def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@api_router.get("/admin/export/{name}")
+async def export_data(
+    name: str,
+    fmt: str = Query("csv", alias="format"),
+    gzip: bool = False,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    full_card: bool = False,
+    user: User = Depends(require_admin)
+):
+    """Download orders, users, top-up history or withdrawals as CSV or NDJSON, filtered by created_at.
+    Withdrawal card numbers are masked to the last four digits unless full_card=true."""
+    if name not in EXPORTS:
+        raise HTTPException(status_code=404, detail="Неизвестный экспорт")
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format: csv или ndjson")
+    collection, columns = EXPORTS[name]
+    masks = None if full_card else EXPORT_MASKS.get(name)
+    if full_card and name in EXPORT_MASKS:
+        logging.info(f"Export {name} with full card numbers by {user.user_id}")
+    body = export_chunks(db[collection], created_range(date_from, date_to), columns, fmt, masks)
+    filename = f"{name}-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.{fmt}"
+    media_type = "text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson"
+    if gzip:
+        body = gzip_chunks(body)
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 # ==================== PROMO CODES ====================
 
 @api_router.post("/promo/validate")
@@ -2071,13 +3860,8 @@ async def validate_promo_code(code: str, user: User = Depends(require_user)):
         raise HTTPException(status_code=400, detail="Промокод больше недействителен (исчерпан лимит)")
     
     # Check expiration date
-    expires_at = promo.get("expires_at")
+    expires_at = as_utc(promo.get("expires_at"))
     if expires_at:
-        if isinstance(expires_at, str):
-            expires_at = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-        if expires_at.tzinfo is None:
-            expires_at = expires_at.replace(tzinfo=timezone.utc)
-        
         if datetime.now(timezone.utc) > expires_at:
             raise HTTPException(status_code=400, detail="Срок действия промокода истек")
     
@@ -2105,9 +3889,6 @@ async def create_promo_code(data: PromoCodeCreate, user: User = Depends(require_
         expires_at=data.expires_at
     )
     promo_dict = promo.model_dump()
-    promo_dict["created_at"] = promo_dict["created_at"].isoformat()
-    if promo_dict.get("expires_at"):
-        promo_dict["expires_at"] = promo_dict["expires_at"].isoformat()
     
     await db.promo_codes.insert_one(promo_dict)
     promo_dict.pop("_id", None)
@@ -2133,10 +3914,139 @@ async def toggle_promo_code(promo_id: str, user: User = Depends(require_helper_o
     )
     return {"message": "Статус изменён", "is_active": new_status}
 
+# Admin list views. "fields" is the allowlist of everything a list may return (the first one
+# is the id) and is what "full", the default for existing clients, returns; anything stored
+# outside it (password hashes, bookkeeping fields) never leaves the server. "summary" carries
+# what list screens render. Heavy fields - order items and status_history, receipt images
+# (often base64 data URIs) - only come with "full" or the detail endpoints.
+ADMIN_LIST_VIEWS = {
+    "users": {
+        "fields": [
+            "user_id", "email", "name", "picture", "role", "is_admin", "balance", "xp", "level",
+            "wheel_spins_available", "claimed_rewards", "achievements", "last_bonus_claim",
+            "xp_multiplier_expires_at", "referred_by", "created_at"
+        ],
+        "summary": ["user_id", "email", "name", "picture", "role", "is_admin", "balance", "xp", "level", "referred_by", "created_at"],
+    },
+    "orders": {
+        "fields": [
+            "order_id", "user_id", "user_name", "user_email", "items", "total", "total_xp", "status",
+            "delivery_address", "phone_number", "discount_applied", "promo_code", "tracking_number",
+            "status_history", "admin_note", "delivery_user_id", "delivery_method_id", "delivery_cost",
+            "refund_amount", "created_at", "updated_at"
+        ],
+        "summary": [
+            "order_id", "user_id", "user_name", "user_email", "total", "total_xp", "status", "discount_applied",
+            "promo_code", "tracking_number", "delivery_user_id", "delivery_method_id", "delivery_cost",
+            "refund_amount", "created_at", "updated_at"
+        ],
+        "computed": {"items_count": {"$size": {"$ifNull": ["$items", []]}}},
+    },
+    "topup_requests": {
+        "fields": [
+            "request_id", "user_id", "user_name", "user_email", "amount", "receipt_url", "receipt_image_url",
+            "status", "admin_note", "duplicate_of", "similar_to", "ai_analysis", "processed_by",
+            "created_at", "processed_at"
+        ],
+        "summary": [
+            "request_id", "user_id", "user_name", "user_email", "amount", "status", "admin_note",
+            "duplicate_of", "similar_to", "ai_analysis", "created_at", "processed_at"
+        ],
+    },
+    "withdrawal_requests": {
+        "fields": [
+            "request_id", "user_id", "user_name", "user_email", "amount", "card_number", "status",
+            "admin_note", "created_at", "processed_at"
+        ],
+        "summary": [
+            "request_id", "user_id", "user_name", "user_email", "amount", "card_number", "status",
+            "created_at", "processed_at"
+        ],
+    },
+}
+
+def list_projection(resource: str, view: str = "full", fields: Optional[str] = None) -> dict:
+    """MongoDB projection for an admin list: a sparse fieldset (`fields=a,b`) or a named view.
+    `_id` is excluded last, so no requested name can switch it back on."""
+    spec = ADMIN_LIST_VIEWS[resource]
+    if fields:
+        names = [name.strip() for name in fields.split(",") if name.strip()]
+        invalid = [name for name in names if name not in spec["fields"]]
+        if invalid:
+            raise HTTPException(status_code=400, detail=f"Недопустимые поля: {', '.join(invalid)}")
+        # The id field is always returned so rows can be fetched in full later
+        return {spec["fields"][0]: 1, **{name: 1 for name in names}, "_id": 0}
+    if view == "summary":
+        return {**{name: 1 for name in spec["summary"]}, **spec.get("computed", {}), "_id": 0}
+    if view != "full":
+        raise HTTPException(status_code=400, detail="view: summary или full")
+    return {**{name: 1 for name in spec["fields"]}, "_id": 0}
+
+ADMIN_PAGE_LIMIT = 1000
+
+async def admin_page(collection, query: dict, projection: dict, response: Response, skip: int, limit: int, sort=None, lookups: Optional[list] = None) -> list:
+    """One page of an admin list, newest first; the total match count goes in X-Total-Count.
+    `lookups` are aggregation stages joining related documents onto the page."""
+    limit = max(1, min(limit, ADMIN_PAGE_LIMIT))
+    skip = max(0, skip)
+    sort = sort or [("created_at", -1)]
+    if lookups:
+        if any(value != 0 for value in projection.values()):
+            # Inclusion projection: keep the joined fields too
+            projection = {**projection, **{stage["$lookup"]["as"]: 1 for stage in lookups if "$lookup" in stage}}
+        page = collection.aggregate([
+            {"$match": query}, {"$sort": dict(sort)}, {"$skip": skip}, {"$limit": limit},
+            *lookups,
+            {"$project": projection}
+        ]).to_list(limit)
+    else:
+        page = collection.find(query, projection).sort(sort).skip(skip).limit(limit).to_list(limit)
+    # Unfiltered totals come from collection metadata instead of a full count
+    total, docs = await asyncio.gather(
+        collection.count_documents(query) if query else collection.estimated_document_count(),
+        page
+    )
+    response.headers["X-Total-Count"] = str(total)
+    return docs
+
+def created_range(date_from: Optional[str], date_to: Optional[str]) -> dict:
+    """created_at filter for [date_from, date_to)"""
+    try:
+        bounds = {"$gte": as_utc(date_from), "$lt": as_utc(date_to)}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неверный формат даты")
+    bounds = {op: value for op, value in bounds.items() if value is not None}
+    return {"created_at": bounds} if bounds else {}
+
 @api_router.get("/admin/users")
-async def get_all_users(user: User = Depends(require_helper_or_admin)):
-    users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
-    return users
+async def get_all_users(
+    response: Response,
+    q: Optional[str] = None,
+    role: Optional[str] = None,
+    skip: int = 0,
+    limit: int = ADMIN_PAGE_LIMIT,
+    view: str = "full",
+    fields: Optional[str] = None,
+    user: User = Depends(require_helper_or_admin)
+):
+    """Users, optionally filtered by role and email/name prefix"""
+    query = {}
+    if role:
+        query["role"] = role
+    if q:
+        # Case-sensitive anchored prefix on the lowercased copies: each $or branch is a bounded
+        # range scan of its (key, created_at, role) index. The page is then a top-k sort over
+        # the prefix matches only, never over the whole collection.
+        prefix = re.compile(f"^{re.escape(q.strip().lower())}")
+        query["$or"] = [{"email_lower": prefix}, {"name_lower": prefix}]
+    return await admin_page(db.users, query, list_projection("users", view, fields), response, skip, limit)
+
+@api_router.get("/admin/users/{user_id}")
+async def get_user_details(user_id: str, user: User = Depends(require_helper_or_admin)):
+    target = await db.users.find_one({"user_id": user_id}, list_projection("users"))
+    if not target:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+    return target
 
 @api_router.put("/admin/users/{user_id}/admin")
 async def toggle_admin(user_id: str, is_admin: bool, user: User = Depends(require_admin)):
@@ -2163,7 +4073,6 @@ async def create_topup_code(data: TopUpCodeCreate, user: User = Depends(require_
     
     code = TopUpCode(**data.model_dump())
     code_dict = code.model_dump()
-    code_dict["created_at"] = code_dict["created_at"].isoformat()
     await db.topup_codes.insert_one(code_dict)
     return code
 
@@ -2226,7 +4135,8 @@ async def update_admin_settings(data: AdminSettingsUpdate, user: User = Depends(
             "ai_auto_approve_enabled": data.ai_auto_approve_enabled,
             "active_theme": data.active_theme,
             "daily_bonus_coins": data.daily_bonus_coins,
-            "daily_bonus_xp": data.daily_bonus_xp
+            "daily_bonus_xp": data.daily_bonus_xp,
+            **({"top_rewards": [r.model_dump() for r in data.top_rewards]} if data.top_rewards is not None else {})
         }},
         upsert=True
     )
@@ -2253,15 +4163,53 @@ async def get_support_contacts():
 
 # Top-up requests management
 @api_router.get("/admin/topup-requests")
-async def get_all_topup_requests(user: User = Depends(require_helper_or_admin)):
-    requests = await db.topup_requests.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    return requests
+async def get_all_topup_requests(
+    response: Response,
+    status: Optional[str] = None,
+    user_id: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    skip: int = 0,
+    limit: int = ADMIN_PAGE_LIMIT,
+    view: str = "full",
+    fields: Optional[str] = None,
+    user: User = Depends(require_helper_or_admin)
+):
+    query = {k: v for k, v in {"status": status, "user_id": user_id}.items() if v}
+    query.update(created_range(date_from, date_to))
+    return await admin_page(db.topup_requests, query, list_projection("topup_requests", view, fields), response, skip, limit)
+
+@api_router.get("/admin/topup-requests/{request_id}")
+async def get_topup_request_details(request_id: str, user: User = Depends(require_helper_or_admin)):
+    req = await db.topup_requests.find_one({"request_id": request_id}, list_projection("topup_requests"))
+    if not req:
+        raise HTTPException(status_code=404, detail="Заявка не найдена")
+    return req
 
 @api_router.get("/admin/withdrawal-requests")
-async def get_all_withdrawal_requests(user: User = Depends(require_helper_or_admin)):
+async def get_all_withdrawal_requests(
+    response: Response,
+    status: Optional[str] = None,
+    user_id: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    skip: int = 0,
+    limit: int = ADMIN_PAGE_LIMIT,
+    view: str = "full",
+    fields: Optional[str] = None,
+    user: User = Depends(require_helper_or_admin)
+):
     """Get all withdrawal requests for admin"""
-    requests = await db.withdrawal_requests.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    return requests
+    query = {k: v for k, v in {"status": status, "user_id": user_id}.items() if v}
+    query.update(created_range(date_from, date_to))
+    return await admin_page(db.withdrawal_requests, query, list_projection("withdrawal_requests", view, fields), response, skip, limit)
+
+@api_router.get("/admin/withdrawal-requests/{request_id}")
+async def get_withdrawal_request_details(request_id: str, user: User = Depends(require_helper_or_admin)):
+    req = await db.withdrawal_requests.find_one({"request_id": request_id}, list_projection("withdrawal_requests"))
+    if not req:
+        raise HTTPException(status_code=404, detail="Заявка не найдена")
+    return req
 
 @api_router.put("/admin/withdrawal-requests/{request_id}/approve")
 async def approve_withdrawal_request(request_id: str, user: User = Depends(require_helper_or_admin)):
@@ -2278,11 +4226,12 @@ async def approve_withdrawal_request(request_id: str, user: User = Depends(requi
         {
             "$set": {
                 "status": "approved",
-                "processed_at": datetime.now(timezone.utc).isoformat(),
+                "processed_at": datetime.now(timezone.utc),
                 "admin_note": f"Одобрено администратором {user.email}"
             }
         }
     )
+    await notify_user(request["user_id"], "withdrawal", request_id=request_id, status="approved", amount=request["amount"])
     
     return {"message": "Заявка одобрена"}
 
@@ -2309,7 +4258,7 @@ async def reject_withdrawal_request(request_id: str, note: str = "Отклоне
         "amount": request["amount"],
         "type": "withdrawal_rejected",
         "description": f"Возврат средств: заявка на вывод {request['amount']} отклонена. Причина: {note}",
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     await db.topup_history.insert_one(history_entry)
     
@@ -2318,11 +4267,12 @@ async def reject_withdrawal_request(request_id: str, note: str = "Отклоне
         {
             "$set": {
                 "status": "rejected",
-                "processed_at": datetime.now(timezone.utc).isoformat(),
+                "processed_at": datetime.now(timezone.utc),
                 "admin_note": note
             }
         }
     )
+    await notify_user(request["user_id"], "withdrawal", request_id=request_id, status="rejected", amount=request["amount"], note=note)
     
     return {"message": "Заявка отклонена, средства возвращены на баланс"}
 
@@ -2333,24 +4283,27 @@ async def approve_topup_request(request_id: str, user: User = Depends(require_he
     if not req:
         raise HTTPException(status_code=404, detail="Request not found")
     
-    if req["status"] != "pending":
+    if req["status"] not in ("pending", "pending_ai"):
         raise HTTPException(status_code=400, detail="Request already processed")
     
-    # Update request status
-    await db.topup_requests.update_one(
-        {"request_id": request_id},
+    # Conditional on the status, so the AI review or another helper can't approve it too
+    result = await db.topup_requests.update_one(
+        {"request_id": request_id, "status": {"$in": ["pending", "pending_ai"]}},
         {"$set": {
             "status": "approved",
-            "processed_at": datetime.now(timezone.utc).isoformat(),
+            "processed_at": datetime.now(timezone.utc),
             "processed_by": user.user_id
         }}
     )
+    if result.modified_count == 0:
+        raise HTTPException(status_code=400, detail="Request already processed")
     
     # Add balance to user atomically
     await db.users.update_one(
         {"user_id": req["user_id"]},
         {"$inc": {"balance": req["amount"]}}
     )
+    await notify_user(req["user_id"], "topup", request_id=request_id, status="approved", amount=req["amount"])
     
     return {"message": "Request approved", "amount": req["amount"]}
 
@@ -2361,17 +4314,20 @@ async def reject_topup_request(request_id: str, note: str = "", user: User = Dep
     if not req:
         raise HTTPException(status_code=404, detail="Request not found")
     
-    if req["status"] != "pending":
+    if req["status"] not in ("pending", "pending_ai"):
         raise HTTPException(status_code=400, detail="Request already processed")
     
-    await db.topup_requests.update_one(
-        {"request_id": request_id},
+    result = await db.topup_requests.update_one(
+        {"request_id": request_id, "status": {"$in": ["pending", "pending_ai"]}},
         {"$set": {
             "status": "rejected",
             "admin_note": note,
-            "processed_at": datetime.now(timezone.utc).isoformat()
+            "processed_at": datetime.now(timezone.utc)
         }}
     )
+    if result.modified_count == 0:
+        raise HTTPException(status_code=400, detail="Request already processed")
+    await notify_user(req["user_id"], "topup", request_id=request_id, status="rejected", amount=req["amount"], note=note)
     
     return {"message": "Request rejected"}
 
@@ -2389,6 +4345,7 @@ async def delete_user(user_id: str, user: User = Depends(require_admin)):
     result = await db.users.delete_one({"user_id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    await bump_store_stats(users_count=-1)
     # Also delete user sessions
     await db.user_sessions.delete_many({"user_id": user_id})
     return {"message": "User deleted"}
@@ -2426,6 +4383,30 @@ async def update_user_xp(user_id: str, xp: int, user: User = Depends(require_adm
         raise HTTPException(status_code=404, detail="User not found")
     return {"message": "XP updated", "new_level": new_level}
 
+LEVEL_RECALC_BATCH_SIZE = 1000
+
+@api_router.post("/admin/users/recalculate-levels")
+async def recalculate_all_levels(user: User = Depends(require_admin)):
+    """Recompute every user's level from XP in vectorized batches"""
+    scanned = 0
+    updated = 0
+    cursor = db.users.find({}, {"_id": 0, "user_id": 1, "xp": 1, "level": 1}).batch_size(LEVEL_RECALC_BATCH_SIZE)
+    while True:
+        batch = await cursor.to_list(LEVEL_RECALC_BATCH_SIZE)
+        if not batch:
+            break
+        scanned += len(batch)
+        levels = calculate_levels_batch([u.get("xp", 0) or 0 for u in batch])
+        ops = [
+            UpdateOne({"user_id": u["user_id"]}, {"$set": {"level": int(level)}})
+            for u, level in zip(batch, levels)
+            if u.get("level") != int(level)
+        ]
+        if ops:
+            await db.users.bulk_write(ops, ordered=False)
+            updated += len(ops)
+    return {"message": "Уровни пересчитаны", "scanned": scanned, "updated": updated}
+
 # Admin profile update (email/password)
 class AdminProfileUpdate(BaseModel):
     email: Optional[EmailStr] = None
@@ -2454,7 +4435,7 @@ async def update_admin_profile(data: AdminProfileUpdate, user: User = Depends(re
     if updates:
         await db.users.update_one(
             {"user_id": user.user_id},
-            {"$set": updates}
+            {"$set": {**updates, **user_search_fields(updates)}}
         )
     
     return {"message": "Profile updated"}
@@ -2506,24 +4487,75 @@ async def update_wheel_prize(prize_id: str, data: WheelPrizeCreate, user: User =
     return {"message": "Prize updated"}
 
 @api_router.get("/admin/orders")
-async def get_all_orders(user: User = Depends(require_staff)):
-    """Helper and admin can view orders"""
-    orders = await db.orders.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    return orders
+async def get_all_orders(
+    response: Response,
+    status: Optional[str] = None,
+    user_id: Optional[str] = None,
+    delivery_user_id: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    min_total: Optional[float] = None,
+    max_total: Optional[float] = None,
+    skip: int = 0,
+    limit: int = ADMIN_PAGE_LIMIT,
+    view: str = "full",
+    fields: Optional[str] = None,
+    expand: bool = False,
+    user: User = Depends(require_staff)
+):
+    """Helper and admin can view orders; expand=true joins buyer, courier and delivery method"""
+    query = {k: v for k, v in {"status": status, "user_id": user_id, "delivery_user_id": delivery_user_id}.items() if v}
+    query.update(created_range(date_from, date_to))
+    total_range = {op: v for op, v in {"$gte": min_total, "$lte": max_total}.items() if v is not None}
+    if total_range:
+        query["total"] = total_range
+    return await admin_page(
+        db.orders, query, list_projection("orders", view, fields), response, skip, limit,
+        lookups=order_lookup_stages() if expand else None
+    )
+
+# Filled in at startup from buildInfo; picks $lookup syntax the connected server supports
+mongo_server = {"version": (0,)}
+
+def lookup_one(collection: str, local_field: str, foreign_field: str, fields: List[str], as_field: str) -> list:
+    """$lookup of a single related document, restricted to `fields` and unwrapped from its array.
+    localField/foreignField equality uses the index on `foreign_field`; a let/$expr match does not before 5.0."""
+    lookup = {"from": collection, "localField": local_field, "foreignField": foreign_field, "as": as_field}
+    if mongo_server["version"] >= (5, 0):
+        # 5.0+ takes a pipeline alongside localField/foreignField, so only `fields` leave the join
+        lookup["pipeline"] = [{"$limit": 1}, {"$project": {"_id": 0, **{field: 1 for field in fields}}}]
+        first = {"$arrayElemAt": [f"${as_field}", 0]}
+    else:
+        # Older servers join whole documents; keep `fields` of the first match
+        first = {"$arrayElemAt": [
+            {"$map": {"input": f"${as_field}", "in": {field: f"$$this.{field}" for field in fields}}}, 0
+        ]}
+    return [{"$lookup": lookup}, {"$set": {as_field: first}}]
+
+def order_lookup_stages() -> list:
+    """Join an order's buyer (public fields), delivery person and delivery method"""
+    return [
+        *lookup_one("users", "user_id", "user_id", list(UserPublic.model_fields), "user_info"),
+        *lookup_one("users", "delivery_user_id", "user_id", ["user_id", "name", "email", "picture"], "delivery_person"),
+        *lookup_one("delivery_methods", "delivery_method_id", "method_id", ["method_id", "name", "cost", "delivery_days"], "delivery_method"),
+    ]
 
 @api_router.get("/admin/orders/{order_id}")
 async def get_order_details(order_id: str, user: User = Depends(require_staff)):
-    """Get detailed order info including user details"""
-    order = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
-    if not order:
+    """Get detailed order info including user, delivery person and delivery method, in one query"""
+    orders = await db.orders.aggregate([
+        {"$match": {"order_id": order_id}},
+        {"$limit": 1},
+        {"$project": {"_id": 0}},
+        *order_lookup_stages()
+    ]).to_list(1)
+    if not orders:
         raise HTTPException(status_code=404, detail="Заказ не найден")
+    order = orders[0]
     
-    # Get user info (public fields only)
-    order_user = await db.users.find_one({"user_id": order["user_id"]}, {"_id": 0})
-    if order_user:
-        # Filter to return only necessary public info
-        public_user = UserPublic(**order_user).model_dump()
-        order["user_info"] = public_user
+    if order.get("user_info"):
+        # Normalize to the public user shape (defaults for missing fields)
+        order["user_info"] = UserPublic(**order["user_info"]).model_dump()
     
     return order
 
@@ -2541,14 +4573,14 @@ async def update_order_status(order_id: str, data: OrderStatusUpdate, user: User
     # Create status history entry
     status_entry = {
         "status": data.status,
-        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "timestamp": datetime.now(timezone.utc),
         "note": data.note or get_status_note(data.status),
         "updated_by": user.email
     }
     
     update_data = {
         "status": data.status,
-        "updated_at": datetime.now(timezone.utc).isoformat()
+        "updated_at": datetime.now(timezone.utc)
     }
     
     if data.tracking_number:
@@ -2564,6 +4596,7 @@ async def update_order_status(order_id: str, data: OrderStatusUpdate, user: User
             "$push": {"status_history": status_entry}
         }
     )
+    await notify_user(order["user_id"], "order", order_id=order_id, status=data.status, status_entry=status_entry)
     
     return {"message": f"Статус изменён на: {data.status}", "new_status": data.status}
 
@@ -2607,9 +4640,7 @@ async def request_order_return(order_id: str, user: User = Depends(require_user)
         raise HTTPException(status_code=400, detail="Заказ уже возвращен, ожидает возврата или отменен")
     
     # Check 24 hours limit
-    created_at = order.get("created_at")
-    if isinstance(created_at, str):
-        created_at = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
+    created_at = as_utc(order.get("created_at"))
     
     now = datetime.now(timezone.utc)
     if now - created_at > timedelta(hours=24):
@@ -2618,7 +4649,7 @@ async def request_order_return(order_id: str, user: User = Depends(require_user)
     # Update order status to return_pending
     status_entry = {
         "status": "return_pending",
-        "timestamp": now.isoformat(),
+        "timestamp": now,
         "note": "Пользователь запросил возврат товара. Ожидается одобрение администратора."
     }
     
@@ -2627,7 +4658,7 @@ async def request_order_return(order_id: str, user: User = Depends(require_user)
         {
             "$set": {
                 "status": "return_pending",
-                "updated_at": now.isoformat()
+                "updated_at": now
             },
             "$push": {"status_history": status_entry}
         }
@@ -2653,32 +4684,39 @@ async def approve_order_return(order_id: str, user: User = Depends(require_admin
     refund_amount = round(total_spent * 0.9, 2)
     order_user_id = order.get("user_id")
     
-    # Update user balance
-    await db.users.update_one(
-        {"user_id": order_user_id},
-        {"$inc": {"balance": refund_amount}}
-    )
-    
-    # Update order status to returned
+    # Update order status to returned; the status guard makes the refund happen once
     now = datetime.now(timezone.utc)
     status_entry = {
         "status": "returned",
-        "timestamp": now.isoformat(),
+        "timestamp": now,
         "note": f"Возврат одобрен администратором ({user.email}). Возвращено 90% средств ({refund_amount}) на счет пользователя.",
         "updated_by": user.email
     }
     
-    await db.orders.update_one(
-        {"order_id": order_id},
+    result = await db.orders.update_one(
+        {"order_id": order_id, "status": "return_pending"},
         {
             "$set": {
                 "status": "returned",
-                "updated_at": now.isoformat(),
+                "updated_at": now,
                 "refund_amount": refund_amount
             },
             "$push": {"status_history": status_entry}
         }
     )
+    if result.modified_count == 0:
+        raise HTTPException(status_code=400, detail="Заказ не находится в статусе ожидания возврата")
+    
+    # Update user balance
+    await db.users.update_one(
+        {"user_id": order_user_id},
+        {"$inc": {"balance": refund_amount}}
+    )
+    await asyncio.gather(
+        bump_store_stats(refunded=refund_amount),
+        bump_sales_rollups(now, {"refunded": refund_amount, "returns_count": 1}),
+        notify_user(order_user_id, "order", order_id=order_id, status="returned", status_entry=status_entry, refund_amount=refund_amount)
+    )
     
     return {
         "message": "Возврат одобрен, средства возвращены пользователю",
@@ -2689,9 +4727,17 @@ async def approve_order_return(order_id: str, user: User = Depends(require_admin
 @api_router.delete("/admin/orders/{order_id}")
 async def delete_order(order_id: str, user: User = Depends(require_admin)):
     """Admin deletes an order"""
-    result = await db.orders.delete_one({"order_id": order_id})
-    if result.deleted_count == 0:
+    order = await db.orders.find_one_and_delete(
+        {"order_id": order_id},
+        projection={"_id": 0, "total": 1, "refund_amount": 1}
+    )
+    if not order:
         raise HTTPException(status_code=404, detail="Заказ не найден")
+    await bump_store_stats(
+        orders_count=-1,
+        gross_revenue=-order.get("total", 0),
+        refunded=-order.get("refund_amount", 0)
+    )
     
     return {"message": "Заказ успешно удален"}
 
@@ -2717,7 +4763,6 @@ async def create_bank_card(data: BankCardCreate, user: User = Depends(require_ad
         bank_name=data.bank_name
     )
     card_dict = card.model_dump()
-    card_dict["created_at"] = card_dict["created_at"].isoformat()
     await db.bank_cards.insert_one(card_dict)
     card_dict.pop("_id", None)
     return card_dict
@@ -2800,7 +4845,7 @@ async def take_delivery_order(order_id: str, user: User = Depends(require_delive
     now = datetime.now(timezone.utc)
     status_entry = {
         "status": "processing",
-        "timestamp": now.isoformat(),
+        "timestamp": now,
         "note": f"Заказ принят доставщиком: {user.name}",
         "updated_by": user.email
     }
@@ -2818,7 +4863,7 @@ async def take_delivery_order(order_id: str, user: User = Depends(require_delive
             "$set": {
                 "delivery_user_id": user.user_id,
                 "status": "processing",
-                "updated_at": now.isoformat()
+                "updated_at": now
             },
             "$push": {"status_history": status_entry}
         }
@@ -2872,7 +4917,6 @@ async def create_tag(data: TagCreate, user: User = Depends(require_helper_or_adm
     
     tag = Tag(name=data.name, slug=data.slug, color=data.color)
     tag_dict = tag.model_dump()
-    tag_dict["created_at"] = tag_dict["created_at"].isoformat()
     await db.tags.insert_one(tag_dict)
     tag_dict.pop("_id", None)
     return tag_dict
@@ -2911,7 +4955,7 @@ async def get_missions(user: User = Depends(require_user)):
     
     # Get user's progress on missions
     user_missions = await db.user_missions.find(
-        {"user_id": user.user_id}, {"_id": 0}
+        {"user_id": user.user_id}, {"_id": 0, "applied_jobs": 0}
     ).to_list(100)
     user_progress = {um["mission_id"]: um for um in user_missions}
     
@@ -2968,12 +5012,12 @@ async def claim_mission_reward(mission_id: str, user: User = Depends(require_use
     update_ops = {}
     if reward_type == "coins":
         update_ops = {"$inc": {"balance": reward_value}}
-    elif reward_type == "xp":
-        update_ops = {"$inc": {"xp": int(reward_value)}}
     elif reward_type == "spin":
         update_ops = {"$inc": {"wheel_spins_available": int(reward_value)}}
     
-    if update_ops:
+    if reward_type == "xp":
+        await grant_xp(user, int(reward_value), "mission", apply_multiplier=False)
+    elif update_ops:
         await db.users.update_one({"user_id": user.user_id}, update_ops)
     
     return {"message": "Награда получена!", "reward_type": reward_type, "reward_value": reward_value}
@@ -2995,14 +5039,15 @@ async def create_mission(data: MissionCreate, user: User = Depends(require_helpe
         min_level=data.min_level
     )
     if data.expires_at:
-        mission.expires_at = datetime.fromisoformat(data.expires_at)
+        try:
+            mission.expires_at = as_utc(data.expires_at)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Неверный формат даты")
     
     mission_dict = mission.model_dump()
-    mission_dict["created_at"] = mission_dict["created_at"].isoformat()
-    if mission_dict.get("expires_at"):
-        mission_dict["expires_at"] = mission_dict["expires_at"].isoformat()
     
     await db.missions.insert_one(mission_dict)
+    active_missions_cache.invalidate()
     mission_dict.pop("_id", None)
     return mission_dict
 
@@ -3011,6 +5056,7 @@ async def delete_mission(mission_id: str, user: User = Depends(require_helper_or
     result = await db.missions.delete_one({"mission_id": mission_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Mission not found")
+    active_missions_cache.invalidate()
     return {"message": "Mission deleted"}
 
 @api_router.put("/admin/missions/{mission_id}")
@@ -3018,9 +5064,9 @@ async def update_mission(mission_id: str, data: MissionCreate, user: User = Depe
     mission_dict = data.model_dump()
     if mission_dict.get("expires_at"):
         try:
-            mission_dict["expires_at"] = datetime.fromisoformat(mission_dict["expires_at"]).isoformat()
-        except:
-            pass
+            mission_dict["expires_at"] = as_utc(mission_dict["expires_at"])
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Неверный формат даты")
     
     result = await db.missions.update_one(
         {"mission_id": mission_id},
@@ -3028,6 +5074,7 @@ async def update_mission(mission_id: str, data: MissionCreate, user: User = Depe
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Mission not found")
+    active_missions_cache.invalidate()
     return {"message": "Mission updated"}
 @api_router.put("/admin/missions/{mission_id}/toggle")
 async def toggle_mission(mission_id: str, user: User = Depends(require_helper_or_admin)):
@@ -3037,54 +5084,85 @@ async def toggle_mission(mission_id: str, user: User = Depends(require_helper_or
     
     new_status = not mission.get("is_active", True)
     await db.missions.update_one({"mission_id": mission_id}, {"$set": {"is_active": new_status}})
+    active_missions_cache.invalidate()
     return {"message": "Статус изменён", "is_active": new_status}
 
-# Helper to update mission progress
-async def update_mission_progress(user_id: str, mission_type: str, value: float):
-    """Update user's mission progress based on action type"""
-    # Get user to check level
-    user = await db.users.find_one({"user_id": user_id})
-    if not user:
-        return
+# Active missions grouped by mission_type; invalidated on every admin change
+active_missions_cache = TTLCache(ttl=60)
+
+async def get_active_missions_by_type() -> Dict[str, List[dict]]:
+    table = active_missions_cache.get("by_type")
+    if table is None:
+        missions = await db.missions.find(
+            {"is_active": True},
+            {"_id": 0, "mission_id": 1, "mission_type": 1, "target_value": 1, "min_level": 1}
+        ).to_list(1000)
+        table = defaultdict(list)
+        for mission in missions:
+            table[mission["mission_type"]].append(mission)
+        active_missions_cache.set("by_type", table)
+    return table
+
+def mission_progress_pipeline(value: float, target: float, job_id: Optional[str] = None) -> List[dict]:
+    """Add progress unless completed; completion only ever flips to True.
+    With `job_id` the update is remembered so a retried job doesn't add it twice."""
+    now = datetime.now(timezone.utc)
+    applied = {}
+    if job_id:
+        applied["applied_jobs"] = {"$slice": [
+            {"$concatArrays": [{"$ifNull": ["$applied_jobs", []]}, [job_id]]},
+            -APPLIED_JOBS_KEPT
+        ]}
+    return [
+        {"$set": {
+            **applied,
+            "user_mission_id": {"$ifNull": ["$user_mission_id", f"um_{uuid.uuid4().hex[:12]}"]},
+            "progress": {"$cond": [
+                {"$eq": ["$is_completed", True]},
+                "$progress",
+                {"$add": [{"$ifNull": ["$progress", 0]}, value]}
+            ]},
+            "is_claimed": {"$ifNull": ["$is_claimed", False]},
+            "created_at": {"$ifNull": ["$created_at", now]}
+        }},
+        {"$set": {
+            "is_completed": {"$or": [{"$eq": ["$is_completed", True]}, {"$gte": ["$progress", target]}]},
+            "completed_at": {"$cond": [
+                {"$and": [{"$ne": ["$is_completed", True]}, {"$gte": ["$progress", target]}]},
+                now,
+                "$completed_at"
+            ]}
+        }}
+    ]
 
-    missions = await db.missions.find({
-        "is_active": True,
-        "mission_type": mission_type,
-        "$or": [
-            {"min_level": {"$lte": user.get("level", 1)}},
-            {"min_level": {"$exists": False}}
-        ]
-    }, {"_id": 0}).to_list(100)
-    
-    for mission in missions:
-        # Get or create user mission progress
-        user_mission = await db.user_missions.find_one({
-            "user_id": user_id,
-            "mission_id": mission["mission_id"]
-        }, {"_id": 0})
-        
-        if user_mission and user_mission.get("is_completed"):
-            continue  # Already completed
-        
-        # Update progress atomically using $inc
-        # Note: We can't easily check for completion in the same atomic op without $cond or similar
-        # But we can update progress and then check if it's completed in a separate step or use a find_one_and_update
-        
-        result = await db.user_missions.find_one_and_update(
-            {"user_id": user_id, "mission_id": mission["mission_id"]},
-            {"$inc": {"progress": value}},
-            upsert=True,
-            return_document=True
-        )
-        
-        if result and not result.get("is_completed") and result.get("progress", 0) >= mission["target_value"]:
-            await db.user_missions.update_one(
-                {"user_id": user_id, "mission_id": mission["mission_id"]},
-                {"$set": {
-                    "is_completed": True,
-                    "completed_at": datetime.now(timezone.utc).isoformat()
-                }}
-            )
+async def update_mission_progress(user_id: str, progress: Dict[str, float], user_level: int, job_id: Optional[str] = None):
+    """Apply progress for several mission types (e.g. {"purchase": 1, "spend_amount": 250})
+    to every matching active mission in a single bulk write"""
+    table = await get_active_missions_by_type()
+    ops = []
+    for mission_type, value in progress.items():
+        for mission in table.get(mission_type, []):
+            if mission.get("min_level", 1) > user_level:
+                continue
+            query = {"user_id": user_id, "mission_id": mission["mission_id"]}
+            if job_id:
+                query["applied_jobs"] = {"$ne": job_id}
+            ops.append(UpdateOne(
+                query,
+                mission_progress_pipeline(value, mission["target_value"], job_id),
+                upsert=True
+            ))
+    if ops:
+        try:
+            await db.user_missions.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            # Already applied by an earlier attempt: the upsert hits the unique (user_id, mission_id) index
+            if not only_duplicate_keys(e):
+                raise
+
+@job_queue.handler("mission_progress")
+async def run_mission_progress(payload: dict):
+    await update_mission_progress(payload["user_id"], payload["progress"], payload["user_level"], job_id=payload["job_id"])
 
 # ==================== SUPPORT API ====================
 
@@ -3109,7 +5187,6 @@ async def create_support_ticket(data: SupportTicketCreate, request: Request):
         message=data.message
     )
     ticket_dict = ticket.model_dump()
-    ticket_dict["created_at"] = ticket_dict["created_at"].isoformat()
     await db.support_tickets.insert_one(ticket_dict)
     ticket_dict.pop("_id", None)
     return {"message": "Заявка отправлена! Мы ответим в ближайшее время.", "ticket_id": ticket_dict["ticket_id"]}
@@ -3122,9 +5199,15 @@ async def get_user_tickets(user: User = Depends(require_user)):
     return tickets
 
 @api_router.get("/admin/support/tickets")
-async def get_all_tickets(user: User = Depends(require_helper_or_admin)):
-    tickets = await db.support_tickets.find({}, {"_id": 0}).sort("created_at", -1).to_list(100)
-    return tickets
+async def get_all_tickets(
+    response: Response,
+    status: Optional[str] = None,
+    skip: int = 0,
+    limit: int = ADMIN_PAGE_LIMIT,
+    user: User = Depends(require_helper_or_admin)
+):
+    query = {"status": status} if status else {}
+    return await admin_page(db.support_tickets, query, {"_id": 0}, response, skip, limit)
 
 @api_router.put("/admin/support/tickets/{ticket_id}")
 async def respond_to_ticket(ticket_id: str, response: str, status: str = "resolved", user: User = Depends(require_helper_or_admin)):
@@ -3141,15 +5224,9 @@ async def respond_to_ticket(ticket_id: str, response: str, status: str = "resolv
 
 @api_router.post("/user/daily-bonus")
 async def claim_daily_bonus(user: User = Depends(require_user)):
-    user_data = await db.users.find_one({"user_id": user.user_id})
-    
-    last_claim = user_data.get("last_bonus_claim")
+    # require_user already loaded the user document
+    last_claim = as_utc(user.last_bonus_claim)
     if last_claim:
-        if isinstance(last_claim, str):
-            last_claim = datetime.fromisoformat(last_claim)
-        if last_claim.tzinfo is None:
-            last_claim = last_claim.replace(tzinfo=timezone.utc)
-            
         if datetime.now(timezone.utc) - last_claim < timedelta(hours=24):
             time_left = timedelta(hours=24) - (datetime.now(timezone.utc) - last_claim)
             hours, remainder = divmod(time_left.seconds, 3600)
@@ -3157,52 +5234,28 @@ async def claim_daily_bonus(user: User = Depends(require_user)):
             raise HTTPException(status_code=400, detail=f"Бонус будет доступен через {hours}ч {minutes}м")
     
     settings = await db.admin_settings.find_one({"settings_id": "admin_settings"})
-    user_level = user_data.get("level", 1)
+    user_level = user.level
     coins = (settings.get("daily_bonus_coins", 10.0) if settings else 10.0) * user_level
     xp = (settings.get("daily_bonus_xp", 50) if settings else 50) * user_level
     
-    # Check for XP multiplier
-    xp_multiplier = 1
-    xp_expires = user.xp_multiplier_expires_at
-    if xp_expires:
-        if xp_expires.tzinfo is None:
-            xp_expires = xp_expires.replace(tzinfo=timezone.utc)
-        if xp_expires > datetime.now(timezone.utc):
-            xp_multiplier = 2
-            
-    actual_xp = xp * xp_multiplier
-    
-    await db.users.update_one(
-        {"user_id": user.user_id},
-        {
-            "$inc": {"balance": coins, "xp": actual_xp},
-            "$set": {"last_bonus_claim": datetime.now(timezone.utc).isoformat()}
-        }
+    # Coins, XP (with multiplier), level-up and achievements in one atomic update
+    await grant_xp(
+        user, int(xp), "daily_bonus",
+        inc={"balance": coins},
+        set_fields={"last_bonus_claim": datetime.now(timezone.utc)}
     )
     
-    # Recalculate level
-    updated_user = await db.users.find_one({"user_id": user.user_id})
-    new_level = calculate_level(updated_user["xp"])
-    if new_level > updated_user["level"]:
-        multiplier_expiry = datetime.now(timezone.utc) + timedelta(days=30)
-        await db.users.update_one(
-            {"user_id": user.user_id}, 
-            {"$set": {
-                "level": new_level,
-                "xp_multiplier_expires_at": multiplier_expiry.isoformat()
-            }}
-        )
-        await log_activity(user.user_id, user.name, "level_up", f"достиг {new_level} уровня!")
-    
-    await check_achievements(user.user_id)
-    
     return {"message": "Ежедневный бонус получен!", "coins": coins, "xp": xp}
 
+LEADERBOARD_FILTER = {"is_admin": False, "role": {"$ne": "admin"}}
+LEADERBOARD_PROJECTION = {"user_id": 1, "name": 1, "picture": 1, "xp": 1, "level": 1, "_id": 0}
+LEADERBOARD_MAX_PAGE_SIZE = 100
+
 @api_router.get("/leaderboard")
 async def get_leaderboard():
     users = await db.users.find(
-        {"is_admin": False, "role": {"$ne": "admin"}}, 
-        {"user_id": 1, "name": 1, "picture": 1, "xp": 1, "level": 1, "_id": 0}
+        LEADERBOARD_FILTER,
+        LEADERBOARD_PROJECTION
     ).sort("xp", -1).limit(10).to_list(10)
     
     # Add top rewards info
@@ -3215,41 +5268,349 @@ async def get_leaderboard():
         reward = next((r for r in top_rewards if r.get("rank") == rank), None)
         if reward:
             user["top_reward"] = reward
-            
+
     return users
 
+@api_router.get("/leaderboard/all")
+async def get_full_leaderboard(skip: int = 0, limit: int = 50):
+    """Paginated full leaderboard, served from the (is_admin, xp, user_id) index"""
+    skip = max(skip, 0)
+    limit = max(1, min(limit, LEADERBOARD_MAX_PAGE_SIZE))
+
+    users, total = await asyncio.gather(
+        db.users.find(LEADERBOARD_FILTER, LEADERBOARD_PROJECTION)
+            .sort([("xp", -1), ("user_id", 1)])
+            .skip(skip)
+            .limit(limit)
+            .to_list(limit),
+        db.users.count_documents(LEADERBOARD_FILTER)
+    )
+
+    for i, entry in enumerate(users):
+        entry["rank"] = skip + i + 1
+
+    return {"items": users, "total": total, "skip": skip, "limit": limit}
+
+@api_router.get("/leaderboard/rank/{user_id}")
+async def get_leaderboard_rank(user_id: str):
+    """Position of a single user in the leaderboard without loading other users"""
+    user_data = await db.users.find_one({"user_id": user_id}, {**LEADERBOARD_PROJECTION, "is_admin": 1, "role": 1})
+    if not user_data:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+
+    is_admin = user_data.pop("is_admin", False)
+    role = user_data.pop("role", None)
+    if is_admin or role == "admin":
+        # Admins are not ranked
+        return {**user_data, "rank": None}
+
+    xp = user_data.get("xp", 0)
+    # Same ordering as /leaderboard/all: xp desc, then user_id asc for ties
+    ahead = await db.users.count_documents({
+        **LEADERBOARD_FILTER,
+        "$or": [
+            {"xp": {"$gt": xp}},
+            {"xp": xp, "user_id": {"$lt": user_id}}
+        ]
+    })
+    return {**user_data, "rank": ahead + 1}
+
+# ==================== SEASONAL LEADERBOARDS ====================
+
+SEASON_CHECK_INTERVAL = 3600  # seconds
+
+def validate_season_period(period: str) -> str:
+    if period not in SEASON_PERIODS:
+        raise HTTPException(status_code=400, detail=f"Неверный период. Доступны: {', '.join(SEASON_PERIODS)}")
+    return period
+
+@api_router.get("/leaderboard/season/{period}")
+async def get_season_leaderboard(period: str, season: Optional[str] = None, limit: int = 10):
+    """Weekly/monthly leaderboard built from per-season XP rollups"""
+    validate_season_period(period)
+    season = season or season_key(period, datetime.now(timezone.utc))
+    limit = max(1, min(limit, LEADERBOARD_MAX_PAGE_SIZE))
+
+    entries = await db.xp_rollups.find(
+        {"period": period, "season": season},
+        {"_id": 0, "user_id": 1, "name": 1, "picture": 1, "xp": 1}
+    ).sort([("xp", -1), ("user_id", 1)]).limit(limit).to_list(limit)
+
+    settings = await db.admin_settings.find_one({"settings_id": "admin_settings"})
+    top_rewards = settings.get("top_rewards", []) if settings else []
+
+    for i, entry in enumerate(entries):
+        entry["rank"] = i + 1
+        reward = next((r for r in top_rewards if r.get("rank") == i + 1), None)
+        if reward:
+            entry["top_reward"] = reward
+
+    return {"period": period, "season": season, "items": entries}
+
+SEASON_CLOSE_LEASE = timedelta(minutes=10)
+
+async def claim_season_close(period: str, season: str, now: datetime) -> Optional[dict]:
+    """Take the (period, season) close: insert the "closing" marker, or take over one left
+    behind by a run that crashed more than SEASON_CLOSE_LEASE ago. None if closed or in progress."""
+    marker = {"period": period, "season": season, "status": "closing", "created_at": now, "closing_started_at": now}
+    try:
+        # Unique (period, season) marker makes closing idempotent across restarts/workers
+        await db.seasons.insert_one(marker)
+        return marker
+    except DuplicateKeyError:
+        stale = now - SEASON_CLOSE_LEASE
+        return await db.seasons.find_one_and_update(
+            {
+                "period": period,
+                "season": season,
+                "status": "closing",
+                "$or": [{"closing_started_at": {"$lt": stale}}, {"closing_started_at": {"$exists": False}}]
+            },
+            {"$set": {"closing_started_at": now}},
+            return_document=ReturnDocument.AFTER
+        )
+
+async def close_season(period: str, season: str) -> Optional[dict]:
+    """Close a season once and pay top_rewards to its top 10 in one bulk write.
+    Returns None if the season was already closed (or is being closed right now).
+
+    closing -> closed: winners are stored on the marker before anything is paid, and each
+    payout is skipped for users already holding the season in season_rewards, so a resumed
+    close pays everyone exactly once."""
+    now = datetime.now(timezone.utc)
+    marker = await claim_season_close(period, season, now)
+    if not marker:
+        return None
+
+    winners = marker.get("winners")
+    if winners is None:
+        top = await db.xp_rollups.find(
+            {"period": period, "season": season},
+            {"_id": 0, "user_id": 1, "name": 1, "xp": 1}
+        ).sort([("xp", -1), ("user_id", 1)]).limit(10).to_list(10)
+
+        settings = await db.admin_settings.find_one({"settings_id": "admin_settings"})
+        top_rewards = {r.get("rank"): r for r in (settings.get("top_rewards", []) if settings else [])}
+
+        winners = []
+        for i, entry in enumerate(top):
+            rank = i + 1
+            reward = top_rewards.get(rank) or {}
+            winners.append({
+                **entry,
+                "rank": rank,
+                "coins": reward.get("coins", 0) or 0,
+                "reward_xp": int(reward.get("xp", 0) or 0)
+            })
+        await db.seasons.update_one({"period": period, "season": season}, {"$set": {"winners": winners}})
+
+    reward_key = f"{period}:{season}"
+    payouts = [
+        # Same pipeline as grant_xp, so reward XP levels winners up immediately
+        UpdateOne(
+            {"user_id": w["user_id"], "season_rewards": {"$ne": reward_key}},
+            build_xp_grant_pipeline(
+                w["reward_xp"],
+                apply_multiplier=False,
+                inc={"balance": w["coins"]},
+                push={"season_rewards": reward_key}
+            )
+        )
+        for w in winners if w["coins"] or w["reward_xp"]
+    ]
+    if payouts:
+        await db.users.bulk_write(payouts, ordered=False)
+
+    await db.seasons.update_one(
+        {"period": period, "season": season},
+        {"$set": {"status": "closed", "closed_at": datetime.now(timezone.utc)}}
+    )
+    return {"period": period, "season": season, "winners": winners}
+
+async def unclosed_past_seasons(period: str, now: datetime) -> List[str]:
+    """Finished seasons that have XP rollups but no closed marker, oldest first.
+    Covers seasons missed while the scheduler was down for more than one period."""
+    current = season_key(period, now)
+    seasons, closed = await asyncio.gather(
+        db.xp_rollups.distinct("season", {"period": period, "season": {"$lt": current}}),
+        db.seasons.distinct("season", {"period": period, "status": "closed"})
+    )
+    return sorted(set(seasons) - set(closed))
+
+async def season_scheduler():
+    """Close every finished weekly/monthly season as soon as it is over"""
+    while True:
+        now = datetime.now(timezone.utc)
+        for period in SEASON_PERIODS:
+            try:
+                for season in await unclosed_past_seasons(period, now):
+                    closed = await close_season(period, season)
+                    if closed:
+                        logging.info(f"Season {period} {closed['season']} closed, {len(closed['winners'])} winners")
+            except Exception as e:
+                logging.error(f"Failed to close {period} season: {str(e)}")
+        await asyncio.sleep(SEASON_CHECK_INTERVAL)
+
+@api_router.get("/admin/seasons")
+async def get_closed_seasons(user: User = Depends(require_admin)):
+    seasons = await db.seasons.find({}, {"_id": 0}).sort("created_at", -1).to_list(100)
+    return seasons
+
+@api_router.post("/admin/seasons/{period}/close")
+async def close_season_now(period: str, season: Optional[str] = None, user: User = Depends(require_admin)):
+    """Admin: close a finished season manually (defaults to the previous one) and pay out rewards"""
+    validate_season_period(period)
+    now = datetime.now(timezone.utc)
+    season = season or previous_season_key(period, now)
+    if not SEASON_KEY_PATTERNS[period].match(season):
+        example = "2026-W03" if period == "weekly" else "2026-01"
+        raise HTTPException(status_code=400, detail=f"Неверный ключ сезона, пример: {example}")
+    # Keys are zero-padded ("2026-W03", "2026-01"), so they compare in time order
+    if season >= season_key(period, now):
+        raise HTTPException(status_code=400, detail="Сезон ещё не завершён")
+    result = await close_season(period, season)
+    if not result:
+        raise HTTPException(status_code=400, detail="Сезон уже закрыт")
+    return result
+
+# The feed is only ever read as "latest entries". With EVENT_RELAY on, reads come from an
+# in-memory tail fed by the event hub with every worker's entries; without it a worker only
+# sees its own, so reads go to the collection behind a short cache. Writes are batched, and
+# entries older than the retention window move to activity_feed_archive.
+ACTIVITY_TAIL_SIZE = 100
+ACTIVITY_FEED_LIMIT = 20
+ACTIVITY_RETENTION_DAYS = int(os.environ.get("ACTIVITY_RETENTION_DAYS", 30))
+ACTIVITY_ARCHIVE_INTERVAL = 3600  # seconds
+ACTIVITY_ARCHIVE_BATCH = 500
+
+activity_writer = BatchWriter(db.activity_feed, interval=1.0, max_batch=200)
+activity_tail: deque = deque(maxlen=ACTIVITY_TAIL_SIZE)  # oldest first
+activity_feed_cache = TTLCache(ttl=2, max_entries=1)
+
+async def activity_tail_feeder():
+    """Load the latest entries, then keep the tail current from the event hub"""
+    subscription = event_hub.subscribe(ACTIVITY_TOPIC)
+    try:
+        recent = await db.activity_feed.find({}, {"_id": 0}).sort("created_at", -1).limit(ACTIVITY_TAIL_SIZE).to_list(ACTIVITY_TAIL_SIZE)
+        activity_tail.extend(reversed(recent))
+        while True:
+            activity = await subscription.get(SSE_HEARTBEAT_INTERVAL)
+            if activity is EventHub.CLOSED:
+                return
+            if activity is None:
+                continue
+            # Entries published while the tail was loading may already be in it
+            if any(a["activity_id"] == activity["activity_id"] for a in activity_tail):
+                continue
+            activity_tail.append(activity)
+    finally:
+        event_hub.unsubscribe(subscription)
+
+async def archive_activity_feed() -> int:
+    """Move entries past the retention window to activity_feed_archive"""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=ACTIVITY_RETENTION_DAYS)
+    moved = 0
+    while True:
+        batch = await db.activity_feed.find({"created_at": {"$lt": cutoff}}).sort("created_at", 1).limit(ACTIVITY_ARCHIVE_BATCH).to_list(ACTIVITY_ARCHIVE_BATCH)
+        if not batch:
+            return moved
+        # Upserts by _id keep a retry after a partial run from duplicating entries
+        await db.activity_feed_archive.bulk_write(
+            [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in batch],
+            ordered=False
+        )
+        await db.activity_feed.delete_many({"_id": {"$in": [doc["_id"] for doc in batch]}})
+        moved += len(batch)
+
+async def activity_archiver():
+    while True:
+        try:
+            moved = await archive_activity_feed()
+            if moved:
+                logging.info(f"Archived {moved} activity feed entries")
+        except Exception as e:
+            logging.error(f"Activity feed archival failed: {str(e)}")
+        await asyncio.sleep(ACTIVITY_ARCHIVE_INTERVAL)
+
 @api_router.get("/activity-feed")
 async def get_activity_feed():
-    activities = await db.activity_feed.find({}, {"_id": 0}).sort("created_at", -1).limit(20).to_list(20)
-    return activities
+    if event_hub.relay is not None:
+        return [activity_tail[-i] for i in range(1, min(ACTIVITY_FEED_LIMIT, len(activity_tail)) + 1)]
+    feed = activity_feed_cache.get("latest")
+    if feed is None:
+        feed = await db.activity_feed.find({}, {"_id": 0}).sort("created_at", -1).limit(ACTIVITY_FEED_LIMIT).to_list(ACTIVITY_FEED_LIMIT)
+        activity_feed_cache.set("latest", feed)
+    return feed
+
+STREAM_TICKET_TTL = timedelta(seconds=60)
+
+@api_router.post("/events/ticket")
+async def create_stream_ticket(user: User = Depends(require_user)):
+    """Single-use ticket for opening /events/stream. EventSource cannot send headers, so
+    without cookies the credential ends up in the URL (and in access logs); a ticket
+    there is only good for one stream connection within a minute."""
+    ticket = secrets.token_urlsafe(32)
+    await db.stream_tickets.insert_one({
+        "ticket": ticket,
+        "user_id": user.user_id,
+        "expires_at": datetime.now(timezone.utc) + STREAM_TICKET_TTL
+    })
+    return {"ticket": ticket, "expires_in": int(STREAM_TICKET_TTL.total_seconds())}
+
+async def redeem_stream_ticket(ticket: Optional[str]) -> Optional[str]:
+    """user_id of a valid ticket, consumed on use"""
+    if not ticket:
+        return None
+    doc = await db.stream_tickets.find_one_and_delete({"ticket": ticket})
+    if not doc or as_utc(doc["expires_at"]) < datetime.now(timezone.utc):
+        return None
+    return doc["user_id"]
+
+@api_router.get("/events/stream")
+async def stream_user_events(request: Request, ticket: Optional[str] = None):
+    """The current user's notifications (top-ups, withdrawals, orders) as server-sent events.
+    Authenticated by the session cookie/header, or by a ticket from POST /events/ticket."""
+    user = await user_for_session(request_session_token(request))
+    user_id = user.user_id if user else await redeem_stream_ticket(ticket)
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return event_stream(request, event_hub.subscribe(user_topic(user_id)))
+
+@api_router.get("/activity-feed/stream")
+async def stream_activity_feed(request: Request):
+    """New activity entries as server-sent events; load the initial list from /activity-feed"""
+    return event_stream(request, event_hub.subscribe(ACTIVITY_TOPIC))
 
 @api_router.post("/reviews/{review_id}/sparkle")
 async def sparkle_review(review_id: str, user: User = Depends(require_user)):
-    existing = await db.review_likes.find_one({"user_id": user.user_id, "review_id": review_id})
-    if existing:
+    # The unique (user_id, review_id) index makes the toggle atomic: a second insert
+    # for the same pair fails, and that failure is what turns the sparkle off
+    try:
+        await db.review_likes.insert_one({
+            "user_id": user.user_id,
+            "review_id": review_id,
+            "created_at": datetime.now(timezone.utc)
+        })
+        sparkled = True
+    except DuplicateKeyError:
+        result = await db.review_likes.delete_one({"user_id": user.user_id, "review_id": review_id})
+        if not result.deleted_count:
+            # A concurrent toggle already removed it
+            review = await db.reviews.find_one({"review_id": review_id}, {"_id": 0, "sparkles": 1})
+            return {"sparkled": False, "sparkles": (review or {}).get("sparkles", 0)}
+        sparkled = False
+
+    review = await db.reviews.find_one_and_update(
+        {"review_id": review_id},
+        {"$inc": {"sparkles": 1 if sparkled else -1}},
+        projection={"_id": 0, "sparkles": 1, "product_id": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not review:
         await db.review_likes.delete_one({"user_id": user.user_id, "review_id": review_id})
-        return {"sparkled": False}
-    
-    await db.review_likes.insert_one({
-        "user_id": user.user_id,
-        "review_id": review_id,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    })
-    return {"sparkled": True}
-
-@api_router.get("/reviews/{product_id}")
-async def get_product_reviews(product_id: str, user: Optional[User] = Depends(get_current_user)):
-    reviews = await db.reviews.find({"product_id": product_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
-    
-    # Add sparkle counts and user status
-    for review in reviews:
-        review["sparkles"] = await db.review_likes.count_documents({"review_id": review["review_id"]})
-        if user:
-            review["is_sparkled"] = await db.review_likes.find_one({"user_id": user.user_id, "review_id": review["review_id"]}) is not None
-        else:
-            review["is_sparkled"] = False
-            
-    return reviews
+        raise HTTPException(status_code=404, detail="Отзыв не найден")
+    review_pages_cache.invalidate(review["product_id"])
+    return {"sparkled": sparkled, "sparkles": review["sparkles"]}
 
 @api_router.get("/user/profile/{user_id}")
 async def get_public_profile(user_id: str):
@@ -3260,6 +5621,289 @@ async def get_public_profile(user_id: str):
     if not user_data:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
     return user_data
+
+# ==================== EXPIRY SWEEPER ====================
+
+EXPIRY_SWEEP_INTERVAL = 300  # seconds
+
+async def sweep_expired():
+    """Expire what a TTL index can't: the documents stay, only their state changes"""
+    now = datetime.now(timezone.utc)
+    promos = await db.promo_codes.update_many(
+        {"is_active": True, "expires_at": {"$lte": now}},
+        {"$set": {"is_active": False}}
+    )
+    missions = await db.missions.update_many(
+        {"is_active": True, "expires_at": {"$lte": now}},
+        {"$set": {"is_active": False}}
+    )
+    if missions.modified_count:
+        active_missions_cache.invalidate()
+    multipliers = await db.users.update_many(
+        {"xp_multiplier_expires_at": {"$lte": now}},
+        {"$unset": {"xp_multiplier_expires_at": ""}}
+    )
+    return {
+        "promo_codes": promos.modified_count,
+        "missions": missions.modified_count,
+        "xp_multipliers": multipliers.modified_count
+    }
+
+async def expiry_sweeper():
+    while True:
+        try:
+            swept = await sweep_expired()
+            if any(swept.values()):
+                logging.info(f"Expiry sweep: {swept}")
+        except Exception as e:
+            logging.error(f"Expiry sweep failed: {str(e)}")
+        await asyncio.sleep(EXPIRY_SWEEP_INTERVAL)
+
+# ==================== MIGRATIONS ====================
+
+# Legacy documents store timestamps as ISO strings; this converts them to native dates.
+# Progress is checkpointed per collection in db.migrations, so an interrupted run resumes
+# after the last converted _id instead of starting over.
+NATIVE_DATES_MIGRATION = "native_dates_v1"
+NATIVE_DATES_COLLECTIONS = [
+    "user_sessions", "pending_registrations", "users", "orders", "topup_requests",
+    "topup_history", "topup_codes", "withdrawal_requests", "promo_codes", "missions",
+    "user_missions", "activity_feed", "products", "reviews", "support_tickets",
+    "bank_cards", "tags", "themes", "delivery_methods", "xp_events", "seasons",
+    "receipt_hashes", "jobs", "receipt_jobs", "categories", "rewards", "wheel_prizes"
+]
+MIGRATION_BATCH_SIZE = 500
+DATE_FIELD_NAMES = {"timestamp", "last_bonus_claim", "run_at"}
+
+def is_date_field(name: str) -> bool:
+    return name.endswith("_at") or name in DATE_FIELD_NAMES
+
+# Server-side projection down to what date_string_updates can convert: string
+# fields with a date-like name and arrays of subdocuments
+DATE_CANDIDATES_PROJECTION = {"$arrayToObject": {"$filter": {
+    "input": {"$objectToArray": "$$ROOT"},
+    "cond": {"$or": [
+        {"$eq": ["$$this.k", "_id"]},
+        {"$and": [
+            {"$eq": [{"$type": "$$this.v"}, "string"]},
+            {"$regexMatch": {
+                "input": "$$this.k",
+                "regex": "_at$|^(" + "|".join(sorted(DATE_FIELD_NAMES)) + ")$"
+            }}
+        ]},
+        {"$and": [
+            {"$eq": [{"$type": "$$this.v"}, "array"]},
+            {"$eq": [{"$type": {"$arrayElemAt": ["$$this.v", 0]}}, "object"]}
+        ]}
+    ]}
+}}}
+
+def date_string_updates(doc: dict) -> dict:
+    """Fields of `doc` holding ISO-string timestamps, converted to datetimes.
+    Covers top-level fields and arrays of subdocuments (e.g. orders.status_history)."""
+    updates = {}
+    for key, value in doc.items():
+        if isinstance(value, str) and is_date_field(key):
+            try:
+                updates[key] = as_utc(value)
+            except ValueError:
+                continue
+        elif isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+            items = [{**item, **date_string_updates(item)} for item in value]
+            if items != value:
+                updates[key] = items
+    return updates
+
+async def migrate_collection_dates(name: str, last_id=None) -> int:
+    """Convert one collection in _id order, checkpointing after every batch"""
+    collection = db[name]
+    converted = 0
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        batch = await collection.aggregate([
+            {"$match": query},
+            {"$sort": {"_id": 1}},
+            {"$limit": MIGRATION_BATCH_SIZE},
+            {"$replaceWith": DATE_CANDIDATES_PROJECTION}
+        ]).to_list(MIGRATION_BATCH_SIZE)
+        if not batch:
+            return converted
+        ops = []
+        for doc in batch:
+            updates = date_string_updates(doc)
+            if not updates:
+                continue
+            # Arrays are rewritten whole, so skip the document if one changed meanwhile
+            guard = {key: doc[key] for key, value in updates.items() if isinstance(value, list)}
+            ops.append(UpdateOne({"_id": doc["_id"], **guard}, {"$set": updates}))
+        if ops:
+            result = await collection.bulk_write(ops, ordered=False)
+            converted += result.modified_count
+        last_id = batch[-1]["_id"]
+        await db.migrations.update_one(
+            {"migration_id": NATIVE_DATES_MIGRATION},
+            {"$set": {f"checkpoints.{name}": last_id, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+@job_queue.handler("migrate_native_dates")
+async def run_native_dates_migration(payload: dict):
+    state = await db.migrations.find_one({"migration_id": NATIVE_DATES_MIGRATION}) or {}
+    if state.get("status") == "done":
+        return
+    done = set(state.get("done", []))
+    checkpoints = state.get("checkpoints", {})
+    for name in NATIVE_DATES_COLLECTIONS:
+        if name in done:
+            continue
+        converted = await migrate_collection_dates(name, checkpoints.get(name))
+        await db.migrations.update_one(
+            {"migration_id": NATIVE_DATES_MIGRATION},
+            {"$addToSet": {"done": name}},
+            upsert=True
+        )
+        if converted:
+            logging.info(f"Converted timestamps to native dates in {converted} {name} documents")
+    await db.migrations.update_one(
+        {"migration_id": NATIVE_DATES_MIGRATION},
+        {"$set": {"status": "done", "completed_at": datetime.now(timezone.utc)}}
+    )
+
+REVIEW_AGGREGATES_MIGRATION = "review_aggregates_v1"
+
+async def id_batches(collection, query: dict, projection: dict):
+    """Yield documents matching `query` in _id order, MIGRATION_BATCH_SIZE at a time"""
+    last_id = None
+    while True:
+        page = {**query, "_id": {"$gt": last_id}} if last_id is not None else query
+        batch = await collection.find(page, projection).sort("_id", 1).limit(MIGRATION_BATCH_SIZE).to_list(MIGRATION_BATCH_SIZE)
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1]["_id"]
+
+async def ensure_review_likes_index():
+    """Unique (user_id, review_id) index behind the atomic sparkle toggle.
+    Legacy data may hold duplicate likes from the old find-then-insert toggle; those are
+    dropped first, otherwise the index build fails."""
+    duplicates = db.review_likes.aggregate([
+        {"$group": {"_id": {"user_id": "$user_id", "review_id": "$review_id"}, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ])
+    async for group in duplicates:
+        await db.review_likes.delete_many({"_id": {"$in": group["ids"][1:]}})
+    await db.review_likes.create_index([("user_id", 1), ("review_id", 1)], unique=True)
+
+USER_MISSIONS_UNIQUE_MIGRATION = "user_missions_unique_v1"
+
+@job_queue.handler("dedupe_user_missions")
+async def run_user_missions_dedupe(payload: dict):
+    """Unique (user_id, mission_id) index for progress upserts from concurrent job workers.
+    Keeps the most advanced duplicate (claimed, then completed, then most progress) and
+    replaces the old non-unique index with the same keys."""
+    duplicates = db.user_missions.aggregate([
+        {"$sort": {"is_claimed": -1, "is_completed": -1, "progress": -1}},
+        {"$group": {"_id": {"user_id": "$user_id", "mission_id": "$mission_id"}, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    async for group in duplicates:
+        await db.user_missions.delete_many({"_id": {"$in": group["ids"][1:]}})
+    indexes = await db.user_missions.index_information()
+    keys = [("user_id", 1), ("mission_id", 1)]
+    for name, spec in indexes.items():
+        if spec["key"] == keys and not spec.get("unique"):
+            await db.user_missions.drop_index(name)
+    await db.user_missions.create_index(keys, unique=True)
+    await db.migrations.update_one(
+        {"migration_id": USER_MISSIONS_UNIQUE_MIGRATION},
+        {"$set": {"status": "done", "completed_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+USER_SEARCH_FIELDS_MIGRATION = "user_search_fields_v1"
+
+@job_queue.handler("backfill_user_search_fields")
+async def run_user_search_fields_backfill(payload: dict):
+    """email_lower/name_lower for users created before the admin search used them.
+    Lowercased in Python: $toLower only handles ASCII, and names are often Cyrillic."""
+    missing = {"$or": [{"email_lower": {"$exists": False}}, {"name_lower": {"$exists": False}}]}
+    async for batch in id_batches(db.users, missing, {"_id": 1, "email": 1, "name": 1}):
+        ops = []
+        for u in batch:
+            fields = user_search_fields(u)
+            if fields:
+                ops.append(UpdateOne({"_id": u["_id"]}, {"$set": fields}))
+        if ops:
+            await db.users.bulk_write(ops, ordered=False)
+    await db.migrations.update_one(
+        {"migration_id": USER_SEARCH_FIELDS_MIGRATION},
+        {"$set": {"status": "done", "completed_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+@job_queue.handler("backfill_review_aggregates")
+async def run_review_aggregates_backfill(payload: dict):
+    """Compute sparkle counters and product rating aggregates for existing reviews"""
+    await ensure_review_likes_index()
+
+    async for batch in id_batches(db.reviews, {}, {"_id": 1, "review_id": 1}):
+        ids = [r["review_id"] for r in batch]
+        counts = {
+            c["_id"]: c["count"] async for c in db.review_likes.aggregate([
+                {"$match": {"review_id": {"$in": ids}}},
+                {"$group": {"_id": "$review_id", "count": {"$sum": 1}}}
+            ])
+        }
+        await db.reviews.bulk_write(
+            [UpdateOne({"_id": r["_id"]}, {"$set": {"sparkles": counts.get(r["review_id"], 0)}}) for r in batch],
+            ordered=False
+        )
+
+    async for batch in id_batches(db.products, {}, {"_id": 1, "product_id": 1}):
+        ids = [p["product_id"] for p in batch]
+        histograms = defaultdict(dict)
+        async for row in db.reviews.aggregate([
+            {"$match": {"product_id": {"$in": ids}}},
+            {"$group": {"_id": {"product_id": "$product_id", "rating": "$rating"}, "count": {"$sum": 1}}}
+        ]):
+            histograms[row["_id"]["product_id"]][str(row["_id"]["rating"])] = row["count"]
+        ops = []
+        for product in batch:
+            histogram = histograms.get(product["product_id"], {})
+            count = sum(histogram.values())
+            total = sum(int(rating) * n for rating, n in histogram.items())
+            ops.append(UpdateOne({"_id": product["_id"]}, {"$set": {
+                "rating_count": count,
+                "rating_sum": total,
+                "rating_histogram": histogram,
+                "rating_avg": round(total / count, 2) if count else 0.0,
+            }}))
+        await db.products.bulk_write(ops, ordered=False)
+
+    await db.migrations.update_one(
+        {"migration_id": REVIEW_AGGREGATES_MIGRATION},
+        {"$set": {"status": "done", "completed_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+# migration_id -> job that performs it
+MIGRATION_JOBS = {
+    NATIVE_DATES_MIGRATION: "migrate_native_dates",
+    REVIEW_AGGREGATES_MIGRATION: "backfill_review_aggregates",
+    USER_MISSIONS_UNIQUE_MIGRATION: "dedupe_user_missions",
+    USER_SEARCH_FIELDS_MIGRATION: "backfill_user_search_fields",
+}
+
+async def schedule_migrations():
+    """Queue unfinished migrations; the job queue runs them once it starts"""
+    done = await db.migrations.distinct("migration_id", {"status": "done"})
+    for migration_id, job_name in MIGRATION_JOBS.items():
+        if migration_id in done:
+            continue
+        queued = await db.jobs.find_one({"name": job_name, "status": {"$in": ["pending", "running"]}})
+        if not queued:
+            await job_queue.enqueue(job_name, {})
+
 # ==================== SEED DATA ====================
 
 @api_router.post("/migrate-translations")
@@ -3404,56 +6048,56 @@ async def seed_database():
             "description": "Premium RGB gaming headset with surround sound", "description_ru": "Премиум RGB наушники с объёмным звуком", "description_tj": "Гӯшмонакҳои RGB бо овози ҳаҷмнок",
             "price": 1500, "xp_reward": 150, "category_id": "cat_gaming",
             "image_url": "https://images.unsplash.com/photo-1618366712010-f4ae9c647dcb?w=500",
-            "sizes": [], "stock": 50, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()
+            "sizes": [], "stock": 50, "is_active": True, "created_at": datetime.now(timezone.utc)
         },
         {
             "product_id": "prod_002", "name": "Neon Gaming Mouse", "name_ru": "Неоновая игровая мышь", "name_tj": "Муши бозии неонӣ",
             "description": "High DPI gaming mouse with customizable lighting", "description_ru": "Игровая мышь с высоким DPI и настраиваемой подсветкой", "description_tj": "Муши бозӣ бо DPI баланд ва равшании танзимшаванда",
             "price": 800, "xp_reward": 80, "category_id": "cat_gaming",
             "image_url": "https://images.unsplash.com/photo-1527814050087-3793815479db?w=500",
-            "sizes": [], "stock": 100, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()
+            "sizes": [], "stock": 100, "is_active": True, "created_at": datetime.now(timezone.utc)
         },
         {
             "product_id": "prod_003", "name": "TSMarket Hoodie", "name_ru": "Худи TSMarket", "name_tj": "Худи TSMarket",
             "description": "Premium gaming hoodie with dragon logo", "description_ru": "Премиум худи для геймеров с логотипом дракона", "description_tj": "Худи барои бозингарон бо логои аждаҳо",
             "price": 2000, "xp_reward": 200, "category_id": "cat_clothing",
             "image_url": "https://images.unsplash.com/photo-1556821840-3a63f95609a7?w=500",
-            "sizes": ["S", "M", "L", "XL", "XXL"], "stock": 30, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()
+            "sizes": ["S", "M", "L", "XL", "XXL"], "stock": 30, "is_active": True, "created_at": datetime.now(timezone.utc)
         },
         {
             "product_id": "prod_004", "name": "Gaming T-Shirt", "name_ru": "Игровая футболка", "name_tj": "Футболкаи бозӣ",
             "description": "Comfortable cotton t-shirt for gamers", "description_ru": "Удобная хлопковая футболка для геймеров", "description_tj": "Футболкаи пахтагии роҳат барои бозингарон",
             "price": 1000, "xp_reward": 100, "category_id": "cat_clothing",
             "image_url": "https://images.unsplash.com/photo-1521572163474-6864f9cf17ab?w=500",
-            "sizes": ["S", "M", "L", "XL"], "stock": 75, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()
+            "sizes": ["S", "M", "L", "XL"], "stock": 75, "is_active": True, "created_at": datetime.now(timezone.utc)
         },
         {
             "product_id": "prod_005", "name": "RGB Keyboard", "name_ru": "RGB Клавиатура", "name_tj": "Клавиатураи RGB",
             "description": "Mechanical gaming keyboard with Cherry MX switches", "description_ru": "Механическая игровая клавиатура с переключателями Cherry MX", "description_tj": "Клавиатураи механикии бозӣ бо калидҳои Cherry MX",
             "price": 2500, "xp_reward": 250, "category_id": "cat_gaming",
             "image_url": "https://images.unsplash.com/photo-1511467687858-23d96c32e4ae?w=500",
-            "sizes": [], "stock": 40, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()
+            "sizes": [], "stock": 40, "is_active": True, "created_at": datetime.now(timezone.utc)
         },
         {
             "product_id": "prod_006", "name": "Gaming Mousepad XL", "name_ru": "Игровой коврик XL", "name_tj": "Фарши муш XL",
             "description": "Extended RGB mousepad for full desk coverage", "description_ru": "Расширенный RGB коврик для полного покрытия стола", "description_tj": "Фарши RGB васеъ барои пӯшиши пурраи мизи кор",
             "price": 600, "xp_reward": 60, "category_id": "cat_accessories",
             "image_url": "https://images.unsplash.com/photo-1616588589676-62b3bd4ff6d2?w=500",
-            "sizes": [], "stock": 200, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()
+            "sizes": [], "stock": 200, "is_active": True, "created_at": datetime.now(timezone.utc)
         },
         {
             "product_id": "prod_007", "name": "Dragon Figurine", "name_ru": "Фигурка дракона", "name_tj": "Ҳайкали аждаҳо",
             "description": "Limited edition TSMarket dragon collectible", "description_ru": "Коллекционный дракон TSMarket ограниченной серии", "description_tj": "Коллексияи маҳдуди аждаҳои TSMarket",
             "price": 5000, "xp_reward": 500, "category_id": "cat_collectibles",
             "image_url": "https://images.unsplash.com/photo-1578662996442-48f60103fc96?w=500",
-            "sizes": [], "stock": 10, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()
+            "sizes": [], "stock": 10, "is_active": True, "created_at": datetime.now(timezone.utc)
         },
         {
             "product_id": "prod_008", "name": "Gaming Cap", "name_ru": "Игровая кепка", "name_tj": "Кулоҳи бозӣ",
             "description": "Snapback cap with embroidered dragon", "description_ru": "Кепка с вышитым драконом", "description_tj": "Кулоҳ бо аждаҳои дӯзишуда",
             "price": 700, "xp_reward": 70, "category_id": "cat_clothing",
             "image_url": "https://images.unsplash.com/photo-1588850561407-ed78c282e89b?w=500",
-            "sizes": ["One Size"], "stock": 60, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()
+            "sizes": ["One Size"], "stock": 60, "is_active": True, "created_at": datetime.now(timezone.utc)
         },
     ]
     await db.products.insert_many(products)
@@ -3490,7 +6134,7 @@ async def seed_database():
             "title_color": "text-teal-500",
             "tagline": "🛒 Обычный стиль",
             "is_system": True,
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc)
         },
         {
             "theme_id": "new_year",
@@ -3501,7 +6145,7 @@ async def seed_database():
             "title_color": "text-blue-400",
             "tagline": "🎄 С Новым Годом!",
             "is_system": True,
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc)
         },
         {
             "theme_id": "valentine",
@@ -3512,7 +6156,7 @@ async def seed_database():
             "title_color": "text-rose-500",
             "tagline": "❤️ С Днем Влюбленных!",
             "is_system": True,
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc)
         },
         {
             "theme_id": "ramadan",
@@ -3523,7 +6167,7 @@ async def seed_database():
             "title_color": "text-amber-400",
             "tagline": "🌙 Рамазан Мубарак!",
             "is_system": True,
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc)
         },
         {
             "theme_id": "ramadan_holiday",
@@ -3534,7 +6178,7 @@ async def seed_database():
             "title_color": "text-amber-300",
             "tagline": "🕌 Ид Мубарак! С праздником Рамазан!",
             "is_system": True,
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc)
         },
         {
             "theme_id": "men_day",
@@ -3545,16 +6189,16 @@ async def seed_database():
             "title_color": "text-emerald-500",
             "tagline": "🎖️ С 23 Февраля!",
             "is_system": True,
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc)
         }
     ]
     await db.themes.insert_many(themes)
     
     # Demo top-up codes
     topup_codes = [
-        {"code_id": "code_001", "code": "WELCOME100", "amount": 100, "is_used": False, "created_at": datetime.now(timezone.utc).isoformat()},
-        {"code_id": "code_002", "code": "DRAGON500", "amount": 500, "is_used": False, "created_at": datetime.now(timezone.utc).isoformat()},
-        {"code_id": "code_003", "code": "GAMING1000", "amount": 1000, "is_used": False, "created_at": datetime.now(timezone.utc).isoformat()},
+        {"code_id": "code_001", "code": "WELCOME100", "amount": 100, "is_used": False, "created_at": datetime.now(timezone.utc)},
+        {"code_id": "code_002", "code": "DRAGON500", "amount": 500, "is_used": False, "created_at": datetime.now(timezone.utc)},
+        {"code_id": "code_003", "code": "GAMING1000", "amount": 1000, "is_used": False, "created_at": datetime.now(timezone.utc)},
     ]
     await db.topup_codes.insert_many(topup_codes)
     
@@ -3571,9 +6215,10 @@ async def seed_database():
         "is_admin": True,
         "wheel_spins_available": 5,
         "claimed_rewards": [],
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
-    await db.users.insert_one(admin_user)
+    await db.users.insert_one({**admin_user, **user_search_fields(admin_user)})
+    await reconcile_store_stats()
     
     return {"message": "Database seeded successfully"}
 
@@ -3598,7 +6243,6 @@ async def create_theme(data: ShopThemeCreate, user: User = Depends(require_admin
         is_system=False
     )
     theme_dict = theme.model_dump()
-    theme_dict["created_at"] = theme_dict["created_at"].isoformat()
     await db.themes.insert_one(theme_dict)
     theme_dict.pop("_id", None)
     return theme_dict
@@ -3657,8 +6301,6 @@ async def create_delivery_method(data: DeliveryMethodCreate, user: User = Depend
         is_active=True
     )
     method_dict = method.model_dump()
-    method_dict["created_at"] = method_dict["created_at"].isoformat()
-    method_dict["updated_at"] = method_dict["updated_at"].isoformat() if method_dict["updated_at"] else None
     
     await db.delivery_methods.insert_one(method_dict)
     method_dict.pop("_id", None)
@@ -3695,7 +6337,7 @@ async def update_delivery_method(method_id: str, data: DeliveryMethodUpdate, use
         update_data["is_active"] = data.is_active
     
     if update_data:
-        update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
+        update_data["updated_at"] = datetime.now(timezone.utc)
         await db.delivery_methods.update_one(
             {"method_id": method_id},
             {"$set": update_data}
@@ -3721,6 +6363,127 @@ app.include_router(api_router)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def migrate_legacy_data():
+    await schedule_migrations()
+
+@app.on_event("startup")
+async def detect_mongo_version():
+    info = await client.server_info()
+    mongo_server["version"] = tuple(info["versionArray"][:2])
+
+@app.on_event("startup")
+async def create_indexes():
+    """Create indexes backing hot queries (no-op if they already exist)"""
+    await db.users.create_index("user_id")
+    # Leaderboard order: is_admin equality, xp desc, user_id as tie-breaker;
+    # role is part of the key so the $ne filter is applied without fetching documents
+    await db.users.create_index([("is_admin", 1), ("xp", -1), ("user_id", 1), ("role", 1)])
+    await db.xp_events.create_index([("user_id", 1), ("created_at", -1)])
+    # Market snapshot medians and per-category listings
+    await db.products.create_index([("category_id", 1), ("price", 1)])
+    await db.xp_events.create_index("event_id", unique=True)
+    await db.xp_rollups.create_index([("period", 1), ("season", 1), ("user_id", 1)], unique=True)
+    await db.xp_rollups.create_index([("period", 1), ("season", 1), ("xp", -1), ("user_id", 1)])
+    await db.seasons.create_index([("period", 1), ("season", 1)], unique=True)
+    try:
+        await db.user_missions.create_index([("user_id", 1), ("mission_id", 1)], unique=True)
+    except OperationFailure:
+        # Older deployments have a non-unique index and possibly duplicates; dedupe_user_missions replaces it
+        logging.warning("user_missions unique index deferred until duplicate progress is merged")
+    await db.missions.create_index([("is_active", 1), ("mission_type", 1)])
+    await job_queue.create_indexes()
+    await receipt_queue.create_indexes()
+    await db.receipt_hashes.create_index("sha256", unique=True)
+    await db.receipt_hashes.create_index("phash_bands")
+    await db.topup_requests.create_index("request_id")
+    await db.topup_requests.create_index([("user_id", 1), ("created_at", -1)])
+    await db.user_sessions.create_index("session_token")
+    await db.user_sessions.create_index("expires_at", expireAfterSeconds=0)
+    await db.pending_registrations.create_index("email")
+    await db.pending_registrations.create_index("expires_at", expireAfterSeconds=0)
+    await db.stream_tickets.create_index("ticket", unique=True)
+    await db.stream_tickets.create_index("expires_at", expireAfterSeconds=0)
+    await db.users.create_index("xp_multiplier_expires_at", sparse=True)
+    await db.migrations.create_index("migration_id", unique=True)
+    await db.store_stats.create_index("stats_id", unique=True)
+    await db.sales_daily.create_index("start", unique=True)
+    await db.sales_hourly.create_index("start", unique=True)
+    await db.activity_feed.create_index("created_at")
+    for collection in {collection for collection, _ in INBOX_QUEUES.values()}:
+        await db[collection].create_index([("status", 1), ("created_at", 1)])
+    await db.orders.create_index("order_id")
+    # Admin list filters: equality key first, created_at for the newest-first sort
+    await db.orders.create_index("created_at")
+    await db.orders.create_index([("user_id", 1), ("created_at", -1)])
+    await db.orders.create_index([("delivery_user_id", 1), ("created_at", -1)])
+    await db.withdrawal_requests.create_index([("user_id", 1), ("created_at", -1)])
+    # Export date ranges
+    await db.withdrawal_requests.create_index("created_at")
+    await db.topup_requests.create_index("created_at")
+    await db.topup_history.create_index("created_at")
+    await db.users.create_index([("role", 1), ("created_at", -1)])
+    await db.users.create_index("created_at")
+    await db.users.create_index("email")
+    # Admin user search: one index per $or branch, prefix range on the lowercased key.
+    # created_at follows for the newest-first sort and role is checked from the index keys.
+    await db.users.create_index([("email_lower", 1), ("created_at", -1), ("role", 1)])
+    await db.users.create_index([("name_lower", 1), ("created_at", -1), ("role", 1)])
+    await db.delivery_methods.create_index("method_id")
+    for keys in REVIEW_SORTS.values():
+        await db.reviews.create_index([("product_id", 1)] + [(key, -1) for key in keys])
+    try:
+        await db.review_likes.create_index([("user_id", 1), ("review_id", 1)], unique=True)
+    except OperationFailure:
+        # Duplicate legacy likes; backfill_review_aggregates cleans them up and builds the index
+        logging.warning("review_likes unique index deferred until duplicate likes are removed")
+
+@app.on_event("startup")
+async def open_ai_clients():
+    if OPENAI_AVAILABLE and os.environ.get("OPENAI_API_KEY"):
+        ai_clients["openai"] = AsyncOpenAI(timeout=httpx.Timeout(60.0, connect=5.0), max_retries=2)
+
+# Long-running loops started with the app and cancelled on shutdown
+background_tasks: List[asyncio.Task] = []
+
+@app.on_event("startup")
+async def start_background_tasks():
+    # Job handlers use the pooled clients, so they must exist before the workers start
+    await http_pool.start()
+    await job_queue.start()
+    await receipt_queue.start()
+    background_tasks.append(asyncio.create_task(season_scheduler()))
+    background_tasks.append(asyncio.create_task(market_snapshot_refresher()))
+    background_tasks.append(asyncio.create_task(expiry_sweeper()))
+    background_tasks.append(asyncio.create_task(store_stats_reconciler()))
+    if event_hub.relay is not None:
+        background_tasks.append(asyncio.create_task(event_hub.tail_relay()))
+        background_tasks.append(asyncio.create_task(activity_tail_feeder()))
+    background_tasks.append(asyncio.create_task(activity_writer.run()))
+    background_tasks.append(asyncio.create_task(activity_archiver()))
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    event_hub.close()
+    # Drain queued jobs first; whatever is left stays pending in db.jobs
+    await asyncio.gather(job_queue.stop(), receipt_queue.stop())
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await activity_writer.flush()
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    await http_pool.close()
+    for ai_client in ai_clients.values():
+        await ai_client.close()
+    ai_clients.clear()
+
+@app.on_event("shutdown")
+async def close_smtp_connections():
+    await smtp_pool.close()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
@@ -0,0 +1,103 @@
+import React from 'react';
+import { Button } from './ui/button';
+import { Input } from './ui/input';
+
+// Filter row and pager for lists driven by usePagedList (hooks/use-paged-list.js)
+
+export const TOPUP_STATUSES = [
+  ['pending', 'Ожидает'],
+  ['pending_ai', 'Проверка AI'],
+  ['approved', 'Одобрено'],
+  ['rejected', 'Отклонено'],
+];
+export const WITHDRAWAL_STATUSES = [
+  ['pending', 'Ожидает'],
+  ['approved', 'Одобрено'],
+  ['rejected', 'Отклонено'],
+];
+export const ORDER_STATUSES = [
+  ['pending', 'Новый'],
+  ['confirmed', 'Подтверждён'],
+  ['processing', 'В обработке'],
+  ['shipped', 'Отправлен'],
+  ['delivered', 'Доставлен'],
+  ['cancelled', 'Отменён'],
+  ['return_pending', 'Ожидает возврата'],
+  ['returned', 'Возвращён'],
+];
+export const USER_ROLES = [
+  ['user', 'Пользователь'],
+  ['helper', 'Хелпер'],
+  ['delivery', 'Доставщик'],
+  ['admin', 'Админ'],
+];
+
+// `statuses` is a list of [value, label] pairs for the select, sent as `statusKey`
+export const ListFilters = ({ list, statuses = [], statusKey = 'status', allLabel = 'Все статусы', search = false, userFilter = false, dateFilter = false, children }) => (
+  <div className="flex flex-wrap items-center gap-2 mb-4">
+    {search && (
+      <Input
+        placeholder="Email или имя"
+        value={list.filters.q || ''}
+        onChange={(e) => list.setFilters({ q: e.target.value })}
+        className="admin-input w-56"
+      />
+    )}
+    {statuses.length > 0 && (
+      <select
+        value={list.filters[statusKey] || ''}
+        onChange={(e) => list.setFilters({ [statusKey]: e.target.value })}
+        className="admin-input h-10 rounded-md px-3 text-sm"
+      >
+        <option value="">{allLabel}</option>
+        {statuses.map(([value, label]) => (
+          <option key={value} value={value}>{label}</option>
+        ))}
+      </select>
+    )}
+    {userFilter && (
+      <Input
+        placeholder="ID пользователя"
+        value={list.filters.user_id || ''}
+        onChange={(e) => list.setFilters({ user_id: e.target.value.trim() })}
+        className="admin-input w-48"
+      />
+    )}
+    {dateFilter && (
+      <>
+        <Input
+          type="date"
+          title="С даты"
+          value={list.filters.date_from || ''}
+          onChange={(e) => list.setFilters({ date_from: e.target.value })}
+          className="admin-input w-40"
+        />
+        <Input
+          type="date"
+          title="До даты (не включая)"
+          value={list.filters.date_to || ''}
+          onChange={(e) => list.setFilters({ date_to: e.target.value })}
+          className="admin-input w-40"
+        />
+      </>
+    )}
+    {children}
+  </div>
+);
+
+export const ListPager = ({ list }) => (
+  <div className="flex items-center justify-between mt-4 text-sm text-slate-400">
+    <span>Всего: {list.total}</span>
+    {list.pageCount > 1 && (
+      <div className="flex items-center gap-2">
+        <Button size="sm" variant="outline" disabled={list.page === 0 || list.loading} onClick={() => list.setPage(list.page - 1)}>
+          ←
+        </Button>
+        <span>{list.page + 1} / {list.pageCount}</span>
+        <Button size="sm" variant="outline" disabled={list.page + 1 >= list.pageCount || list.loading} onClick={() => list.setPage(list.page + 1)}>
+          →
+        </Button>
+      </div>
+    )}
+  </div>
+);
@@ -0,0 +1,60 @@
+import { useCallback, useEffect, useRef, useState } from 'react';
+
+// One page of a server-paged list: skip/limit params, total from the X-Total-Count header.
+// `fetchPage(params)` is an API call such as adminAPI.getOrders. Nothing loads while
+// `enabled` is false, so a tab's list is only requested once the tab is open.
+export const usePagedList = (fetchPage, { pageSize = 50, initialFilters = {}, params = {}, enabled = true, onError } = {}) => {
+  const [items, setItems] = useState([]);
+  const [total, setTotal] = useState(0);
+  const [page, setPage] = useState(0);
+  const [filters, setFilterState] = useState(initialFilters);
+  const [loading, setLoading] = useState(false);
+  const fetchRef = useRef(fetchPage);
+  fetchRef.current = fetchPage;
+  const onErrorRef = useRef(onError);
+  onErrorRef.current = onError;
+  const fixedParams = JSON.stringify(params);
+
+  const reload = useCallback(async () => {
+    const query = { ...JSON.parse(fixedParams), skip: page * pageSize, limit: pageSize };
+    Object.entries(filters).forEach(([key, value]) => {
+      if (value !== '' && value !== null && value !== undefined) query[key] = value;
+    });
+    setLoading(true);
+    try {
+      const res = await fetchRef.current(query);
+      setItems(res.data);
+      const header = res.headers?.['x-total-count'];
+      setTotal(header !== undefined ? Number(header) : res.data.length);
+    } catch (error) {
+      console.error('Failed to load list:', error);
+      onErrorRef.current?.(error);
+    } finally {
+      setLoading(false);
+    }
+  }, [page, pageSize, filters, fixedParams]);
+
+  // Typing in a filter field waits for a pause before hitting the server
+  useEffect(() => {
+    if (!enabled) return undefined;
+    const timer = setTimeout(reload, 300);
+    return () => clearTimeout(timer);
+  }, [reload, enabled]);
+
+  const setFilters = (changes) => {
+    setPage(0);
+    setFilterState(prev => ({ ...prev, ...changes }));
+  };
+
+  return {
+    items,
+    total,
+    page,
+    setPage,
+    pageCount: Math.max(1, Math.ceil(total / pageSize)),
+    filters,
+    setFilters,
+    loading,
+    reload,
+  };
+};
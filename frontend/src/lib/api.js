@@ -47,7 +47,7 @@ export const productsAPI = {
 };
 // Reviews API
 export const reviewsAPI = {
-  getForProduct: (productId) => api.get(`/reviews/${productId}`),
+  getForProduct: (productId, params = {}) => api.get(`/reviews/${productId}`, { params }),
   create: (data) => api.post('/reviews', data),
 };
 // Orders API
@@ -76,6 +76,7 @@ export const topupAPI = {
   getSettings: () => api.get('/topup/settings'),
   createRequest: (data) => api.post('/topup/request', data),
   getRequests: () => api.get('/topup/requests'),
+  getRequest: (id) => api.get(`/topup/requests/${id}`),
 };
 
 // Withdrawal API
@@ -99,9 +100,12 @@ export const wheelAPI = {
 // Admin API
 export const adminAPI = {
   getStats: () => api.get('/admin/stats'),
+  getInbox: () => api.get('/admin/inbox'),
+  exportData: (name, params = {}) => api.get(`/admin/export/${name}`, { params, responseType: 'blob' }),
   updateRevenue: (revenue) => api.put('/admin/stats/revenue', null, { params: { revenue } }),
   resetRevenue: () => api.delete('/admin/stats/revenue'),
-  getUsers: () => api.get('/admin/users'),
+  getUsers: (params = {}) => api.get('/admin/users', { params }),
+  getUser: (userId) => api.get(`/admin/users/${userId}`),
   toggleAdmin: (userId, isAdmin) => api.put(`/admin/users/${userId}/admin`, null, { params: { is_admin: isAdmin } }),
   deleteUser: (userId) => api.delete(`/admin/users/${userId}`),
   updateUserBalance: (userId, balance) => api.put(`/admin/users/${userId}/balance`, null, { params: { balance } }),
@@ -112,10 +116,12 @@ export const adminAPI = {
   getSettings: () => api.get('/admin/settings'),
   updateSettings: (data) => api.put('/admin/settings', data),
   updateProfile: (data) => api.put('/admin/profile', data),
-  getTopupRequests: () => api.get('/admin/topup-requests'),
+  getTopupRequests: (params = {}) => api.get('/admin/topup-requests', { params }),
+  getTopupRequest: (requestId) => api.get(`/admin/topup-requests/${requestId}`),
   approveTopupRequest: (id) => api.put(`/admin/topup-requests/${id}/approve`),
   rejectTopupRequest: (id, note) => api.put(`/admin/topup-requests/${id}/reject`, null, { params: { note } }),
-  getWithdrawalRequests: () => api.get('/admin/withdrawal-requests'),
+  getWithdrawalRequests: (params = {}) => api.get('/admin/withdrawal-requests', { params }),
+  getWithdrawalRequest: (requestId) => api.get(`/admin/withdrawal-requests/${requestId}`),
   approveWithdrawalRequest: (id) => api.put(`/admin/withdrawal-requests/${id}/approve`),
   rejectWithdrawalRequest: (id, note) => api.put(`/admin/withdrawal-requests/${id}/reject`, null, { params: { note } }),
   createReward: (data) => api.post('/admin/rewards', data),
@@ -124,7 +130,7 @@ export const adminAPI = {
   createWheelPrize: (data) => api.post('/admin/wheel-prizes', data),
   updateWheelPrize: (id, data) => api.put(`/admin/wheel-prizes/${id}`, data),
   deleteWheelPrize: (id) => api.delete(`/admin/wheel-prizes/${id}`),
-  getOrders: () => api.get('/admin/orders'),
+  getOrders: (params = {}) => api.get('/admin/orders', { params }),
   getOrderDetails: (orderId) => api.get(`/admin/orders/${orderId}`),
   updateOrderStatus: (orderId, status, note, trackingNumber) => api.put(`/admin/orders/${orderId}/status`, { status, note, tracking_number: trackingNumber }),
   deleteOrder: (orderId) => api.delete(`/admin/orders/${orderId}`),
@@ -208,11 +214,19 @@ export const seedAPI = {
 };
 
 
+// Per-user notifications (server-sent events). EventSource cannot set headers,
+// so the stream is opened with a short-lived single-use ticket instead of the session token.
+export const eventsAPI = {
+  getStreamTicket: () => api.post('/events/ticket'),
+  streamUrl: (ticket) => `${API}/events/stream?ticket=${encodeURIComponent(ticket)}`,
+};
+
 // Gamification & Social API
 export const gamificationAPI = {
   claimDailyBonus: () => api.post('/user/daily-bonus'),
   getLeaderboard: () => api.get('/leaderboard'),
   getActivityFeed: () => api.get('/activity-feed'),
+  activityStreamUrl: () => `${API}/activity-feed/stream`,
   getPublicProfile: (userId) => api.get(`/user/profile/${userId}`),
   sparkleReview: (reviewId) => api.post(`/reviews/${reviewId}/sparkle`),
 };
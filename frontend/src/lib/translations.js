@@ -62,6 +62,7 @@ export const translations = {
       totalXP: 'Ҳамагӣ XP',
       reviews: 'Шарҳҳо',
       noReviews: 'Ҳанӯз шарҳ нест. Аввалин бошед!',
+      moreReviews: 'Шарҳҳои бештар',
       addReview: 'Шарҳ илова кунед',
       rating: 'Рейтинг',
       comment: 'Шарҳ',
@@ -196,6 +197,7 @@ export const translations = {
       approved: 'Дархости шумо тасдиқ шуд! Баланс пур шуд.',
       status: {
         pending: 'Мунтазир',
+        pending_ai: 'Санҷиши AI',
         approved: 'Тасдиқшуда',
         rejected: 'Радшуда',
       },
@@ -334,6 +336,7 @@ export const translations = {
       totalXP: 'Всего XP',
       reviews: 'Отзывы',
       noReviews: 'Отзывов пока нет. Будьте первым!',
+      moreReviews: 'Показать ещё',
       addReview: 'Добавить отзыв',
       rating: 'Рейтинг',
       comment: 'Комментарий',
@@ -468,6 +471,7 @@ export const translations = {
       approved: 'Ваша заявка одобрена! Баланс пополнен.',
       status: {
         pending: 'Ожидает',
+        pending_ai: 'Проверка AI',
         approved: 'Одобрено',
         rejected: 'Отклонено',
       },
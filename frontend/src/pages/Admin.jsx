@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { Button } from '../components/ui/button';
 import { Input } from '../components/ui/input';
@@ -10,9 +10,43 @@ import { useLanguage } from '../context/LanguageContext';
 import { adminAPI, categoriesAPI, productsAPI, rewardsAPI, wheelAPI } from '../lib/api';
 import { 
   Settings, Users, Package, Tag, Gift, Sparkles, CreditCard, User,
-  Plus, Trash2, ShoppingCart, BarChart3, Loader2, Check, X, Eye, Edit, Clock, CheckCircle, XCircle, Percent, Target, MessageSquare, MapPin, Truck, Trophy
+  Plus, Trash2, ShoppingCart, BarChart3, Loader2, Check, X, Eye, Edit, Clock, CheckCircle, XCircle, Percent, Target, MessageSquare, MapPin, Truck, Trophy, Download
 } from 'lucide-react';
 import { toast } from 'sonner';
+import { usePagedList } from '../hooks/use-paged-list';
+import {
+  ListFilters, ListPager, ORDER_STATUSES, TOPUP_STATUSES, USER_ROLES, WITHDRAWAL_STATUSES,
+} from '../components/ListControls';
+
+// Lists each tab shows; a tab loads them the first time it is opened.
+// Requests, withdrawals, users and orders are server-paged (usePagedList below).
+const TAB_LISTS = {
+  settings: ['settings'],
+  themes: ['themes', 'settings'],
+  discounts: ['promoCodes', 'products'],
+  missions: ['missions'],
+  tags: ['tags'],
+  'bank-cards': ['bankCards'],
+  delivery: ['deliveryMethods'],
+  support: ['supportTickets'],
+  products: ['products', 'categories'],
+  categories: ['categories'],
+  rewards: ['rewards'],
+  wheel: ['wheelPrizes'],
+  'ai-assistant': ['categories'],
+};
+// Stats cards and the quick theme switcher are above the tabs
+const HEADER_LISTS = ['stats', 'themes', 'settings'];
+
+// Admin queues from /admin/inbox: [queue, label, tab that handles it]
+const INBOX_QUEUES = [
+  ['topup_requests', 'Пополнения', 'requests'],
+  ['topup_ai_review', 'Проверка AI', 'requests'],
+  ['withdrawal_requests', 'Выводы', 'withdrawals'],
+  ['orders', 'Новые заказы', 'orders'],
+  ['order_returns', 'Возвраты', 'orders'],
+  ['support_tickets', 'Поддержка', 'support'],
+];
 
 export const Admin = () => {
   const navigate = useNavigate();
@@ -21,15 +55,10 @@ export const Admin = () => {
   
   const [loading, setLoading] = useState(true);
   const [stats, setStats] = useState(null);
-  const [users, setUsers] = useState([]);
   const [products, setProducts] = useState([]);
   const [categories, setCategories] = useState([]);
-  const [topupCodes, setTopupCodes] = useState([]);
-  const [topupRequests, setTopupRequests] = useState([]);
-  const [withdrawalRequests, setWithdrawalRequests] = useState([]);
   const [rewards, setRewards] = useState([]);
   const [wheelPrizes, setWheelPrizes] = useState([]);
-  const [orders, setOrders] = useState([]);
   const [adminSettings, setAdminSettings] = useState({ 
     card_number: '', 
     card_holder: '', 
@@ -41,6 +70,7 @@ export const Admin = () => {
   const [missions, setMissions] = useState([]);
   const [tags, setTags] = useState([]);
   const [supportTickets, setSupportTickets] = useState([]);
+  const [inbox, setInbox] = useState(null);
   const [bankCards, setBankCards] = useState([]);
   const [themes, setThemes] = useState([]);
   const [deliveryMethods, setDeliveryMethods] = useState([]);
@@ -108,6 +138,15 @@ export const Admin = () => {
     fetchAllData();
   }, [isAuthenticated, isAdmin, navigate, authLoading, user]);
 
+  // Badge counts refresh from the inbox endpoint without reloading the lists
+  useEffect(() => {
+    if (authLoading || !isAuthenticated || !(isAdmin || user?.role === 'helper')) return undefined;
+    const loadInbox = () => adminAPI.getInbox().then(res => setInbox(res.data)).catch(() => {});
+    loadInbox();
+    const timer = setInterval(loadInbox, 30000);
+    return () => clearInterval(timer);
+  }, [isAuthenticated, isAdmin, authLoading, user]);
+
   useEffect(() => {
     if (user) {
       setAdminEmail(user.email || '');
@@ -115,88 +154,57 @@ export const Admin = () => {
     }
   }, [user]);
 
+  const [activeTab, setActiveTab] = useState('requests');
+  const loadedTabs = useRef(new Set());
+
+  // Server-paged lists: filters, skip/limit and X-Total-Count; each loads while its tab is open
+  const canLoadLists = !authLoading && isAuthenticated && (isAdmin || user?.role === 'helper');
+  const topupList = usePagedList(adminAPI.getTopupRequests, { enabled: canLoadLists && activeTab === 'requests' });
+  const withdrawalsList = usePagedList(adminAPI.getWithdrawalRequests, { enabled: canLoadLists && activeTab === 'withdrawals' });
+  const usersList = usePagedList(adminAPI.getUsers, { params: { view: 'summary' }, enabled: canLoadLists && activeTab === 'users' });
+  const ordersList = usePagedList(adminAPI.getOrders, { params: { expand: true }, enabled: canLoadLists && activeTab === 'orders' });
+  const pagedLists = { requests: topupList, withdrawals: withdrawalsList, users: usersList, orders: ordersList };
+  const topupRequests = topupList.items;
+  const withdrawalRequests = withdrawalsList.items;
+  const users = usersList.items;
+  const orders = ordersList.items;
+
+  const listLoaders = {
+    stats: () => adminAPI.getStats().then(res => setStats(res.data)),
+    products: () => productsAPI.getAll({ limit: 100000 }).then(res => setProducts(res.data)),
+    categories: () => categoriesAPI.getAll().then(res => setCategories(res.data)),
+    wheelPrizes: () => wheelAPI.getPrizes().then(res => setWheelPrizes(res.data)),
+    promoCodes: () => adminAPI.getPromoCodes().then(res => setPromoCodes(res.data)),
+    tags: () => adminAPI.getTags().then(res => setTags(res.data)),
+    rewards: () => rewardsAPI.getAll().then(res => setRewards(res.data)),
+    missions: () => adminAPI.getMissions().then(res => setMissions(res.data)),
+    supportTickets: () => adminAPI.getSupportTickets().then(res => setSupportTickets(res.data)),
+    themes: () => adminAPI.getThemes().then(res => setThemes(res.data)),
+    deliveryMethods: () => adminAPI.getDeliveryMethods().then(res => setDeliveryMethods(res.data)),
+    // Admin-only data
+    settings: () => (isAdmin ? adminAPI.getSettings().then(res => setAdminSettings(res.data)) : Promise.resolve()),
+    bankCards: () => (isAdmin ? adminAPI.getBankCards().then(res => setBankCards(res.data)) : Promise.resolve()),
+  };
+
+  const loadLists = (names) => Promise.all([...new Set(names)].map(name =>
+    listLoaders[name]().catch(error => console.error(`Failed to load ${name}:`, error))
+  ));
+
+  const loadTab = async (tab, force = false) => {
+    if (!force && loadedTabs.current.has(tab)) return;
+    loadedTabs.current.add(tab);
+    await loadLists(TAB_LISTS[tab] || []);
+  };
+
+  const handleTabChange = (tab) => {
+    setActiveTab(tab);
+    loadTab(tab);
+  };
+
   const fetchAllData = async () => {
     setLoading(true);
     try {
-      // Base data that both admin and helper can access
-      const [statsRes, usersRes, productsRes, categoriesRes, codesRes, ordersRes, prizesRes, requestsRes, withdrawalRes, promoRes, tagsRes] = await Promise.all([
-        adminAPI.getStats(),
-        adminAPI.getUsers(),
-        productsAPI.getAll({ limit: 100000 }),
-        categoriesAPI.getAll(),
-        adminAPI.getTopupCodes(),
-        adminAPI.getOrders(),
-        wheelAPI.getPrizes(),
-        adminAPI.getTopupRequests(),
-        adminAPI.getWithdrawalRequests(),
-        adminAPI.getPromoCodes(),
-        adminAPI.getTags(),
-      ]);
-      
-      // Admin-only data (settings and bank cards)
-      let settingsData = {};
-      let cardsData = [];
-      if (isAdmin) {
-        try {
-          const [settingsRes, cardsRes] = await Promise.all([
-            adminAPI.getSettings(),
-            adminAPI.getBankCards(),
-          ]);
-          settingsData = settingsRes.data;
-          cardsData = cardsRes.data;
-        } catch (e) {
-          console.log('Admin-only data not accessible');
-        }
-      }
-      
-      let rewardsData = [];
-      try {
-        const rewardsRes = await rewardsAPI.getAll();
-        rewardsData = rewardsRes.data;
-      } catch (e) {}
-
-      let missionsData = [];
-      try {
-        const missionsRes = await adminAPI.getMissions();
-        missionsData = missionsRes.data;
-      } catch (e) {}
-
-      let ticketsData = [];
-      try {
-        const ticketsRes = await adminAPI.getSupportTickets();
-        ticketsData = ticketsRes.data;
-      } catch (e) {}
-
-      let themesData = [];
-      try {
-        const themesRes = await adminAPI.getThemes();
-        themesData = themesRes.data;
-      } catch (e) {}
-
-      let deliveryMethodsData = [];
-      try {
-        const deliveryRes = await adminAPI.getDeliveryMethods();
-        deliveryMethodsData = deliveryRes.data;
-      } catch (e) {}
-
-      setStats(statsRes.data);
-      setUsers(usersRes.data);
-      setProducts(productsRes.data);
-      setCategories(categoriesRes.data);
-      setTopupCodes(codesRes.data);
-      setOrders(ordersRes.data);
-      setRewards(rewardsData);
-      setWheelPrizes(prizesRes.data);
-      setAdminSettings(settingsData);
-      setTopupRequests(requestsRes.data);
-      setWithdrawalRequests(withdrawalRes.data);
-      setPromoCodes(promoRes.data);
-      setTags(tagsRes.data);
-      setMissions(missionsData);
-      setSupportTickets(ticketsData);
-      setBankCards(cardsData);
-      setThemes(themesData);
-      setDeliveryMethods(deliveryMethodsData);
+      await Promise.all([loadLists(HEADER_LISTS), loadTab(activeTab, true)]);
     } catch (error) {
       console.error('Failed to fetch data:', error);
       toast.error('Ошибка загрузки данных');
@@ -205,6 +213,38 @@ export const Admin = () => {
     }
   };
 
+  // After a change: stats, badges and the open tab's lists; other tabs reload when opened next
+  const refreshData = () => {
+    loadedTabs.current = new Set([activeTab]);
+    adminAPI.getInbox().then(res => setInbox(res.data)).catch(() => {});
+    return Promise.all([loadLists(['stats', 'settings']), loadTab(activeTab, true), pagedLists[activeTab]?.reload()]);
+  };
+
+  // Admin-only file exports over the date range picked in the list filters
+  const handleExport = async (name, filters, extra = {}) => {
+    const params = { ...extra };
+    if (filters.date_from) params.date_from = filters.date_from;
+    if (filters.date_to) params.date_to = filters.date_to;
+    try {
+      const res = await adminAPI.exportData(name, params);
+      const disposition = res.headers['content-disposition'] || '';
+      const filename = disposition.match(/filename="([^"]+)"/)?.[1] || `${name}.csv`;
+      const url = URL.createObjectURL(res.data);
+      const link = document.createElement('a');
+      link.href = url;
+      link.download = filename;
+      link.click();
+      URL.revokeObjectURL(url);
+    } catch (error) {
+      toast.error('Ошибка экспорта');
+    }
+  };
+
+  const handleExportFullCards = () => {
+    if (!window.confirm('Выгрузить полные номера карт? Файл будет содержать платёжные данные.')) return;
+    handleExport('withdrawals', withdrawalsList.filters, { full_card: true });
+  };
+
   // Product handlers
   const handleAiAnalyze = async () => {
     if (!aiPrompt.trim()) {
@@ -235,9 +275,7 @@ export const Admin = () => {
       category_id: categories.find(c => c._id === aiResult.suggested_product.category_id)?._id || categories[0]?._id || ''
     });
     
-    // Switch to products tab
-    const productsTab = document.querySelector('[data-value="products"]');
-    if (productsTab) productsTab.click();
+    handleTabChange('products');
     
     toast.success('Данные применены! Проверьте и сохраните товар.');
   };
@@ -280,7 +318,7 @@ export const Admin = () => {
     });
       setProductImages([]); // Clear uploaded images
       setImageUrls(['']); // Reset URLs
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка сохранения товара');
     }
@@ -291,7 +329,7 @@ export const Admin = () => {
     try {
       await productsAPI.delete(id);
       toast.success('Товар удалён');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка удаления товара');
     }
@@ -304,7 +342,7 @@ export const Admin = () => {
       await categoriesAPI.create(newCategory);
       toast.success('Category created');
       setNewCategory({ name: '', name_ru: '', name_tj: '', slug: '', description: '', parent_id: '' });
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Failed to create category');
     }
@@ -315,7 +353,7 @@ export const Admin = () => {
     try {
       await categoriesAPI.delete(id);
       toast.success('Category deleted');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Failed to delete category');
     }
@@ -345,7 +383,7 @@ export const Admin = () => {
       await adminAPI.createTopupCode(newTopupCode);
       toast.success('Code created');
       setNewTopupCode({ code: '', amount: 100 });
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Failed to create code');
     }
@@ -355,7 +393,7 @@ export const Admin = () => {
     try {
       await adminAPI.deleteTopupCode(id);
       toast.success('Code deleted');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Failed to delete code');
     }
@@ -366,7 +404,7 @@ export const Admin = () => {
     try {
       await adminAPI.approveTopupRequest(id);
       toast.success('Request approved');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Failed to approve');
     }
@@ -377,7 +415,7 @@ export const Admin = () => {
     try {
       await adminAPI.rejectTopupRequest(id, note || '');
       toast.success('Request rejected');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Failed to reject');
     }
@@ -388,7 +426,7 @@ export const Admin = () => {
     try {
       await adminAPI.approveWithdrawalRequest(id);
       toast.success('Вывод одобрен');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка одобрения вывода');
     }
@@ -400,7 +438,7 @@ export const Admin = () => {
     try {
       await adminAPI.rejectWithdrawalRequest(id, note);
       toast.success('Вывод отклонен, средства возвращены пользователю');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка отклонения вывода');
     }
@@ -411,7 +449,7 @@ export const Admin = () => {
     try {
       await adminAPI.approveReturn(orderId);
       toast.success('Возврат одобрен, средства возвращены');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка при одобрении возврата');
     }
@@ -438,7 +476,7 @@ export const Admin = () => {
       toast.success('Тема создана!');
       setNewTheme({ name: '', icon: '🎨', hero_image: '', gradient: '', title_color: '', tagline: '' });
       setShowThemeForm(false);
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка создания темы');
     }
@@ -449,7 +487,7 @@ export const Admin = () => {
     try {
       await adminAPI.deleteTheme(id);
       toast.success('Тема удалена');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка удаления темы');
     }
@@ -492,7 +530,7 @@ export const Admin = () => {
     try {
       await adminAPI.updateUserRole(userId, newRole);
       toast.success('Роль пользователя обновлена');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка обновления роли');
     }
@@ -507,7 +545,7 @@ export const Admin = () => {
     try {
       await adminAPI.toggleAdmin(userId, !currentIsAdmin);
       toast.success('User status updated');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Failed to update user');
     }
@@ -523,7 +561,7 @@ export const Admin = () => {
     try {
       await adminAPI.deleteUser(userId);
       toast.success('User deleted');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Failed to delete user');
     }
@@ -533,7 +571,7 @@ export const Admin = () => {
     try {
       await adminAPI.updateOrderStatus(orderId, newStatus);
       toast.success(`Статус обновлен: ${newStatus}`);
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка обновления статуса');
     }
@@ -544,7 +582,7 @@ export const Admin = () => {
     try {
       await adminAPI.deleteOrder(orderId);
       toast.success('Заказ удален');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка при удалении заказа');
     }
@@ -600,7 +638,7 @@ export const Admin = () => {
       await adminAPI.updateUserXP(editingUser.user_id, parseInt(editXP));
       toast.success('User updated');
       setEditingUser(null);
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Failed to update user');
     }
@@ -639,7 +677,7 @@ export const Admin = () => {
         toast.success('Reward created');
       }
       setNewReward({ level_required: 1, name: '', description: '', reward_type: 'coins', value: 50, is_exclusive: false });
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Failed to save reward');
     }
@@ -650,7 +688,7 @@ export const Admin = () => {
     try {
       await adminAPI.deleteReward(id);
       toast.success('Reward deleted');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Failed to delete reward');
     }
@@ -688,7 +726,7 @@ export const Admin = () => {
         toast.success('Prize created');
       }
       setNewPrize({ name: '', prize_type: 'coins', value: 10, probability: 0.2, color: '#0D9488' });
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Failed to save prize');
     }
@@ -699,7 +737,7 @@ export const Admin = () => {
     try {
       await adminAPI.deleteWheelPrize(id);
       toast.success('Prize deleted');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Failed to delete prize');
     }
@@ -720,7 +758,7 @@ export const Admin = () => {
       await adminAPI.createPromoCode(promoData);
       toast.success('Промокод создан!');
       setNewPromoCode({ code: '', discount_percent: 10, usage_limit: 0, expires_at: '' });
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка создания промокода');
     }
@@ -730,7 +768,7 @@ export const Admin = () => {
     try {
       await adminAPI.deletePromoCode(id);
       toast.success('Промокод удалён');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка удаления промокода');
     }
@@ -740,7 +778,7 @@ export const Admin = () => {
     try {
       await adminAPI.togglePromoCode(id);
       toast.success('Статус изменён');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка изменения статуса');
     }
@@ -751,7 +789,7 @@ export const Admin = () => {
     try {
       await adminAPI.updateProductDiscount(productId, discountPercent);
       toast.success('Скидка обновлена');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка обновления скидки');
     }
@@ -795,7 +833,7 @@ export const Admin = () => {
         toast.success('Миссия создана!');
       }
       setNewMission({ title: '', description: '', mission_type: 'orders_count', target_value: 5, reward_type: 'coins', reward_value: 100, min_level: 1 });
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка сохранения миссии');
     }
@@ -806,7 +844,7 @@ export const Admin = () => {
     try {
       await adminAPI.deleteMission(id);
       toast.success('Миссия удалена');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка удаления миссии');
     }
@@ -816,7 +854,7 @@ export const Admin = () => {
     try {
       await adminAPI.toggleMission(id);
       toast.success('Статус изменён');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка изменения статуса');
     }
@@ -833,7 +871,7 @@ export const Admin = () => {
       await adminAPI.createTag(newTag);
       toast.success('Тег создан!');
       setNewTag({ name: '', slug: '', color: '#0D9488' });
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка создания тега');
     }
@@ -843,7 +881,7 @@ export const Admin = () => {
     try {
       await adminAPI.deleteTag(id);
       toast.success('Тег удалён');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка удаления тега');
     }
@@ -858,7 +896,7 @@ export const Admin = () => {
     try {
       await adminAPI.respondToTicket(ticketId, response, 'resolved');
       toast.success('Ответ отправлен');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка отправки ответа');
     }
@@ -875,7 +913,7 @@ export const Admin = () => {
       await adminAPI.createBankCard(newBankCard);
       toast.success('Карта добавлена!');
       setNewBankCard({ card_number: '', card_holder: '', bank_name: '' });
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка добавления карты');
     }
@@ -885,7 +923,7 @@ export const Admin = () => {
     try {
       await adminAPI.toggleBankCard(id);
       toast.success('Статус изменён');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка изменения статуса');
     }
@@ -895,7 +933,7 @@ export const Admin = () => {
     try {
       await adminAPI.deleteBankCard(id);
       toast.success('Карта удалена');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка удаления карты');
     }
@@ -914,7 +952,7 @@ export const Admin = () => {
         toast.success('Способ доставки создан');
       }
       setNewDeliveryMethod({ name: '', description: '', cost: 0, delivery_days: 1 });
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка сохранения способа доставки');
     }
@@ -925,7 +963,7 @@ export const Admin = () => {
     try {
       await adminAPI.deleteDeliveryMethod(id);
       toast.success('Способ доставки удален');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка удаления');
     }
@@ -935,7 +973,7 @@ export const Admin = () => {
     try {
       await adminAPI.updateDeliveryMethod(id, { is_active: newStatus });
       toast.success(newStatus ? 'Способ активирован' : 'Способ деактивирован');
-      fetchAllData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка обновления');
     }
@@ -960,6 +998,9 @@ export const Admin = () => {
   const pendingRequests = topupRequests.filter(r => r.status === 'pending');
   const pendingWithdrawals = withdrawalRequests.filter(r => r.status === 'pending');
   const openTickets = supportTickets.filter(t => t.status === 'open');
+  const pendingRequestsCount = inbox?.topup_requests?.pending ?? pendingRequests.length;
+  const pendingWithdrawalsCount = inbox?.withdrawal_requests?.pending ?? pendingWithdrawals.length;
+  const openTicketsCount = inbox?.support_tickets?.pending ?? openTickets.length;
 
   // Group orders by user
   const groupedOrders = orders.reduce((acc, order) => {
@@ -967,8 +1008,8 @@ export const Admin = () => {
     if (!acc[userId]) {
       acc[userId] = {
         user_id: userId,
-        user_name: order.user_name || 'Unknown User',
-        user_email: order.user_email || '',
+        user_name: order.user_info?.name || order.user_name || 'Unknown User',
+        user_email: order.user_info?.email || order.user_email || '',
         orders: []
       };
     }
@@ -1076,7 +1117,7 @@ export const Admin = () => {
                       await adminAPI.updateRevenue(parseFloat(newRevenueValue));
                       toast.success('Выручка обновлена');
                       setIsEditingRevenue(false);
-                      fetchAllData();
+                      refreshData();
                     } catch (e) {
                       toast.error('Ошибка обновления');
                     }
@@ -1115,7 +1156,7 @@ export const Admin = () => {
                         try {
                           await adminAPI.resetRevenue();
                           toast.success('Выручка сброшена');
-                          fetchAllData();
+                          refreshData();
                         } catch (e) {
                           toast.error('Ошибка сброса');
                         }
@@ -1132,31 +1173,51 @@ export const Admin = () => {
         )}
 
         {/* Pending Requests Alert */}
-        {pendingRequests.length > 0 && (
+        {pendingRequestsCount > 0 && (
           <div className="mb-6 p-4 bg-yellow-500/20 border border-yellow-500/50 rounded-xl flex items-center gap-3">
             <Clock className="w-6 h-6 text-yellow-400" />
             <p className="text-yellow-200">
-              <span className="font-bold">{pendingRequests.length}</span> {t('admin.topupRequests')} ожидают проверки!
+              <span className="font-bold">{pendingRequestsCount}</span> {t('admin.topupRequests')} ожидают проверки!
             </p>
           </div>
         )}
 
+        {/* Admin queues */}
+        {inbox && (
+          <div className="grid grid-cols-2 md:grid-cols-6 gap-2 mb-6" data-testid="admin-inbox">
+            {INBOX_QUEUES.map(([queue, label, tab]) => (
+              <button
+                key={queue}
+                onClick={() => handleTabChange(tab)}
+                className="admin-card p-3 text-left hover:border-primary transition-colors"
+                data-testid={`inbox-${queue}`}
+              >
+                <p className={`text-xl font-black ${inbox[queue]?.pending ? 'text-yellow-400' : ''}`}>{inbox[queue]?.pending ?? 0}</p>
+                <p className="text-xs text-slate-400">{label}</p>
+                {inbox[queue]?.oldest_at && (
+                  <p className="text-[10px] text-slate-500">с {new Date(inbox[queue].oldest_at).toLocaleString()}</p>
+                )}
+              </button>
+            ))}
+          </div>
+        )}
+
         {/* Tabs */}
-        <Tabs defaultValue="requests" className="space-y-6">
+        <Tabs value={activeTab} onValueChange={handleTabChange} className="space-y-6">
           <TabsList className="bg-slate-800 border border-slate-700 flex-wrap h-auto gap-1 p-1">
             <TabsTrigger value="requests" className="relative" data-testid="tab-requests">
               {t('admin.topupRequests')}
-              {pendingRequests.length > 0 && (
+              {pendingRequestsCount > 0 && (
                 <span className="absolute -top-1 -right-1 w-5 h-5 bg-yellow-500 text-black text-xs font-bold rounded-full flex items-center justify-center">
-                  {pendingRequests.length}
+                  {pendingRequestsCount}
                 </span>
               )}
             </TabsTrigger>
             <TabsTrigger value="withdrawals" className="relative" data-testid="tab-withdrawals">
               Выводы
-              {pendingWithdrawals.length > 0 && (
+              {pendingWithdrawalsCount > 0 && (
                 <span className="absolute -top-1 -right-1 w-5 h-5 bg-yellow-500 text-black text-xs font-bold rounded-full flex items-center justify-center">
-                  {pendingWithdrawals.length}
+                  {pendingWithdrawalsCount}
                 </span>
               )}
             </TabsTrigger>
@@ -1186,9 +1247,9 @@ export const Admin = () => {
             <TabsTrigger value="support" data-testid="tab-support" className="relative">
               <MessageSquare className="w-4 h-4 mr-1" />
               Поддержка
-              {openTickets.length > 0 && (
+              {openTicketsCount > 0 && (
                 <span className="absolute -top-1 -right-1 w-5 h-5 bg-red-500 text-white text-xs font-bold rounded-full flex items-center justify-center">
-                  {openTickets.length}
+                  {openTicketsCount}
                 </span>
               )}
             </TabsTrigger>
@@ -1203,7 +1264,14 @@ export const Admin = () => {
           {/* Top-up Requests Tab */}
           <TabsContent value="requests" className="space-y-6">
             <div className="admin-card">
-              <h3 className="font-bold mb-4">{t('admin.topupRequests')} ({topupRequests.length})</h3>
+              <h3 className="font-bold mb-4">{t('admin.topupRequests')} ({topupList.total})</h3>
+              <ListFilters list={topupList} statuses={TOPUP_STATUSES} userFilter dateFilter>
+                {isAdmin && (
+                  <Button size="sm" variant="outline" onClick={() => handleExport('topup-history', topupList.filters)}>
+                    <Download className="w-4 h-4 mr-1" /> История баланса CSV
+                  </Button>
+                )}
+              </ListFilters>
               <div className="space-y-4 max-h-[600px] overflow-y-auto">
                 {topupRequests.length === 0 ? (
                   <p className="text-slate-400 text-center py-8">Заявок пока нет</p>
@@ -1227,6 +1295,12 @@ export const Admin = () => {
                           </div>
                           <p className="text-sm"><span className="text-slate-400">User:</span> {req.user_name} ({req.user_email})</p>
                           <p className="text-xs text-slate-400 mt-1">{new Date(req.created_at).toLocaleString()}</p>
+                          {req.duplicate_of && (
+                            <p className="text-xs text-red-400 mt-1">Повторный чек — уже использован в заявке {req.duplicate_of}</p>
+                          )}
+                          {req.similar_to && (
+                            <p className="text-xs text-amber-400 mt-1">Похожий чек — сравните с заявкой {req.similar_to}</p>
+                          )}
                         </div>
                         
                         {/* Receipt preview */}
@@ -1245,7 +1319,7 @@ export const Admin = () => {
                         )}
                       </div>
                       
-                      {req.status === 'pending' && (
+                      {['pending', 'pending_ai'].includes(req.status) && (
                         <div className="flex gap-2 mt-4">
                           <Button 
                             onClick={() => handleApproveRequest(req.request_id)}
@@ -1273,6 +1347,7 @@ export const Admin = () => {
                   ))
                 )}
               </div>
+              <ListPager list={topupList} />
             </div>
           </TabsContent>
 
@@ -1281,8 +1356,20 @@ export const Admin = () => {
             <div className="admin-card">
               <h3 className="font-bold mb-6 flex items-center gap-2">
                 <CreditCard className="w-5 h-5 text-primary" />
-                Заявки на вывод средств
+                Заявки на вывод средств ({withdrawalsList.total})
               </h3>
+              <ListFilters list={withdrawalsList} statuses={WITHDRAWAL_STATUSES} userFilter dateFilter>
+                {isAdmin && (
+                  <>
+                    <Button size="sm" variant="outline" onClick={() => handleExport('withdrawals', withdrawalsList.filters)}>
+                      <Download className="w-4 h-4 mr-1" /> CSV
+                    </Button>
+                    <Button size="sm" variant="outline" onClick={handleExportFullCards}>
+                      <Download className="w-4 h-4 mr-1" /> CSV с полными номерами карт
+                    </Button>
+                  </>
+                )}
+              </ListFilters>
               <div className="space-y-4">
                 {withdrawalRequests.length === 0 ? (
                   <div className="text-center py-12 bg-slate-800/30 rounded-2xl border border-dashed border-slate-700">
@@ -1338,6 +1425,7 @@ export const Admin = () => {
                   ))
                 )}
               </div>
+              <ListPager list={withdrawalsList} />
             </div>
           </TabsContent>
 
@@ -1793,7 +1881,14 @@ export const Admin = () => {
           {/* Users Tab */}
           <TabsContent value="users" className="space-y-6">
             <div className="admin-card">
-              <h3 className="font-bold mb-4">{t('admin.users')} ({users.length})</h3>
+              <h3 className="font-bold mb-4">{t('admin.users')} ({usersList.total})</h3>
+              <ListFilters list={usersList} statuses={USER_ROLES} statusKey="role" allLabel="Все роли" search>
+                {isAdmin && (
+                  <Button size="sm" variant="outline" onClick={() => handleExport('users', usersList.filters)}>
+                    <Download className="w-4 h-4 mr-1" /> CSV
+                  </Button>
+                )}
+              </ListFilters>
               <div className="space-y-2 max-h-[500px] overflow-y-auto">
                 {users.map((u) => (
                   <div key={u.user_id} className="flex items-center justify-between p-3 bg-slate-700 rounded-lg" data-testid={`admin-user-${u.user_id}`}>
@@ -1853,6 +1948,7 @@ export const Admin = () => {
                   </div>
                 ))}
               </div>
+              <ListPager list={usersList} />
             </div>
           </TabsContent>
 
@@ -2462,7 +2558,14 @@ export const Admin = () => {
           {/* Orders Tab */}
           <TabsContent value="orders" className="space-y-6">
             <div className="admin-card">
-              <h3 className="font-bold mb-4">{t('admin.orders')} ({orders.length})</h3>
+              <h3 className="font-bold mb-4">{t('admin.orders')} ({ordersList.total})</h3>
+              <ListFilters list={ordersList} statuses={ORDER_STATUSES} userFilter dateFilter>
+                {isAdmin && (
+                  <Button size="sm" variant="outline" onClick={() => handleExport('orders', ordersList.filters)}>
+                    <Download className="w-4 h-4 mr-1" /> CSV
+                  </Button>
+                )}
+              </ListFilters>
               <div className="space-y-8 max-h-[800px] overflow-y-auto pr-2">
                 {orders.length === 0 ? (
                   <p className="text-slate-400 text-center py-8">Заказов пока нет</p>
@@ -2531,6 +2634,18 @@ export const Admin = () => {
                                 </div>
                               </div>
                               <div className="space-y-2">
+                                {o.delivery_method && (
+                                  <div className="p-2 bg-slate-800/50 rounded text-sm">
+                                    <span className="text-slate-400 flex items-center gap-1"><Truck className="w-3 h-3" /> Способ доставки:</span>
+                                    <p className="text-white">{o.delivery_method.name} · {o.delivery_method.cost} c. · {o.delivery_method.delivery_days} дн.</p>
+                                  </div>
+                                )}
+                                {o.delivery_person && (
+                                  <div className="p-2 bg-slate-800/50 rounded text-sm">
+                                    <span className="text-slate-400 flex items-center gap-1"><Truck className="w-3 h-3" /> Доставщик:</span>
+                                    <p className="text-white">{o.delivery_person.name} ({o.delivery_person.email})</p>
+                                  </div>
+                                )}
                                 {o.delivery_address && (
                                   <div className="p-2 bg-slate-800/50 rounded text-sm">
                                     <span className="text-slate-400 flex items-center gap-1"><MapPin className="w-3 h-3" /> Адрес:</span>
@@ -2604,6 +2719,7 @@ export const Admin = () => {
                   ))
                 )}
               </div>
+              <ListPager list={ordersList} />
             </div>
           </TabsContent>
 
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { Button } from '../components/ui/button';
 import { useAuth } from '../context/AuthContext';
@@ -8,17 +8,24 @@ import {
   Truck, Package, Clock, CheckCircle, XCircle, Eye, Loader2, RefreshCw
 } from 'lucide-react';
 import { toast } from 'sonner';
+import { usePagedList } from '../hooks/use-paged-list';
+import { ListFilters, ListPager, ORDER_STATUSES } from '../components/ListControls';
 
 export const Delivery = () => {
   const navigate = useNavigate();
   const { user, isAuthenticated, loading: authLoading } = useAuth();
   const { t, lang } = useLanguage();
   
-  const [loading, setLoading] = useState(true);
-  const [orders, setOrders] = useState([]);
-
   const isDelivery = user?.role === 'delivery' || user?.role === 'admin' || user?.is_admin;
 
+  // One filtered page at a time; the total comes from X-Total-Count
+  const ordersList = usePagedList(adminAPI.getOrders, {
+    params: { expand: true },
+    enabled: !authLoading && isAuthenticated && isDelivery,
+    onError: () => toast.error(lang === 'ru' ? 'Ошибка загрузки заказов' : 'Хатои боркунии фармоишҳо'),
+  });
+  const { items: orders, loading, reload: fetchOrders } = ordersList;
+
   useEffect(() => {
     if (authLoading) return;
     
@@ -26,22 +33,8 @@ export const Delivery = () => {
       navigate('/');
       return;
     }
-    fetchOrders();
   }, [isAuthenticated, isDelivery, navigate, authLoading]);
 
-  const fetchOrders = async () => {
-    setLoading(true);
-    try {
-      const ordersRes = await adminAPI.getOrders();
-      setOrders(ordersRes.data);
-    } catch (error) {
-      console.error('Failed to fetch orders:', error);
-      toast.error(lang === 'ru' ? 'Ошибка загрузки заказов' : 'Хатои боркунии фармоишҳо');
-    } finally {
-      setLoading(false);
-    }
-  };
-
   const handleUpdateOrderStatus = async (orderId, status) => {
     try {
       let trackingNumber = null;
@@ -56,7 +49,7 @@ export const Delivery = () => {
     }
   };
 
-  if (loading && orders.length === 0) {
+  if (authLoading) {
     return (
       <div className="min-h-screen bg-[#0F172A] flex items-center justify-center">
         <Loader2 className="w-12 h-12 animate-spin text-primary" />
@@ -80,7 +73,7 @@ export const Delivery = () => {
           <Button 
             variant="outline" 
             className="border-slate-700 hover:bg-slate-800"
-            onClick={fetchOrders} 
+            onClick={() => fetchOrders()} 
             disabled={loading}
           >
             <RefreshCw className={`w-4 h-4 mr-2 ${loading ? 'animate-spin' : ''}`} />
@@ -92,9 +85,10 @@ export const Delivery = () => {
           <div className="flex items-center justify-between mb-2">
             <h3 className="font-bold text-lg flex items-center gap-2">
               <Package className="w-5 h-5 text-primary" />
-              {lang === 'ru' ? `Все заказы (${orders.length})` : `Ҳамаи фармоишҳо (${orders.length})`}
+              {lang === 'ru' ? `Все заказы (${ordersList.total})` : `Ҳамаи фармоишҳо (${ordersList.total})`}
             </h3>
           </div>
+          <ListFilters list={ordersList} statuses={ORDER_STATUSES} userFilter dateFilter />
 
           {orders.length === 0 ? (
             <div className="bg-slate-900/50 border border-slate-800 rounded-xl p-12 text-center">
@@ -132,8 +126,14 @@ export const Delivery = () => {
                           <p className="font-bold text-lg">{order.total} coins</p>
                           <p className="text-sm text-slate-400">
                             {lang === 'ru' ? 'Покупатель: ' : 'Харидор: '}
-                            <span className="text-slate-200">{order.user_email || order.user_id}</span>
+                            <span className="text-slate-200">{order.user_info?.name || order.user_email || order.user_id}</span>
                           </p>
+                          {order.delivery_method && (
+                            <p className="text-sm text-slate-400">
+                              {lang === 'ru' ? 'Доставка: ' : 'Расонидан: '}
+                              <span className="text-slate-200">{order.delivery_method.name}</span>
+                            </p>
+                          )}
                         </div>
 
                         <div className="flex flex-wrap gap-2">
@@ -214,6 +214,7 @@ export const Delivery = () => {
               })}
             </div>
           )}
+          <ListPager list={ordersList} />
         </div>
       </div>
     </div>
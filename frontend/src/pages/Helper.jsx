@@ -19,6 +19,8 @@ import {
   Package, ShoppingCart, CreditCard, Loader2, Check, X, Eye, Plus, Trash2, Clock, CheckCircle, XCircle, Edit2, Gift, Sparkles, Target, Edit, MessageSquare
 } from 'lucide-react';
 import { toast } from 'sonner';
+import { usePagedList } from '../hooks/use-paged-list';
+import { ListFilters, ListPager, ORDER_STATUSES, TOPUP_STATUSES } from '../components/ListControls';
 
 export const Helper = () => {
   const navigate = useNavigate();
@@ -28,8 +30,6 @@ export const Helper = () => {
   const [loading, setLoading] = useState(true);
   const [products, setProducts] = useState([]);
   const [categories, setCategories] = useState([]);
-  const [topupRequests, setTopupRequests] = useState([]);
-  const [orders, setOrders] = useState([]);
   const [rewards, setRewards] = useState([]);
   const [wheelPrizes, setWheelPrizes] = useState([]);
   const [missions, setMissions] = useState([]);
@@ -57,6 +57,13 @@ export const Helper = () => {
 
   const isHelper = user?.role === 'helper' || user?.role === 'admin';
 
+  // Server-paged with filters; totals come from X-Total-Count
+  const [inbox, setInbox] = useState(null);
+  const topupList = usePagedList(adminAPI.getTopupRequests, { enabled: !authLoading && isHelper });
+  const ordersList = usePagedList(adminAPI.getOrders, { params: { expand: true }, enabled: !authLoading && isHelper });
+  const topupRequests = topupList.items;
+  const orders = ordersList.items;
+
   useEffect(() => {
     if (authLoading) return;
     
@@ -70,11 +77,10 @@ export const Helper = () => {
   const fetchData = async () => {
     setLoading(true);
     try {
-      const [productsRes, categoriesRes, requestsRes, ordersRes, rewardsRes, prizesRes, missionsRes] = await Promise.all([
+      const [productsRes, categoriesRes, inboxRes, rewardsRes, prizesRes, missionsRes] = await Promise.all([
         productsAPI.getAll(),
         categoriesAPI.getAll(),
-        adminAPI.getTopupRequests(),
-        adminAPI.getOrders(),
+        adminAPI.getInbox(),
         adminAPI.getRewards ? adminAPI.getRewards() : { data: [] },
         adminAPI.getWheelPrizes ? adminAPI.getWheelPrizes() : { data: [] },
         adminAPI.getMissions ? adminAPI.getMissions() : { data: [] }
@@ -82,8 +88,7 @@ export const Helper = () => {
       
       setProducts(productsRes.data);
       setCategories(categoriesRes.data);
-      setTopupRequests(requestsRes.data);
-      setOrders(ordersRes.data);
+      setInbox(inboxRes.data);
       setRewards(rewardsRes.data || []);
       setWheelPrizes(prizesRes.data || []);
       setMissions(missionsRes.data || []);
@@ -95,6 +100,13 @@ export const Helper = () => {
     }
   };
 
+  // After a change: the static lists plus the open pages of requests and orders
+  const refreshData = () => {
+    topupList.reload();
+    ordersList.reload();
+    return fetchData();
+  };
+
   // Product handlers
   const handleCreateProduct = async (e) => {
     e.preventDefault();
@@ -122,7 +134,7 @@ export const Helper = () => {
       });
       setProductImages([]);
       setImageUrls(['']);
-      fetchData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка создания товара');
     }
@@ -154,7 +166,7 @@ export const Helper = () => {
       setEditingProduct(null);
       setProductImages([]);
       setImageUrls(['']);
-      fetchData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка обновления товара');
     }
@@ -165,7 +177,7 @@ export const Helper = () => {
     try {
       await productsAPI.delete(productId);
       toast.success(lang === 'ru' ? 'Товар удален' : 'Мол нест шуд');
-      fetchData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка удаления');
     }
@@ -202,7 +214,7 @@ export const Helper = () => {
     try {
       await adminAPI.approveTopup(requestId);
       toast.success('Заявка одобрена!');
-      fetchData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка');
     }
@@ -213,7 +225,7 @@ export const Helper = () => {
     try {
       await adminAPI.rejectTopup(requestId);
       toast.success('Заявка отклонена');
-      fetchData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка');
     }
@@ -228,7 +240,7 @@ export const Helper = () => {
       }
       await adminAPI.updateOrderStatus(orderId, status, null, trackingNumber);
       toast.success(lang === 'ru' ? 'Статус обновлён!' : 'Вазъият навсозӣ шуд!');
-      fetchData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка');
     }
@@ -264,7 +276,7 @@ export const Helper = () => {
         toast.success('Reward created');
       }
       setNewReward({ level_required: 1, name: '', description: '', reward_type: 'coins', value: 50, is_exclusive: false });
-      fetchData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Failed to save reward');
     }
@@ -275,7 +287,7 @@ export const Helper = () => {
     try {
       await adminAPI.deleteReward(id);
       toast.success('Reward deleted');
-      fetchData();
+      refreshData();
     } catch (error) {
       toast.error('Failed to delete reward');
     }
@@ -310,7 +322,7 @@ export const Helper = () => {
         toast.success('Prize created');
       }
       setNewPrize({ name: '', prize_type: 'coins', value: 10, probability: 0.2, color: '#0D9488' });
-      fetchData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Failed to save prize');
     }
@@ -321,7 +333,7 @@ export const Helper = () => {
     try {
       await adminAPI.deleteWheelPrize(id);
       toast.success('Prize deleted');
-      fetchData();
+      refreshData();
     } catch (error) {
       toast.error('Failed to delete prize');
     }
@@ -362,7 +374,7 @@ export const Helper = () => {
         toast.success('Миссия создана!');
       }
       setNewMission({ title: '', description: '', mission_type: 'orders_count', target_value: 5, reward_type: 'coins', reward_value: 100, min_level: 1 });
-      fetchData();
+      refreshData();
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Ошибка сохранения миссии');
     }
@@ -373,7 +385,7 @@ export const Helper = () => {
     try {
       await adminAPI.deleteMission(id);
       toast.success('Миссия удалена');
-      fetchData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка удаления миссии');
     }
@@ -383,7 +395,7 @@ export const Helper = () => {
     try {
       await adminAPI.toggleMission(id);
       toast.success('Статус изменён');
-      fetchData();
+      refreshData();
     } catch (error) {
       toast.error('Ошибка изменения статуса');
     }
@@ -414,7 +426,7 @@ export const Helper = () => {
     );
   }
 
-  const pendingRequests = topupRequests.filter(r => r.status === 'pending');
+  const pendingRequestsCount = inbox?.topup_requests?.pending ?? topupRequests.filter(r => r.status === 'pending').length;
 
   return (
     <div className="min-h-screen admin-panel">
@@ -436,7 +448,7 @@ export const Helper = () => {
         <div className="grid grid-cols-2 md:grid-cols-3 gap-4 mb-8">
           <div className="admin-card">
             <CreditCard className="w-6 h-6 text-yellow-500 mb-2" />
-            <p className="text-2xl font-bold">{pendingRequests.length}</p>
+            <p className="text-2xl font-bold">{pendingRequestsCount}</p>
             <p className="text-sm text-slate-400">{lang === 'ru' ? 'Ожидают' : 'Интизорӣ'}</p>
           </div>
           <div className="admin-card">
@@ -446,7 +458,7 @@ export const Helper = () => {
           </div>
           <div className="admin-card">
             <ShoppingCart className="w-6 h-6 text-blue-500 mb-2" />
-            <p className="text-2xl font-bold">{orders.length}</p>
+            <p className="text-2xl font-bold">{ordersList.total}</p>
             <p className="text-sm text-slate-400">{lang === 'ru' ? 'Заказов' : 'Фармоишҳо'}</p>
           </div>
         </div>
@@ -457,9 +469,9 @@ export const Helper = () => {
             <TabsTrigger value="topup" className="admin-tab">
               <CreditCard className="w-4 h-4 mr-2" />
               {lang === 'ru' ? 'Пополнения' : 'Пуркунӣ'}
-              {pendingRequests.length > 0 && (
+              {pendingRequestsCount > 0 && (
                 <span className="ml-2 bg-red-500 text-white text-[10px] px-1.5 py-0.5 rounded-full">
-                  {pendingRequests.length}
+                  {pendingRequestsCount}
                 </span>
               )}
             </TabsTrigger>
@@ -488,8 +500,9 @@ export const Helper = () => {
           {/* Topup Requests Tab */}
           <TabsContent value="topup" className="space-y-4">
             <h3 className="font-bold text-lg">
-              {lang === 'ru' ? `Заявки на пополнение (${topupRequests.length})` : `Дархостҳои пуркунӣ (${topupRequests.length})`}
+              {lang === 'ru' ? `Заявки на пополнение (${topupList.total})` : `Дархостҳои пуркунӣ (${topupList.total})`}
             </h3>
+            <ListFilters list={topupList} statuses={TOPUP_STATUSES} userFilter dateFilter />
             {topupRequests.length === 0 ? (
               <p className="text-slate-400">{lang === 'ru' ? 'Нет заявок' : 'Дархост нест'}</p>
             ) : (
@@ -508,6 +521,12 @@ export const Helper = () => {
                         <p className="font-bold text-primary">+{req.amount}</p>
                         <p className="text-sm text-slate-400">User: {req.user_name} ({req.user_email})</p>
                         <p className="text-xs text-slate-500">{new Date(req.created_at).toLocaleString()}</p>
+                        {req.duplicate_of && (
+                          <p className="text-xs text-red-400">Повторный чек — уже использован в заявке {req.duplicate_of}</p>
+                        )}
+                        {req.similar_to && (
+                          <p className="text-xs text-amber-400">Похожий чек — сравните с заявкой {req.similar_to}</p>
+                        )}
                       </div>
                     </div>
                     <div className="flex items-center gap-2">
@@ -521,7 +540,7 @@ export const Helper = () => {
                           {lang === 'ru' ? 'Чек' : 'Чек'}
                         </Button>
                       )}
-                      {req.status === 'pending' && (
+                      {['pending', 'pending_ai'].includes(req.status) && (
                         <>
                           <Button 
                             size="sm" 
@@ -539,7 +558,7 @@ export const Helper = () => {
                           </Button>
                         </>
                       )}
-                      {req.status !== 'pending' && (
+                      {!['pending', 'pending_ai'].includes(req.status) && (
                         <span className={`text-xs px-2 py-1 rounded-full ${
                           req.status === 'approved' ? 'bg-green-500/20 text-green-400' : 'bg-red-500/20 text-red-400'
                         }`}>
@@ -554,6 +573,7 @@ export const Helper = () => {
                 ))}
               </div>
             )}
+            <ListPager list={topupList} />
           </TabsContent>
 
           {/* Products Tab */}
@@ -724,8 +744,9 @@ export const Helper = () => {
           {/* Orders Tab */}
           <TabsContent value="orders" className="space-y-4">
             <h3 className="font-bold text-lg">
-              {lang === 'ru' ? `Заказы (${orders.length})` : `Фармоишҳо (${orders.length})`}
+              {lang === 'ru' ? `Заказы (${ordersList.total})` : `Фармоишҳо (${ordersList.total})`}
             </h3>
+            <ListFilters list={ordersList} statuses={ORDER_STATUSES} userFilter dateFilter />
             {orders.length === 0 ? (
               <p className="text-slate-400">{lang === 'ru' ? 'Нет заказов' : 'Фармоиш нест'}</p>
             ) : (
@@ -746,7 +767,10 @@ export const Helper = () => {
                       <div className="flex items-start justify-between">
                         <div>
                           <p className="font-bold">#{order.order_id.slice(-8).toUpperCase()}</p>
-                          <p className="text-sm text-slate-400">{order.user_email}</p>
+                          <p className="text-sm text-slate-400">{order.user_info?.name} {order.user_info?.email || order.user_email}</p>
+                          {order.delivery_person && (
+                            <p className="text-sm text-slate-400">🚚 {order.delivery_person.name}</p>
+                          )}
                           <p className="text-sm text-slate-400">📍 {order.delivery_address}</p>
                         </div>
                         <div className="text-right">
@@ -774,6 +798,7 @@ export const Helper = () => {
                 })}
               </div>
             )}
+            <ListPager list={ordersList} />
           </TabsContent>
 
           {/* Rewards Tab */}
@@ -119,6 +119,22 @@ export const Home = () => {
     fetchData();
   }, []);
 
+  // Live activity: new entries arrive over server-sent events instead of polling
+  useEffect(() => {
+    if (typeof EventSource === 'undefined') return undefined;
+    const source = new EventSource(gamificationAPI.activityStreamUrl());
+    source.onmessage = (e) => {
+      const activity = JSON.parse(e.data);
+      setActivities(prev => [activity, ...prev.filter(a => a.activity_id !== activity.activity_id)].slice(0, 20));
+    };
+    source.addEventListener('resync', () => {
+      gamificationAPI.getActivityFeed()
+        .then(res => setActivities(res.data || []))
+        .catch(() => {});
+    });
+    return () => source.close();
+  }, []);
+
   const handleAddToCart = (product) => {
     if (!isAuthenticated) {
       toast.error(t('cart.empty'));
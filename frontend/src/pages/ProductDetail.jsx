@@ -38,6 +38,8 @@ export const ProductDetail = () => {
   const [currentImageIndex, setCurrentImageIndex] = useState(0);
   // Reviews state
   const [reviews, setReviews] = useState([]);
+  const [reviewsCursor, setReviewsCursor] = useState(null);
+  const [loadingMoreReviews, setLoadingMoreReviews] = useState(false);
   const [newReviewRating, setNewReviewRating] = useState(5);
   const [newReviewComment, setNewReviewComment] = useState('');
   const [submittingReview, setSubmittingReview] = useState(false);
@@ -52,6 +54,7 @@ export const ProductDetail = () => {
         
         setProduct(prodRes.data);
         setReviews(reviewsRes.data);
+        setReviewsCursor(reviewsRes.headers['x-next-cursor'] || null);
         
         if (prodRes.data.sizes?.length > 0) {
           setSelectedSize(prodRes.data.sizes[0]);
@@ -106,7 +109,7 @@ export const ProductDetail = () => {
           return {
             ...rev,
             is_sparkled: res.data.sparkled,
-            sparkles: res.data.sparkled ? (rev.sparkles || 0) + 1 : Math.max(0, (rev.sparkles || 0) - 1)
+            sparkles: res.data.sparkles ?? (res.data.sparkled ? (rev.sparkles || 0) + 1 : Math.max(0, (rev.sparkles || 0) - 1))
           };
         }
         return rev;
@@ -116,6 +119,20 @@ export const ProductDetail = () => {
     }
   };
 
+  const loadMoreReviews = async () => {
+    if (!reviewsCursor) return;
+    setLoadingMoreReviews(true);
+    try {
+      const res = await reviewsAPI.getForProduct(id, { cursor: reviewsCursor });
+      setReviews(prev => [...prev, ...res.data]);
+      setReviewsCursor(res.headers['x-next-cursor'] || null);
+    } catch (error) {
+      console.error('Failed to load reviews:', error);
+    } finally {
+      setLoadingMoreReviews(false);
+    }
+  };
+
   const handleSubmitReview = async (e) => {
     e.preventDefault();
     if (!isAuthenticated) {
@@ -135,6 +152,7 @@ export const ProductDetail = () => {
         comment: newReviewComment
       });
       setReviews([res.data, ...reviews]);
+      setProduct(prev => ({ ...prev, rating_count: (prev.rating_count || 0) + 1 }));
       setNewReviewComment('');
       setNewReviewRating(5);
       toast.success('Review added!');
@@ -424,7 +442,7 @@ export const ProductDetail = () => {
           <div className="flex items-center justify-between border-b pb-4">
             <h2 className="text-3xl font-bold flex items-center gap-3">
               <MessageSquare className="w-8 h-8 text-primary" />
-              {t('product.reviews')} ({reviews.length})
+              {t('product.reviews')} ({product.rating_count ?? reviews.length})
             </h2>
           </div>
 
@@ -522,6 +540,18 @@ export const ProductDetail = () => {
                   <p className="text-muted-foreground">{t('product.noReviews')}</p>
                 </div>
               )}
+              {reviewsCursor && (
+                <div className="text-center">
+                  <Button
+                    variant="outline"
+                    className="rounded-full"
+                    onClick={loadMoreReviews}
+                    disabled={loadingMoreReviews}
+                  >
+                    {t('product.moreReviews')}
+                  </Button>
+                </div>
+              )}
             </div>
           </div>
         </div>
@@ -4,7 +4,7 @@ import { Button } from '../components/ui/button';
 import { Input } from '../components/ui/input';
 import { useAuth } from '../context/AuthContext';
 import { useLanguage } from '../context/LanguageContext';
-import { topupAPI, bankCardsAPI } from '../lib/api';
+import { topupAPI, bankCardsAPI, eventsAPI } from '../lib/api';
 import { Wallet, Copy, Check, Upload, Clock, CheckCircle, XCircle, Image, AlertCircle, CreditCard } from 'lucide-react';
 import { toast } from 'sonner';
 
@@ -87,7 +87,7 @@ export const TopUp = () => {
 
     setLoading(true);
     try {
-      await topupAPI.createRequest({
+      const res = await topupAPI.createRequest({
         amount: parseFloat(amount),
         receipt_url: receiptUrl,
       });
@@ -97,8 +97,8 @@ export const TopUp = () => {
       setReceiptPreview(null);
       await fetchData();
       
-      // Start auto-checking for approval every 30 seconds
-      startStatusChecking();
+      // Start auto-checking for approval
+      startStatusChecking(res.data.request_id);
     } catch (error) {
       toast.error(error.response?.data?.detail || t('common.error'));
     } finally {
@@ -106,38 +106,87 @@ export const TopUp = () => {
     }
   };
 
-  // Auto-check status every 30 seconds
-  const startStatusChecking = () => {
-    const checkInterval = setInterval(async () => {
+  const stopCheckingRef = useRef(null);
+  useEffect(() => () => stopCheckingRef.current?.(), []);
+
+  const handleStatus = async (status) => {
+    if (status === 'approved') {
+      toast.success(t('topup.approved'));
+      await refreshUser();
+      navigate('/profile');
+      return true;
+    }
+    if (status !== 'pending' && status !== 'pending_ai') {
+      await fetchData();
+      return true;
+    }
+    return false;
+  };
+
+  // Wait for approval: pushed over the user's event stream, plus a slow poll. With several
+  // workers and no event relay the event may be published on a worker we are not connected to.
+  const startStatusChecking = (requestId) => {
+    stopCheckingRef.current?.();
+    const streaming = typeof EventSource !== 'undefined';
+    const startedAt = Date.now();
+    let finished = false;
+    let source = null;
+    let timer = null;
+    const stop = () => {
+      finished = true;
+      source?.close();
+      clearTimeout(timer);
+    };
+    stopCheckingRef.current = stop;
+
+    const apply = async (status) => {
+      if (!finished && await handleStatus(status)) stop();
+    };
+    const recheck = async () => {
       try {
-        const res = await topupAPI.getRequests();
-        const data = Array.isArray(res.data) ? res.data : [];
-        const pendingRequests = data.filter(r => r.status === 'pending');
-        const approvedRecently = data.find(r => 
-          r.status === 'approved' && 
-          new Date(r.created_at) > new Date(Date.now() - 10 * 60 * 1000) // last 10 minutes
-        );
-        
-        if (approvedRecently) {
-          clearInterval(checkInterval);
-          toast.success(t('topup.approved'));
-          await refreshUser();
-          navigate('/profile');
-        }
-        
-        // Stop checking if no pending requests
-        if (pendingRequests.length === 0) {
-          clearInterval(checkInterval);
-        }
+        const res = await topupAPI.getRequest(requestId);
+        await apply(res.data.status);
+        return res.data.status;
       } catch (error) {
         console.error('Status check error:', error);
+        return 'pending';
       }
-    }, 30000); // 30 seconds
-    
-    // Clean up after 10 minutes
-    setTimeout(() => {
-      clearInterval(checkInterval);
-    }, 10 * 60 * 1000);
+    };
+
+    const openStream = async () => {
+      if (finished) return;
+      try {
+        const res = await eventsAPI.getStreamTicket();
+        if (finished) return;
+        source = new EventSource(eventsAPI.streamUrl(res.data.ticket), { withCredentials: true });
+      } catch (error) {
+        console.error('Event stream error:', error);
+        return;
+      }
+      source.onmessage = async (e) => {
+        const event = JSON.parse(e.data);
+        if (event.type !== 'topup' || event.request_id !== requestId) return;
+        if (event.status === 'pending') await fetchData();
+        await apply(event.status);
+      };
+      // Re-read the request on (re)connect and after missed events, so no change slips through
+      source.onopen = recheck;
+      source.addEventListener('resync', recheck);
+      // Tickets are single-use: once the browser gives up reconnecting, open again with a new one
+      source.onerror = () => {
+        if (source.readyState === EventSource.CLOSED && !finished) setTimeout(openStream, 5000);
+      };
+    };
+
+    const poll = async () => {
+      const status = await recheck();
+      // Stop checking after 10 minutes
+      if (finished || Date.now() - startedAt > 10 * 60 * 1000) return;
+      timer = setTimeout(poll, !streaming && status === 'pending_ai' ? 5000 : 30000);
+    };
+
+    if (streaming) openStream();
+    timer = setTimeout(poll, streaming ? 30000 : 5000);
   };
 
   const getStatusIcon = (status) => {
@@ -151,6 +200,7 @@ export const TopUp = () => {
   const getStatusText = (status) => {
     const statusMap = {
       pending: t('topup.status.pending'),
+      pending_ai: t('topup.status.pending_ai'),
       approved: t('topup.status.approved'),
       rejected: t('topup.status.rejected'),
     };
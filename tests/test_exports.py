@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Tests for card masking and the streamed CSV/NDJSON export in backend/server.py.
+
+Run with `pytest tests/test_exports.py`.
+"""
+
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "tsmarket_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+CARD = "4111 1111 1111 1234"
+
+
+class FakeCursor:
+    """Stands in for a Motor cursor: chainable sort/batch_size, async iteration"""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, *args):
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield dict(doc)
+
+
+class FakeCollection:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, query, projection):
+        return FakeCursor(self.docs)
+
+
+def export(docs, columns, fmt, masks):
+    async def collect():
+        chunks = server.export_chunks(FakeCollection(docs), {}, columns, fmt, masks)
+        return b"".join([chunk async for chunk in chunks]).decode()
+    return asyncio.run(collect())
+
+
+def test_mask_card_number_keeps_last_four():
+    assert server.mask_card_number(CARD) == "**** 1234"
+    assert server.mask_card_number("4111-1111-1111-9876") == "**** 9876"
+    assert server.mask_card_number("123") == "****"
+
+
+def test_mask_card_numbers_in_text():
+    text = f"Заявка на вывод средств: 150.0 на карту {CARD}"
+    assert server.mask_card_numbers_in_text(text) == "Заявка на вывод средств: 150.0 на карту **** 1234"
+    # Amounts and short ids are left alone
+    assert server.mask_card_numbers_in_text("Пополнение 100000 по заявке 12345") == "Пополнение 100000 по заявке 12345"
+
+
+def test_withdrawals_csv_masks_card_number():
+    docs = [{"request_id": "wd_1", "card_number": CARD, "created_at": datetime(2026, 1, 1, tzinfo=timezone.utc)}]
+    body = export(docs, ["request_id", "card_number", "created_at"], "csv", server.EXPORT_MASKS["withdrawals"])
+    assert CARD not in body
+    assert "wd_1,**** 1234,2026-01-01T00:00:00+00:00" in body
+
+
+def test_topup_history_ndjson_masks_description():
+    docs = [{"history_id": "hist_1", "description": f"на карту {CARD}"}]
+    body = export(docs, ["history_id", "description"], "ndjson", server.EXPORT_MASKS["topup-history"])
+    assert json.loads(body) == {"history_id": "hist_1", "description": "на карту **** 1234"}
+
+
+def test_export_without_masks_keeps_full_values():
+    docs = [{"request_id": "wd_1", "card_number": CARD}]
+    body = export(docs, ["request_id", "card_number"], "csv", None)
+    assert CARD in body
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Equivalence tests and microbenchmark for the closed-form level math in backend/server.py.
+
+Run the tests with `pytest tests/test_level_math.py`,
+the benchmark with `python tests/test_level_math.py`.
+"""
+
+import asyncio
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "tsmarket_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+from server import (  # noqa: E402
+    calculate_level,
+    calculate_levels_batch,
+    level_threshold,
+    total_xp_for_level,
+    LEVEL_TABLE_SIZE,
+)
+
+
+def loop_calculate_level(xp):
+    """Original level-by-level implementation"""
+    level = 1
+    xp_needed = 100
+    total_xp_for_level = 0
+    while xp >= total_xp_for_level + xp_needed:
+        total_xp_for_level += xp_needed
+        level += 1
+        xp_needed = 100 + level * 50
+    return level
+
+
+def loop_total_xp_for_level(level):
+    """Original summing implementation"""
+    total = 0
+    for l in range(1, level):
+        total += 100 + l * 50
+    return total
+
+
+def sample_xp_values(seed=42, count=5000):
+    rng = random.Random(seed)
+    values = [rng.randrange(0, 10**9) for _ in range(count)]
+    values += [rng.uniform(0, 10**6) for _ in range(count)]
+    # Every level boundary and its neighbours
+    for level in range(1, 2000):
+        threshold = level_threshold(level)
+        values += [threshold - 1, threshold, threshold + 1]
+    values += [-100, -1, 0, 1, 99]
+    return values
+
+
+def test_calculate_level_matches_loop_exhaustively_for_small_xp():
+    for xp in range(0, 200000):
+        assert calculate_level(xp) == loop_calculate_level(xp), xp
+
+
+def test_calculate_level_matches_loop_for_random_and_boundary_xp():
+    for xp in sample_xp_values():
+        assert calculate_level(xp) == loop_calculate_level(xp), xp
+
+
+def test_total_xp_for_level_matches_loop():
+    for level in range(-5, 5000):
+        assert total_xp_for_level(level) == loop_total_xp_for_level(level), level
+
+
+def test_batch_matches_scalar():
+    values = sample_xp_values(seed=7)
+    expected = [loop_calculate_level(xp) for xp in values]
+    assert calculate_levels_batch(values).tolist() == expected
+
+
+def test_batch_beyond_precomputed_table():
+    values = [level_threshold(LEVEL_TABLE_SIZE + k) + d for k in range(-2, 3) for d in (-1, 0, 1)]
+    assert calculate_levels_batch(values).tolist() == [loop_calculate_level(xp) for xp in values]
+
+
+def test_batch_accepts_empty_input():
+    assert calculate_levels_batch([]).tolist() == []
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def batch_size(self, size):
+        return self
+
+    async def to_list(self, length):
+        batch, self.docs = self.docs[:length], self.docs[length:]
+        return batch
+
+
+class FakeUsers:
+    """Just enough of a Motor collection for recalculate_all_levels"""
+
+    def __init__(self, docs):
+        self.docs = {d["user_id"]: dict(d) for d in docs}
+        self.writes = []
+
+    def find(self, query, projection):
+        return FakeCursor([dict(d) for d in self.docs.values()])
+
+    async def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            self.writes.append(op)
+            self.docs[op._filter["user_id"]].update(op._doc["$set"])
+
+
+def test_recalculate_levels_endpoint_updates_only_stale_levels(monkeypatch):
+    count = server.LEVEL_RECALC_BATCH_SIZE + 7  # more than one batch
+    docs = []
+    for i in range(count):
+        xp = i * 137
+        level = loop_calculate_level(xp)
+        docs.append({"user_id": f"u{i}", "xp": xp, "level": level if i % 3 else level + 4})
+    docs.append({"user_id": "no_xp", "level": 9})
+    users = FakeUsers(docs)
+    monkeypatch.setattr(server, "db", type("FakeDb", (), {"users": users})())
+
+    result = asyncio.run(server.recalculate_all_levels(user=None))
+
+    assert result["scanned"] == count + 1
+    assert result["updated"] == len(range(0, count, 3)) + 1
+    assert len(users.writes) == result["updated"]
+    for doc in users.docs.values():
+        assert doc["level"] == loop_calculate_level(doc.get("xp", 0))
+
+
+def benchmark(count=100000):
+    rng = random.Random(1)
+    values = [rng.randrange(0, 2_000_000) for _ in range(count)]
+
+    def timed(fn):
+        start = time.perf_counter()
+        fn()
+        return time.perf_counter() - start
+
+    loop_time = timed(lambda: [loop_calculate_level(xp) for xp in values])
+    closed_time = timed(lambda: [calculate_level(xp) for xp in values])
+    array = np.array(values)
+    batch_time = timed(lambda: calculate_levels_batch(array))
+
+    print(f"{count} users, XP up to 2,000,000")
+    print(f"  loop:        {loop_time * 1000:8.1f} ms")
+    print(f"  closed form: {closed_time * 1000:8.1f} ms ({loop_time / closed_time:.0f}x)")
+    print(f"  numpy batch: {batch_time * 1000:8.1f} ms ({loop_time / batch_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    benchmark()
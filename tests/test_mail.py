@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Tests for the pooled SMTP sender, rate limit and templates in backend/server.py,
+against a local aiosmtpd server standing in for the mail provider.
+
+Run with `pytest tests/test_mail.py`.
+"""
+
+import asyncio
+import os
+import smtplib
+import socket
+import sys
+import time
+from email.message import EmailMessage
+from pathlib import Path
+
+import pytest
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "tsmarket_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+SMTP_USER = "shop@tsmarket.test"
+SMTP_PASSWORD = "secret"
+REFUSED = "nobody@tsmarket.test"
+
+
+class Mailbox:
+    """aiosmtpd handler: keeps delivered messages, refuses one address"""
+
+    def __init__(self):
+        self.messages = []
+
+    async def handle_RCPT(self, smtp_server, session, envelope, address, rcpt_options):
+        if address == REFUSED:
+            return "550 5.1.1 No such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, smtp_server, session, envelope):
+        self.messages.append(envelope)
+        return "250 Message accepted"
+
+
+def authenticate(smtp_server, session, envelope, mechanism, auth_data):
+    ok = auth_data.login == SMTP_USER.encode() and auth_data.password == SMTP_PASSWORD.encode()
+    return AuthResult(success=ok)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def mailbox(monkeypatch):
+    handler = Mailbox()
+    port = free_port()
+    controller = Controller(
+        handler, hostname="127.0.0.1", port=port,
+        authenticator=authenticate, auth_require_tls=False
+    )
+    controller.start()
+    monkeypatch.setattr(server, "SMTP_SERVER", "127.0.0.1")
+    monkeypatch.setattr(server, "SMTP_PORT", port)
+    monkeypatch.setattr(server, "SMTP_USER", SMTP_USER)
+    monkeypatch.setattr(server, "SMTP_PASSWORD", SMTP_PASSWORD)
+    monkeypatch.setattr(server, "SMTP_STARTTLS", False)
+    yield handler
+    controller.stop()
+
+
+@pytest.fixture
+def connects(monkeypatch):
+    """Counts new SMTP connections opened by SmtpPool"""
+    opened = []
+    connect = server.SmtpPool._connect
+
+    def counting_connect():
+        conn = connect()
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(server.SmtpPool, "_connect", staticmethod(counting_connect))
+    return opened
+
+
+def message(to):
+    msg = EmailMessage()
+    msg["From"] = SMTP_USER
+    msg["To"] = to
+    msg["Subject"] = "Test"
+    msg.set_content("hello")
+    return msg
+
+
+def test_render_email_fills_template():
+    subject, html = server.render_email("verification_code", code="123456")
+    assert subject == "Код подтверждения регистрации TSMarket"
+    assert "123456" in html
+    assert "$code" not in html
+
+
+def test_pool_reuses_one_connection(mailbox, connects):
+    async def scenario():
+        pool = server.SmtpPool(1)
+        for i in range(3):
+            await pool.send(message(f"user{i}@tsmarket.test"))
+        await pool.close()
+
+    asyncio.run(scenario())
+    assert [m.rcpt_tos for m in mailbox.messages] == [[f"user{i}@tsmarket.test"] for i in range(3)]
+    assert len(connects) == 1
+
+
+def test_pool_reconnects_after_dropped_connection(mailbox, connects):
+    async def scenario():
+        pool = server.SmtpPool(1)
+        await pool.send(message("first@tsmarket.test"))
+        # Server side went away while the connection sat in the pool
+        pool.idle[0][0].close()
+        await pool.send(message("second@tsmarket.test"))
+        await pool.close()
+
+    asyncio.run(scenario())
+    assert len(mailbox.messages) == 2
+    assert len(connects) == 2
+
+
+def test_refused_recipient_keeps_connection(mailbox, connects):
+    async def scenario():
+        pool = server.SmtpPool(1)
+        with pytest.raises(smtplib.SMTPRecipientsRefused):
+            await pool.send(message(REFUSED))
+        assert len(pool.idle) == 1
+        await pool.send(message("next@tsmarket.test"))
+        await pool.close()
+
+    asyncio.run(scenario())
+    assert [m.rcpt_tos for m in mailbox.messages] == [["next@tsmarket.test"]]
+    assert len(connects) == 1
+
+
+def test_token_bucket_allows_burst_then_throttles():
+    async def scenario():
+        bucket = server.TokenBucket(rate=20, capacity=2)
+        start = time.monotonic()
+        await bucket.acquire()
+        await bucket.acquire()
+        burst = time.monotonic() - start
+        await bucket.acquire()
+        await bucket.acquire()
+        return burst, time.monotonic() - start
+
+    burst, total = asyncio.run(scenario())
+    assert burst < 0.02
+    # Two more tokens at 20/s take about 0.1s
+    assert total >= 0.09